@@ -1,20 +1,25 @@
-from ehrql.tables.tpp import patients, practice_registrations, clinical_events, addresses, medications, ons_deaths, apcs, decision_support_values, emergency_care_attendances, ethnicity_from_sus 
-from ehrql import create_dataset, codelist_from_csv, days, case, when, minimum_of, show
+from ehrql.tables.tpp import patients, practice_registrations, clinical_events, medications, ons_deaths, apcs, decision_support_values, emergency_care_attendances, ethnicity_from_sus 
+from ehrql import create_dataset, codelist_from_csv, days, minimum_of, show
 from datetime import date
 from analysis.dataset_definition.variable_helper_functions import (
-    get_prescription_dates, 
-    get_prescription_gaps,
+    count_prescriptions_by_class,
+    has_any_class_count_at_least,
     last_matching_event_clinical_snomed_before,
+    first_matching_event_clinical_snomed_date_on_or_before,
     last_matching_event_apc_before,
     last_matching_event_clinical_ctv3_before,
     ever_matching_event_clinical_ctv3_before,
     get_latest_ethnicity,
     get_imd,
+    get_address_on,
+    get_registration_on,
     filter_codes_by_category
 )
+from analysis.dataset_definition.recode import get_smoking_status
 
-# Codelists from codelists.py (which pulls all variables from the codelist folder)
-from codelists import *
+# Codelists from codelists.py (which pulls all variables from the codelist folder).
+# They are used as attributes of the module so that each codelist is only loaded when a function needs it
+import codelists
 
 ## This function adds all the variables for inclusion and exclusion criteria for the study
 ## Inputs: 
@@ -22,37 +27,20 @@ from codelists import *
 ## start_date - the date for which the variables will be calculated
 ## collapse_vars - if 0, adds all variables separately. If 1, creates one variable which is TRUE if the patient meets all criteria and FALSE otherwise
 ## column_suffix - the suffix to add to the variable name if collapse_vars is 1
-def add_inex_variables(dataset, start_date, collapse_vars=0, column_suffix=""):
+## keep_column - function which is TRUE for the columns to add (see column_manifest.get_column_filter). By default
+## every column is added
+def add_inex_variables(dataset, start_date, collapse_vars=0, column_suffix="", keep_column=None):
     
     # Dementia diagnosis
     inex_bin_has_dem = (
-        clinical_events.where(clinical_events.snomedct_code.is_in(dementia_codelist))
+        clinical_events.where(clinical_events.snomedct_code.is_in(codelists.dementia_codelist))
         .where(clinical_events.date.is_on_or_before(start_date))
         ).exists_for_patient()
 
-    # Long-term antihypertensive user 
-    inex_bin_antihyp = ((medications.where(medications.dmd_code.is_in(ace_inhibitor_codelist))
-        .where(medications.date.is_on_or_after(start_date - days(365)))
-        .where(medications.date.is_on_or_before(start_date))
-        .count_for_patient()) > 2) | ((medications.where(medications.dmd_code.is_in(alpha_adrenoceptor_blocking_drugs_codelist))
-        .where(medications.date.is_on_or_after(start_date - days(365)))
-        .where(medications.date.is_on_or_before(start_date))
-        .count_for_patient()) > 2) | ((medications.where(medications.dmd_code.is_in(angiotensin_ii_receptor_blockers_codelist))
-        .where(medications.date.is_on_or_after(start_date - days(365)))
-        .where(medications.date.is_on_or_before(start_date))
-        .count_for_patient()) > 2) | ((medications.where(medications.dmd_code.is_in(beta_blockers_codelist))
-        .where(medications.date.is_on_or_after(start_date - days(365)))
-        .where(medications.date.is_on_or_before(start_date))
-        .count_for_patient()) > 2) | ((medications.where(medications.dmd_code.is_in(calcium_channel_blockers_codelist))
-        .where(medications.date.is_on_or_after(start_date - days(365)))
-        .where(medications.date.is_on_or_before(start_date))
-        .count_for_patient()) > 2) | ((medications.where(medications.dmd_code.is_in(centrally_acting_antihypertensives_codelist))
-        .where(medications.date.is_on_or_after(start_date - days(365)))
-        .where(medications.date.is_on_or_before(start_date))
-        .count_for_patient()) > 2) | ((medications.where(medications.dmd_code.is_in(potassium_sparing_diuretics_codelist))
-        .where(medications.date.is_on_or_after(start_date - days(365)))
-        .where(medications.date.is_on_or_before(start_date))
-        .count_for_patient()) > 2)
+    # Long-term antihypertensive user: more than 2 prescriptions of any one class in the year before the start date
+    inex_bin_antihyp = has_any_class_count_at_least(
+        count_prescriptions_by_class(start_date - days(365), start_date, codelists.antihypertensive_class_by_code), 3
+    )
 
     # Alive at start date
     inex_bin_alive = (((patients.date_of_death.is_null()) | (patients.date_of_death.is_after(start_date))) & 
@@ -69,9 +57,9 @@ def add_inex_variables(dataset, start_date, collapse_vars=0, column_suffix=""):
     #Known sex
     inex_bin_known_sex = (patients.sex == "male") | (patients.sex == "female")
     #Known IMD
-    inex_bin_known_imd = addresses.for_patient_on(start_date).imd_rounded.is_not_null()
+    inex_bin_known_imd = get_address_on(start_date).imd_rounded.is_not_null()
     #Known region
-    inex_bin_known_region = practice_registrations.for_patient_on(start_date).practice_nuts1_region_name.is_not_null()
+    inex_bin_known_region = get_registration_on(start_date).practice_nuts1_region_name.is_not_null()
 
     # Add all variables to the dataset
     inex_vars = {
@@ -85,7 +73,8 @@ def add_inex_variables(dataset, start_date, collapse_vars=0, column_suffix=""):
 
         # Add them all to the dataset
         for name, expr in inex_vars.items():
-            dataset.add_column(name, expr)
+            if keep_column is None or keep_column(name):
+                dataset.add_column(name, expr)
 
     else:
         # Combine all expressions using logical AND
@@ -98,8 +87,9 @@ def add_inex_variables(dataset, start_date, collapse_vars=0, column_suffix=""):
                 combined_expr = combined_expr & expr
 
         # Only add if at least one variable exists
-        if combined_expr is not None:
-            dataset.add_column(f"inex_bin_all_{column_suffix}", combined_expr)
+        name = f"inex_bin_all_{column_suffix}"
+        if combined_expr is not None and (keep_column is None or keep_column(name)):
+            dataset.add_column(name, combined_expr)
 
 ## This function adds inclusion and exclusion criteria for the initial dataset (anyone who could become elligible at any point during the study period).
 ## dataset - the ehrQL dataset which the variables will be added to
@@ -109,33 +99,14 @@ def add_inex_variables_prematch(dataset,start_date,end_date):
     
     # Dementia diagnosis before end date
     inex_bin_has_dem = (
-        clinical_events.where(clinical_events.snomedct_code.is_in(dementia_codelist))
+        clinical_events.where(clinical_events.snomedct_code.is_in(codelists.dementia_codelist))
         .where(clinical_events.date.is_on_or_before(end_date))
         ).exists_for_patient()
     
-    # More than 2 antihypertensive 
-    inex_bin_antihyp = ((medications.where(medications.dmd_code.is_in(ace_inhibitor_codelist))
-        .where(medications.date.is_on_or_after(start_date))
-        .where(medications.date.is_on_or_before(end_date))
-        .count_for_patient()) > 2) | ((medications.where(medications.dmd_code.is_in(alpha_adrenoceptor_blocking_drugs_codelist))
-        .where(medications.date.is_on_or_after(start_date))
-        .where(medications.date.is_on_or_before(end_date))
-        .count_for_patient()) > 2) | ((medications.where(medications.dmd_code.is_in(angiotensin_ii_receptor_blockers_codelist))
-        .where(medications.date.is_on_or_after(start_date))
-        .where(medications.date.is_on_or_before(end_date))
-        .count_for_patient()) > 2) | ((medications.where(medications.dmd_code.is_in(beta_blockers_codelist))
-        .where(medications.date.is_on_or_after(start_date))
-        .where(medications.date.is_on_or_before(end_date))
-        .count_for_patient()) > 2) | ((medications.where(medications.dmd_code.is_in(calcium_channel_blockers_codelist))
-        .where(medications.date.is_on_or_after(start_date))
-        .where(medications.date.is_on_or_before(end_date))
-        .count_for_patient()) > 2) | ((medications.where(medications.dmd_code.is_in(centrally_acting_antihypertensives_codelist))
-        .where(medications.date.is_on_or_after(start_date))
-        .where(medications.date.is_on_or_before(end_date))
-        .count_for_patient()) > 2) | ((medications.where(medications.dmd_code.is_in(potassium_sparing_diuretics_codelist))
-        .where(medications.date.is_on_or_after(start_date))
-        .where(medications.date.is_on_or_before(end_date))
-        .count_for_patient()) > 2)
+    # More than 2 prescriptions of any one antihypertensive class
+    inex_bin_antihyp = has_any_class_count_at_least(
+        count_prescriptions_by_class(start_date, end_date, codelists.antihypertensive_class_by_code), 3
+    )
     
     # Alive at any time during study
     inex_bin_alive = (((patients.date_of_death.is_null()) | (patients.date_of_death.is_after(start_date))) & 
@@ -159,115 +130,101 @@ def add_inex_variables_prematch(dataset,start_date,end_date):
 ## dataset - the ehrQL dataset which the variables will be added to
 ## index_date - the start date for which the variables will be calculated and date for non time-varying variables
 ## end_date - the end date of the study period, used to calculate some variables such diagnoses
-def add_covariates(dataset, index_date, end_date, column_suffix=""):
+## keep_column - function which is TRUE for the columns to add (see column_manifest.get_column_filter). By default
+## every column is added
+def add_covariates(dataset, index_date, end_date, column_suffix="", keep_column=None):
 
     cov_num_age = patients.age_on(index_date)
     cov_cat_sex = patients.sex
 
     ### Ethnicity
-    cov_cat_ethnicity = get_latest_ethnicity(index_date,ethnicity_snomed, grouping=6)
+    cov_cat_ethnicity = get_latest_ethnicity(index_date,codelists.ethnicity_snomed, grouping=6)
 
     ### Deprivation
     cov_cat_imd = get_imd(index_date, groups=5, max_imd=32844)
 
-    cov_cat_region = practice_registrations.for_patient_on(index_date).practice_nuts1_region_name
+    cov_cat_region = get_registration_on(index_date).practice_nuts1_region_name
 
-    # Date of first dementia diagnosis
-    cov_dat_dem = (
-        clinical_events.where(clinical_events.snomedct_code.is_in(dementia_codelist))
-        .where(clinical_events.date.is_on_or_before(end_date))
-        .sort_by(clinical_events.date)
-        .first_for_patient()
-        .date)
+    # Date of first dementia diagnosis. The diagnoses up to end_date only depend on the first diagnosis ever, so the
+    # same query is shared by every year the covariates are added for
+    cov_dat_dem = first_matching_event_clinical_snomed_date_on_or_before(codelists.dementia_codelist, end_date)
 
     # Alzheimer's diagnosis
-    cov_bin_dem_alz = (
-        clinical_events.where(clinical_events.snomedct_code.is_in(alzheimers_codelist))
-        .where(clinical_events.date.is_on_or_before(end_date))
-        ).exists_for_patient()
+    cov_bin_dem_alz = first_matching_event_clinical_snomed_date_on_or_before(
+        codelists.alzheimers_codelist, end_date
+        ).is_not_null()
 
     # Vascular dementia diagnosis
-    cov_bin_dem_vasc = (
-        clinical_events.where(clinical_events.snomedct_code.is_in(vascular_dementia_codelist))
-        .where(clinical_events.date.is_on_or_before(end_date))
-        ).exists_for_patient()
+    cov_bin_dem_vasc = first_matching_event_clinical_snomed_date_on_or_before(
+        codelists.vascular_dementia_codelist, end_date
+        ).is_not_null()
 
     # "Other" dementia diagnosis
-    cov_bin_dem_other = (
-        clinical_events.where(clinical_events.snomedct_code.is_in(other_dementia_codelist))
-        .where(clinical_events.date.is_on_or_before(end_date))
-        ).exists_for_patient()
+    cov_bin_dem_other = first_matching_event_clinical_snomed_date_on_or_before(
+        codelists.other_dementia_codelist, end_date
+        ).is_not_null()
 
     # Acute MI diagnosis
     cov_bin_ami = (
             (last_matching_event_clinical_snomed_before(
-                ami_snomed, index_date
+                codelists.ami_snomed, index_date
             ).exists_for_patient()) |
             (last_matching_event_apc_before(
-                ami_icd10 + ami_prior_icd10, index_date
+                codelists.ami_icd10 | codelists.ami_prior_icd10, index_date
             ).exists_for_patient())
         )
 
     ### Ischaemic stroke
     cov_bin_stroke = (
         (last_matching_event_clinical_snomed_before(
-            stroke_isch_snomed, index_date
+            codelists.stroke_isch_snomed, index_date
         ).exists_for_patient()) |
         (last_matching_event_apc_before(
-            stroke_isch_icd10, index_date
+            codelists.stroke_isch_icd10, index_date
         ).exists_for_patient())
     )
 
     #Date of CHD diagnosis
-    cov_dat_chd = (
-        clinical_events.where(clinical_events.snomedct_code.is_in(chd_codelist))
-        .where(clinical_events.date.is_on_or_before(end_date))
-        .sort_by(clinical_events.date)
-        .first_for_patient()
-        .date)
+    cov_dat_chd = first_matching_event_clinical_snomed_date_on_or_before(codelists.chd_codelist, end_date)
 
     ### Cancer
     cov_bin_cancer = (
         (last_matching_event_clinical_snomed_before(
-            cancer_snomed, index_date
+            codelists.cancer_snomed, index_date
         ).exists_for_patient()) |
         (last_matching_event_apc_before(
-            cancer_icd10, index_date
+            codelists.cancer_icd10, index_date
         ).exists_for_patient())
     )
 
     ### Hypertension 
     cov_bin_hypertension = (
         (last_matching_event_clinical_snomed_before(
-            hypertension_snomed, index_date
+            codelists.hypertension_snomed, index_date
         ).exists_for_patient()) |
         (last_matching_event_apc_before(
-            hypertension_icd10, index_date
+            codelists.hypertension_icd10, index_date
         ).exists_for_patient())
     )
 
     # Care home status
+    address = get_address_on(index_date)
     cov_bin_carehome = (
-            addresses.for_patient_on(index_date).care_home_is_potential_match |
-            addresses.for_patient_on(index_date).care_home_requires_nursing |
-            addresses.for_patient_on(index_date).care_home_does_not_require_nursing
+            address.care_home_is_potential_match |
+            address.care_home_requires_nursing |
+            address.care_home_does_not_require_nursing
         )
 
     ### Smoking status
     tmp_most_recent_smoking_cat = (
-        last_matching_event_clinical_ctv3_before(smoking_clear, index_date)
-        .ctv3_code.to_category(smoking_clear)
+        last_matching_event_clinical_ctv3_before(codelists.smoking_clear, index_date)
+        .ctv3_code.to_category(codelists.smoking_clear)
     )
     tmp_ever_smoked = ever_matching_event_clinical_ctv3_before(
-        (filter_codes_by_category(smoking_clear, include=["S", "E"])), index_date
+        (filter_codes_by_category(codelists.smoking_clear, include=["S", "E"])), index_date
         ).exists_for_patient()
 
-    cov_cat_smoking = case(
-        when(tmp_most_recent_smoking_cat == "S").then("S"),
-        when((tmp_most_recent_smoking_cat == "E") | ((tmp_most_recent_smoking_cat == "N") & (tmp_ever_smoked == True))).then("E"),
-        when((tmp_most_recent_smoking_cat == "N") & (tmp_ever_smoked == False)).then("N"),
-        otherwise="M"
-    )
+    cov_cat_smoking = get_smoking_status(tmp_most_recent_smoking_cat, tmp_ever_smoked)
 
     # Number of different medications prescribed in the year prior to index date
     cov_num_med_count = ( 
@@ -307,16 +264,17 @@ def add_covariates(dataset, index_date, end_date, column_suffix=""):
     covariates = {name: value for name, value in locals().items() if name.startswith("cov_")}
 
     for name, expr in covariates.items():
-        dataset.add_column(f"{name}_{column_suffix}", expr)
+        if keep_column is None or keep_column(f"{name}_{column_suffix}"):
+            dataset.add_column(f"{name}_{column_suffix}", expr)
     
 
-## This function adds columns for the next and previous prescriptions of a given medication around an index date
-## It also creates the columns counting the frequency of size gaps for the medication within the study period.
+## This function adds columns for the next and previous prescriptions of a given medication around an index date.
+## The gaps between prescriptions are counted from the extracted prescriptions (see prescription_gaps.py).
 ## Inputs:
 ## dataset - the ehrQL dataset which the variables will be added to
 ## index_date - the date around which the next and previous prescriptions will be identified
-## start_date - the start date for which the gaps will be calulated
-## end_date - the end date for which the gaps will be calculated
+## start_date - the earliest date of the previous prescription
+## end_date - the latest date of the next prescription
 ## medication_codelist - the codelist for the medication for which the variables will be created
 ## column_suffix - the suffix to add to the variables created by this function
 def add_out_variables(dataset, index_date, start_date, end_date, medication_codelist, column_suffix):
@@ -338,9 +296,6 @@ def add_out_variables(dataset, index_date, start_date, end_date, medication_code
         .last_for_patient()
         .date)
 
-    ## Number of days between prescription dates of antihypertensives
-    get_prescription_gaps(dataset, start_date, end_date, medication_codelist, column_suffix, 100)
-
     # ---- Add variables to dataset ----
     dataset.add_column(f"out_dat_next_{column_suffix}", out_dat_next_med)
     dataset.add_column(f"out_dat_prev_{column_suffix}", out_dat_prev_med)
\ No newline at end of file
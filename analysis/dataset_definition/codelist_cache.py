@@ -0,0 +1,146 @@
+## This file compiles the project's codelists into a single cached file.
+## The codelist CSVs are only parsed (and the derived codelists only recalculated) when the cache is missing
+## or out of date. The cache is keyed by the path, size and modification time of every codelist CSV,
+## codelists/codelists.json and the code that builds the codelists, so editing any of these rebuilds it on the next
+## run without reading the CSVs to check them.
+## Codelists are loaded as frozensets, or as dicts of code: category for codelists with a category column.
+## The cache is plain JSON, with each codelist stored separately and only decoded the first time it is used.
+
+import json
+import os
+import sys
+from collections.abc import Mapping
+from pathlib import Path
+
+from ehrql import codelist_from_csv
+
+CACHE_PATH = Path(".codelist_cache/compiled_codelists.json")
+CODELISTS_JSON = Path("codelists/codelists.json")
+
+
+## This function calculates the key identifying a set of compiled codelists, from the arguments used to read each
+## codelist and the size and modification time of every file they are built from
+## codelist_csvs: dict of codelist name: dict of arguments to codelist_from_csv
+## source_files: files containing the code that builds the codelists
+def get_cache_key(codelist_csvs, source_files):
+    paths = [csv_args["filename"] for csv_args in codelist_csvs.values()] + [CODELISTS_JSON, *source_files]
+    files = {}
+    for path in sorted(set(str(path) for path in paths)):
+        try:
+            stat = os.stat(path)
+            files[path] = [stat.st_size, stat.st_mtime_ns]
+        except OSError:
+            files[path] = None
+    arguments = {name: sorted(csv_args.items()) for name, csv_args in codelist_csvs.items()}
+    return json.dumps({"codelists": arguments, "files": files}, sort_keys=True)
+
+
+## This function reads the codelist CSVs and applies derive_codelists to them
+## codelist_csvs: dict of codelist name: dict of arguments to codelist_from_csv
+## derive_codelists: function taking the dict of codelists read from the CSVs and returning a dict of
+## any codelists derived from them
+def compile_codelists(codelist_csvs, derive_codelists):
+    codelists = {}
+    for name, csv_args in codelist_csvs.items():
+        codelist = codelist_from_csv(**csv_args)
+        codelists[name] = codelist if isinstance(codelist, dict) else frozenset(codelist)
+    codelists.update(derive_codelists(codelists))
+    return codelists
+
+
+## These functions convert a codelist to and from JSON. Codelists are sets of codes, dicts of code: category, or
+## dicts of name: codelist (e.g. antihypertensive_class_codelists)
+def to_json(codelist):
+    if isinstance(codelist, (set, frozenset)):
+        return {"codes": sorted(codelist)}
+    return {"dict": {key: value if isinstance(value, str) else to_json(value) for key, value in codelist.items()}}
+
+
+def from_json(value):
+    if "codes" in value:
+        return frozenset(value["codes"])
+    return {key: item if isinstance(item, str) else from_json(item) for key, item in value["dict"].items()}
+
+
+## This function writes compiled codelists to the cache. The first line of the cache is a JSON header (the cache
+## key and the position of each codelist in the rest of the file), followed by each codelist as JSON.
+## It is written to a temporary file which then replaces the cache, so that jobs reading the cache while another
+## job rewrites it never read a partly written file.
+def write_cache(cache_key, codelists):
+    blobs = {name: json.dumps(to_json(codelist)).encode() for name, codelist in codelists.items()}
+    index = {}
+    offset = 0
+    for name, blob in blobs.items():
+        index[name] = [offset, len(blob)]
+        offset += len(blob)
+    header = json.dumps({"key": cache_key, "index": index}).encode()
+
+    CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = CACHE_PATH.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        with tmp_path.open("wb") as f:
+            f.write(header + b"\n")
+            for blob in blobs.values():
+                f.write(blob)
+        os.replace(tmp_path, CACHE_PATH)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+## This function reads the cache, returning the cache key, the position of each codelist and the codelists as
+## JSON. The whole file is read at once, so a cache replaced by another job later on can't be mixed with this one.
+def read_cache():
+    data = CACHE_PATH.read_bytes()
+    header, _, codelists_json = data.partition(b"\n")
+    header = json.loads(header)
+    return header["key"], header["index"], codelists_json
+
+
+## Mapping of codelist name to codelist, which decodes each codelist from the cache when it is first used.
+## Codelists which have been used are listed in loaded_names.
+class CachedCodelists(Mapping):
+    def __init__(self, index, codelists_json, codelists=None):
+        self.index = index
+        self.codelists_json = codelists_json
+        self.codelists = dict(codelists or {})
+        self.loaded_names = []
+
+    def __getitem__(self, name):
+        if name not in self.codelists:
+            offset, length = self.index[name]
+            self.codelists[name] = from_json(json.loads(self.codelists_json[offset:offset + length]))
+        if name not in self.loaded_names:
+            self.loaded_names.append(name)
+        return self.codelists[name]
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+## This function returns the compiled codelists, from the cache if it is up to date and otherwise by
+## compiling them and updating the cache
+## codelist_csvs: dict of codelist name: dict of arguments to codelist_from_csv
+## derive_codelists: function returning any codelists derived from those read from the CSVs
+## source_files: files containing the code that builds the codelists
+def load_codelists(codelist_csvs, derive_codelists, source_files=()):
+    cache_key = get_cache_key(codelist_csvs, [__file__, *source_files])
+
+    try:
+        cached_key, index, codelists_json = read_cache()
+        if cached_key == cache_key:
+            return CachedCodelists(index, codelists_json)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    codelists = compile_codelists(codelist_csvs, derive_codelists)
+
+    # The cache is only an optimisation, so carry on if it can't be written (e.g. on a read-only checkout)
+    try:
+        write_cache(cache_key, codelists)
+    except OSError as error:
+        print(f"Codelist cache not written to {CACHE_PATH}: {error}", file=sys.stderr)
+
+    return CachedCodelists({name: None for name in codelists}, None, codelists)
@@ -1,156 +1,217 @@
-## This file loads all the necessary codelists for this project from OpenCodelists 
-from ehrql import codelist_from_csv
-
-# Ethnicity
-ethnicity_snomed = codelist_from_csv(
-  "codelists/opensafely-ethnicity-snomed-0removed.csv",
-  column = "code",
-  category_column = "Grouping_6"
-)
-
-## All dementia codes 
-dementia_codelist = codelist_from_csv(
-    "codelists/nhsd-primary-care-domain-refsets-dem_cod.csv",
-    column="code"
-)
-## Vascular dementia codes
-vascular_dementia_codelist = codelist_from_csv(
-    "codelists/nhsd-primary-care-domain-refsets-vascular-dementia-codes.csv",
-    column="code"
-)
-## Alzheimer's codes
-alzheimers_codelist = codelist_from_csv(
-    "codelists/nhsd-primary-care-domain-refsets-alzheimers-disease-dementia-codes.csv",
-    column="code"
-)
-# Other dementia = codes in general list but not in alz or vasc
-other_dementia_codelist = list(
-    set(dementia_codelist) - set(alzheimers_codelist).union(vascular_dementia_codelist)
-)
-
-## Medication review codes
-medication_review_codelist = codelist_from_csv(
-    "codelists/nhsd-primary-care-domain-refsets-demmedrvw_cod.csv",
-    column="code"
-)
-
-## Antihypertensive codes
-antihypertensive_codelist = codelist_from_csv(
-    "codelists/opensafely-combination-blood-pressure-medication.csv",
-    column="code"
-)
-## ACE-Inhibitor codes
-ace_inhibitor_codelist = codelist_from_csv(
-    "codelists/opensafely-ace-inhibitor-medications.csv",
-    column="code"
-)
-## Alpha-Adrenoceptor Blocking Drugs codes
-alpha_adrenoceptor_blocking_drugs_codelist = codelist_from_csv(
-    "codelists/opensafely-alpha-adrenoceptor-blocking-drugs.csv",
-    column="code"
-)
-## Angiotensin II Receptor Blockers (ARBs) codes
-angiotensin_ii_receptor_blockers_codelist = codelist_from_csv(
-    "codelists/opensafely-angiotensin-ii-receptor-blockers-arbs.csv",
-    column="code"
-)
-## Beta blockers codes
-beta_blockers_codelist = codelist_from_csv(
-    "codelists/opensafely-beta-blocker-medications.csv",
-    column="code"
-)
-## Calcium channel blockers codes
-calcium_channel_blockers_codelist = codelist_from_csv(
-    "codelists/opensafely-calcium-channel-blockers.csv",
-    column="code"
-)
-
-## Centrally acting antihypertensives codes
-centrally_acting_antihypertensives_codelist = codelist_from_csv(
-    "codelists/user-robert_porteous-centrally-acting-antihypertensives-dmd.csv",
-    column="code"
-)
-
-## Potassium sparing diuretics codes
-potassium_sparing_diuretics_codelist = codelist_from_csv(
-    "codelists/user-robert_porteous-potassium-sparing-diuretics-aldosterone-antagonists-and-compounds-dmd.csv",
-    column="code"
-)
-
-## Chronic Heart Disease codes
-chd_codelist = codelist_from_csv(
-    "codelists/primis-covid19-vacc-uptake-chd_cov.csv",
-    column="code"
-)
-
-## Myocardial Infarction codes
-mi_codelist = codelist_from_csv(
-    "codelists/nhsd-primary-care-domain-refsets-mi_cod.csv",
-    column="code"
-)
-
-## Stroke codes
-strk_codelist = codelist_from_csv(
-    "codelists/nhsd-primary-care-domain-refsets-strk_cod.csv",
-    column="code"
-)
-
-# AMI (Acute Myocardial Infarction)
-ami_snomed = codelist_from_csv(
-  "codelists/user-elsie_horne-ami_snomed.csv",
-  column = "code"
-)
-ami_icd10 = codelist_from_csv(
-  "codelists/user-RochelleKnight-ami_icd10.csv",
-  column = "code"
-)
-ami_prior_icd10 = codelist_from_csv(
-  "codelists/user-elsie_horne-ami_prior_icd10.csv",
-  column = "code"
-)
-
-# Stroke Ischaemic (Ischaemic Stroke)
-stroke_isch_snomed = codelist_from_csv(
-  "codelists/user-elsie_horne-stroke_isch_snomed.csv",
-  column = "code"
-)
-stroke_isch_icd10 = codelist_from_csv(
-  "codelists/user-RochelleKnight-stroke_isch_icd10.csv",
-  column = "code"
-)
-
-# Cancer
-cancer_snomed = codelist_from_csv(
-  "codelists/user-elsie_horne-cancer_snomed.csv",
-  column = "code"
-)
-cancer_icd10 = codelist_from_csv(
-  "codelists/user-elsie_horne-cancer_icd10.csv",
-  column = "code"
-)
-
-# Hypertension
-hypertension_icd10 = codelist_from_csv(
-  "codelists/user-elsie_horne-hypertension_icd10.csv",
-  column = "code"
-)
-hypertension_snomed = codelist_from_csv(
-  "codelists/nhsd-primary-care-domain-refsets-hyp_cod.csv",
-  column = "code"
-)
-
-# Smoking
-smoking_clear = codelist_from_csv(
-  "codelists/opensafely-smoking-clear.csv",
-  column = "CTV3Code",
-  category_column = "Category"
-)
-smoking_unclear = codelist_from_csv(
-  "codelists/opensafely-smoking-unclear.csv",
-  column = "CTV3Code",
-  category_column = "Category"
-)
-ever_current_smoke = codelist_from_csv(
-  "codelists/bristol-smoke-and-eversmoke.csv",
-  column = "code"
-)
\ No newline at end of file
+## This file loads all the necessary codelists for this project from OpenCodelists.
+## The codelists are compiled into a cache by codelist_cache.py, so the CSVs are only read again when they change.
+## Each codelist is available as a module-level variable, e.g. dementia_codelist, which is only loaded the first
+## time it is used. Importing a codelist by name (from codelists import dementia_codelist) or using it as an
+## attribute (codelists.dementia_codelist) only loads that codelist. `from codelists import *` still works, but it
+## loads every codelist, as Python looks up each name in __all__ to bind it, so the dataset definitions import the
+## codelists they use by name.
+from codelist_cache import load_codelists
+
+## Codelists read from the codelists folder, with the arguments to pass to codelist_from_csv
+codelist_csvs = {
+    # Ethnicity
+    "ethnicity_snomed": dict(
+        filename="codelists/opensafely-ethnicity-snomed-0removed.csv",
+        column="code",
+        category_column="Grouping_6"
+    ),
+
+    ## All dementia codes
+    "dementia_codelist": dict(
+        filename="codelists/nhsd-primary-care-domain-refsets-dem_cod.csv",
+        column="code"
+    ),
+
+    ## Vascular dementia codes
+    "vascular_dementia_codelist": dict(
+        filename="codelists/nhsd-primary-care-domain-refsets-vascular-dementia-codes.csv",
+        column="code"
+    ),
+
+    ## Alzheimer's codes
+    "alzheimers_codelist": dict(
+        filename="codelists/nhsd-primary-care-domain-refsets-alzheimers-disease-dementia-codes.csv",
+        column="code"
+    ),
+
+    ## Medication review codes
+    "medication_review_codelist": dict(
+        filename="codelists/nhsd-primary-care-domain-refsets-demmedrvw_cod.csv",
+        column="code"
+    ),
+
+    ## Antihypertensive codes
+    "antihypertensive_codelist": dict(
+        filename="codelists/opensafely-combination-blood-pressure-medication.csv",
+        column="code"
+    ),
+
+    ## ACE-Inhibitor codes
+    "ace_inhibitor_codelist": dict(
+        filename="codelists/opensafely-ace-inhibitor-medications.csv",
+        column="code"
+    ),
+
+    ## Alpha-Adrenoceptor Blocking Drugs codes
+    "alpha_adrenoceptor_blocking_drugs_codelist": dict(
+        filename="codelists/opensafely-alpha-adrenoceptor-blocking-drugs.csv",
+        column="code"
+    ),
+
+    ## Angiotensin II Receptor Blockers (ARBs) codes
+    "angiotensin_ii_receptor_blockers_codelist": dict(
+        filename="codelists/opensafely-angiotensin-ii-receptor-blockers-arbs.csv",
+        column="code"
+    ),
+
+    ## Beta blockers codes
+    "beta_blockers_codelist": dict(
+        filename="codelists/opensafely-beta-blocker-medications.csv",
+        column="code"
+    ),
+
+    ## Calcium channel blockers codes
+    "calcium_channel_blockers_codelist": dict(
+        filename="codelists/opensafely-calcium-channel-blockers.csv",
+        column="code"
+    ),
+
+    ## Centrally acting antihypertensives codes
+    "centrally_acting_antihypertensives_codelist": dict(
+        filename="codelists/user-robert_porteous-centrally-acting-antihypertensives-dmd.csv",
+        column="code"
+    ),
+
+    ## Potassium sparing diuretics codes
+    "potassium_sparing_diuretics_codelist": dict(
+        filename="codelists/user-robert_porteous-potassium-sparing-diuretics-aldosterone-antagonists-and-compounds-dmd.csv",
+        column="code"
+    ),
+
+    ## Chronic Heart Disease codes
+    "chd_codelist": dict(
+        filename="codelists/primis-covid19-vacc-uptake-chd_cov.csv",
+        column="code"
+    ),
+
+    ## Myocardial Infarction codes
+    "mi_codelist": dict(
+        filename="codelists/nhsd-primary-care-domain-refsets-mi_cod.csv",
+        column="code"
+    ),
+
+    ## Stroke codes
+    "strk_codelist": dict(
+        filename="codelists/nhsd-primary-care-domain-refsets-strk_cod.csv",
+        column="code"
+    ),
+
+    # AMI (Acute Myocardial Infarction)
+    "ami_snomed": dict(
+        filename="codelists/user-elsie_horne-ami_snomed.csv",
+        column="code"
+    ),
+    "ami_icd10": dict(
+        filename="codelists/user-RochelleKnight-ami_icd10.csv",
+        column="code"
+    ),
+    "ami_prior_icd10": dict(
+        filename="codelists/user-elsie_horne-ami_prior_icd10.csv",
+        column="code"
+    ),
+
+    # Stroke Ischaemic (Ischaemic Stroke)
+    "stroke_isch_snomed": dict(
+        filename="codelists/user-elsie_horne-stroke_isch_snomed.csv",
+        column="code"
+    ),
+    "stroke_isch_icd10": dict(
+        filename="codelists/user-RochelleKnight-stroke_isch_icd10.csv",
+        column="code"
+    ),
+
+    # Cancer
+    "cancer_snomed": dict(
+        filename="codelists/user-elsie_horne-cancer_snomed.csv",
+        column="code"
+    ),
+    "cancer_icd10": dict(
+        filename="codelists/user-elsie_horne-cancer_icd10.csv",
+        column="code"
+    ),
+
+    # Hypertension
+    "hypertension_icd10": dict(
+        filename="codelists/user-elsie_horne-hypertension_icd10.csv",
+        column="code"
+    ),
+    "hypertension_snomed": dict(
+        filename="codelists/nhsd-primary-care-domain-refsets-hyp_cod.csv",
+        column="code"
+    ),
+
+    # Smoking
+    "smoking_clear": dict(
+        filename="codelists/opensafely-smoking-clear.csv",
+        column="CTV3Code",
+        category_column="Category"
+    ),
+    "smoking_unclear": dict(
+        filename="codelists/opensafely-smoking-unclear.csv",
+        column="CTV3Code",
+        category_column="Category"
+    ),
+    "ever_current_smoke": dict(
+        filename="codelists/bristol-smoke-and-eversmoke.csv",
+        column="code"
+    ),
+}
+
+## This function derives the codelists that are built from other codelists
+def derive_codelists(codelists):
+    # Other dementia = codes in general list but not in alz or vasc
+    other_dementia_codelist = codelists["dementia_codelist"] - (
+        codelists["alzheimers_codelist"] | codelists["vascular_dementia_codelist"]
+    )
+
+    ## Antihypertensive class codelists, keyed by the suffix used for each class in variable names
+    antihypertensive_class_codelists = {
+        "acei": codelists["ace_inhibitor_codelist"],
+        "aab": codelists["alpha_adrenoceptor_blocking_drugs_codelist"],
+        "arb": codelists["angiotensin_ii_receptor_blockers_codelist"],
+        "bb": codelists["beta_blockers_codelist"],
+        "ccb": codelists["calcium_channel_blockers_codelist"],
+        "caa": codelists["centrally_acting_antihypertensives_codelist"],
+        "psd": codelists["potassium_sparing_diuretics_codelist"],
+    }
+
+    ## Antihypertensive codes tagged with their class, so that prescriptions of every class can be counted from
+    ## one set of medications. A code in more than one class is tagged with each of them joined by "|", e.g. "acei|ccb"
+    antihypertensive_class_by_code = {}
+    for name, codelist in antihypertensive_class_codelists.items():
+        for code in codelist:
+            if code in antihypertensive_class_by_code:
+                antihypertensive_class_by_code[code] += f"|{name}"
+            else:
+                antihypertensive_class_by_code[code] = name
+
+    return {
+        "other_dementia_codelist": other_dementia_codelist,
+        "antihypertensive_class_codelists": antihypertensive_class_codelists,
+        "antihypertensive_class_by_code": antihypertensive_class_by_code,
+    }
+
+compiled_codelists = load_codelists(codelist_csvs, derive_codelists, source_files=[__file__])
+
+__all__ = list(compiled_codelists)
+
+## Load a codelist the first time it is used, and keep it as a module-level variable
+def __getattr__(name):
+    if name not in compiled_codelists:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    codelist = compiled_codelists[name]
+    globals()[name] = codelist
+    return codelist
+
+def __dir__():
+    return sorted(set(globals()) | set(compiled_codelists))
@@ -0,0 +1,56 @@
+## This file contains functions for pruning the columns of a dataset definition to those which the later actions
+## read. analysis/column_manifest.json lists, for each dataset, the columns each table script reads from it, as
+## names or fnmatch patterns (e.g. cov_cat_*). Scripts which read the one row per patient per year version of a
+## dataset (see patient_years.py) list the names without the year, and these match the column for every year.
+## Columns made from other columns after the dataset is generated are listed in DERIVED_COLUMNS, and a script which
+## reads one of them reads the columns it is made from.
+## When prune_columns is true in config.json, the dataset definitions only add the columns which a script reads
+## (see get_column_filter), so the queries of the other columns are never run. analysis/dev_tools/check_column_manifest.py checks that every
+## column a table script selects is in the manifest.
+
+import json
+import re
+from fnmatch import fnmatchcase
+
+MANIFEST_PATH = "analysis/column_manifest.json"
+
+# Name of a variable followed by a year, with or without an underscore between them (e.g. desc_cat_region2017)
+YEAR_SUFFIX = re.compile(r"^(.*?)_?(\d{4})$")
+
+## Columns made when a dataset is cleaned, and the patterns of the generated columns they are made from
+DERIVED_COLUMNS = {
+    # Eligibility in each year, packed into one integer by clean_dataset.py --pack-eligibility
+    "inex_num_years": ["inex_bin_all_*"],
+}
+
+
+## This function returns the columns read from a dataset by each table script, as a dict of script: patterns
+def get_consumers(dataset_name):
+    with open(MANIFEST_PATH) as f:
+        return json.load(f)[dataset_name]
+
+
+## This function returns whether a column matches any of the patterns, with or without its year suffix
+def is_consumed(column_name, patterns):
+    names = [column_name]
+    match = YEAR_SUFFIX.match(column_name)
+    if match:
+        names.append(match.group(1))
+    return any(fnmatchcase(name, pattern) for name in names for pattern in patterns)
+
+
+## This function returns a function which is TRUE for the columns of a dataset which a table script reads, and so
+## should be added to it. Every column is added if prune_columns isn't set in config.json
+## dataset_name: the name of the dataset in the manifest (e.g. "cov")
+def get_column_filter(dataset_name):
+    with open("analysis/config.json") as f:
+        if not json.load(f).get("prune_columns", False):
+            return lambda column_name: True
+    patterns = [pattern for consumer in get_consumers(dataset_name).values() for pattern in consumer]
+    patterns += [
+        source
+        for name, sources in DERIVED_COLUMNS.items()
+        if is_consumed(name, patterns)
+        for source in sources
+    ]
+    return lambda column_name: is_consumed(column_name, patterns)
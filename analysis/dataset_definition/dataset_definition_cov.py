@@ -2,13 +2,11 @@
 ## For now these will be presented in table 1 format to be used in the descriptive section of the study.
 ## Variables are defined for each year of the study period to account for possible changes in the values and inclusion
 
-from ehrql.tables.tpp import clinical_events, practice_registrations
+from ehrql.tables.tpp import clinical_events
 from ehrql import create_dataset
-from ehrql.query_language import table_from_file , PatientFrame, Series
-from datetime import datetime, date
-from analysis.dataset_definition.variable_helper_functions import (
-    get_prescription_gaps
-)
+from analysis.dataset_definition.population import eligible_population
+from analysis.dataset_definition.column_manifest import get_column_filter
+from datetime import date
 from analysis.dataset_definition.add_variables import(
     add_covariates,
     add_inex_variables,
@@ -16,43 +14,40 @@ from analysis.dataset_definition.add_variables import(
 
 
 # Codelists from codelists.py (which pulls all variables from the codelist folder)
-from codelists import *
-@table_from_file("output/dataset_clean/input_clean_prematch.csv.gz")
-class input_inex(PatientFrame):
-    qa_num_birth_year = Series(str)
+from codelists import medication_review_codelist
 
 ## Create dataset
 dataset = create_dataset()
 
-import json
-with open("analysis/config.json") as f:
-    study_dates = json.load(f)
-start_date = study_dates["start_date"]
-end_date = study_dates["end_date"]
+from analysis.dataset_definition.study_dates import start_date, end_date, get_partition
+
+# Years to create variables for (all of them, unless this is one partition of the dataset), and whether to
+# create the variables shared by every year
+partition_years, include_shared = get_partition()
 
-index_date = start_date
-limit = 2
+# Only the columns which a table script reads are added (see analysis/column_manifest.json)
+keep_column = get_column_filter("cov")
 
-# Add inex variables for 2015 through 2024
-for year in range(2017, 2025):
+# Add inex variables for each year of the study
+for year in partition_years:
     #Add collapsed in/ex variable for each year in the study
-    add_inex_variables(dataset, date(year, 1, 1), 1,year)
+    add_inex_variables(dataset, date(year, 1, 1), 1,year, keep_column)
 
     # ---------------------------------
     # Create covariates on index date
-    add_covariates(dataset, date(year, 1, 1), date(year, 12, 31), year)
+    add_covariates(dataset, date(year, 1, 1), date(year, 12, 31), year, keep_column)
 
-    # Medication review variables
-    exp_dat_med_rev = (
+if include_shared and keep_column("exp_dat_med_rev"):
+    # Medication review variables. The first review in the study period is the same for every year, so it is added
+    # once without a year suffix (patient_years.py repeats it on each year's row)
+    dataset.exp_dat_med_rev = (
         clinical_events.where(clinical_events.snomedct_code.is_in(medication_review_codelist))
         .where(clinical_events.date.is_on_or_after(start_date))
         .where(clinical_events.date.is_on_or_before(end_date))
         .sort_by(clinical_events.date)
         .first_for_patient()
         .date)
-    
-    dataset.add_column(f"exp_dat_med_rev_{year}", exp_dat_med_rev)
 
 ##Define population
 dataset.configure_dummy_data()
-dataset.define_population(input_inex.exists_for_patient())
+dataset.define_population(eligible_population.exists_for_patient())
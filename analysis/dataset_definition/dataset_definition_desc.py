@@ -2,46 +2,45 @@
 ## Key variables defined are:
 ## - Number of medication reviews each patient has in each year of the study
 ## - Date of first medication review for each year of the study period
-## - Date of the first "stopping" event for each drug in each year of the study based on different stopping definitions
 ## - Region of the patient's practice for regional analysis 
+## The date of the first "stopping" event for each drug in each year of the study, based on different stopping
+## definitions, is added in analysis/dataset_derive/derive_dataset_desc.py
 
-from analysis.dataset_definition.variable_helper_functions import get_stopping_dates_after_event
-from ehrql.tables.tpp import practice_registrations, clinical_events
+from ehrql.tables.tpp import clinical_events
 from ehrql import create_dataset, days
-from ehrql.query_language import table_from_file , PatientFrame, Series
+from analysis.dataset_definition.population import eligible_population
+from analysis.dataset_definition.column_manifest import get_column_filter
+from analysis.dataset_definition.variable_helper_functions import get_registration_on
 from datetime import date
 
 from analysis.dataset_definition.add_variables import(
     add_inex_variables)
 
 # Codelists from codelists.py (which pulls all variables from the codelist folder)
-from codelists import *
-@table_from_file("output/dataset_clean/input_clean_prematch.csv.gz")
-class input_inex(PatientFrame):
-    qa_num_birth_year = Series(int)
+from codelists import medication_review_codelist
 
 
 ## Create dataset
 dataset = create_dataset()
 
 #Get study dates
-import json
-with open("analysis/config.json") as f:
-    study_dates = json.load(f)
-start_date = study_dates["start_date"]
-end_date = study_dates["end_date"]
+from analysis.dataset_definition.study_dates import start_date, get_partition
 
-#Add region variable for regional analysis
+# Years to create variables for (all of them, unless this is one partition of the dataset)
+partition_years, include_shared = get_partition()
+
+# Only the columns which a table script reads are added (see analysis/column_manifest.json)
+keep_column = get_column_filter("desc")
 
-dataset.desc_cat_region = practice_registrations.for_patient_on(start_date).practice_nuts1_region_name
+#Add region variable for regional analysis
 
-# Different gap sizes defining stopping events
-gap_sizes = [30, 90, 180]
+if include_shared and keep_column("desc_cat_region"):
+    dataset.desc_cat_region = get_registration_on(start_date).practice_nuts1_region_name
 
-# Add inex variables for 2015 through 2024
-for year in range(2017, 2025):
+# Add inex variables for each year of the study
+for year in partition_years:
     #Add collapsed in/ex variable for each year in the study
-    add_inex_variables(dataset, date(year, 1, 1), 1,year)
+    add_inex_variables(dataset, date(year, 1, 1), 1,year, keep_column)
 
     
     med_rev=(clinical_events.where(clinical_events.snomedct_code.is_in(medication_review_codelist))
@@ -57,21 +56,11 @@ for year in range(2017, 2025):
     .date)
     
     # Add medication review variables for each year
-    dataset.add_column(f"desc_num_med_rev_{year}", med_rev)
-    dataset.add_column(f"desc_dat_med_rev_{year}", med_rev_dat)
-
-    # Loop through gap sizes
-    for gap_size in gap_sizes:
-    
-        # Add variables for date of first stop following medication review for each year for each medication class
-        get_stopping_dates_after_event(dataset, date(year, 1, 1), date(year, 1, 1)+days(365), ace_inhibitor_codelist, medication_review_codelist, f"desc_dat_stop_acei_{gap_size}_{year}", 10, gap_size)
-        get_stopping_dates_after_event(dataset, date(year, 1, 1), date(year, 1, 1)+days(365), alpha_adrenoceptor_blocking_drugs_codelist, medication_review_codelist, f"desc_dat_stop_aab_{gap_size}_{year}", 10, gap_size)
-        get_stopping_dates_after_event(dataset, date(year, 1, 1), date(year, 1, 1)+days(365), angiotensin_ii_receptor_blockers_codelist, medication_review_codelist, f"desc_dat_stop_arb_{gap_size}_{year}", 10, gap_size)
-        get_stopping_dates_after_event(dataset, date(year, 1, 1), date(year, 1, 1)+days(365), beta_blockers_codelist, medication_review_codelist, f"desc_dat_stop_bb_{gap_size}_{year}", 10, gap_size)
-        get_stopping_dates_after_event(dataset, date(year, 1, 1), date(year, 1, 1)+days(365), calcium_channel_blockers_codelist, medication_review_codelist, f"desc_dat_stop_ccb_{gap_size}_{year}", 10, gap_size)
-        get_stopping_dates_after_event(dataset, date(year, 1, 1), date(year, 1, 1)+days(365), centrally_acting_antihypertensives_codelist, medication_review_codelist, f"desc_dat_stop_caa_{gap_size}_{year}", 10, gap_size)
-        get_stopping_dates_after_event(dataset, date(year, 1, 1), date(year, 1, 1)+days(365), potassium_sparing_diuretics_codelist, medication_review_codelist, f"desc_dat_stop_psd_{gap_size}_{year}", 10, gap_size)
+    if keep_column(f"desc_num_med_rev_{year}"):
+        dataset.add_column(f"desc_num_med_rev_{year}", med_rev)
+    if keep_column(f"desc_dat_med_rev_{year}"):
+        dataset.add_column(f"desc_dat_med_rev_{year}", med_rev_dat)
 
 ##Define population
 dataset.configure_dummy_data()
-dataset.define_population(input_inex.exists_for_patient())
+dataset.define_population(eligible_population.exists_for_patient())
@@ -0,0 +1,99 @@
+## This script extracts the event-level records from which the medication-derived variables are calculated.
+## Every antihypertensive prescription and every medication review in the study period (plus a year of follow-up)
+## is extracted once, and the gaps between prescriptions (out_num_gap_*) and the stopping dates after medication
+## reviews (desc_dat_stop_*) are derived from these tables by the scripts in analysis/dataset_derive, rather than
+## each being a separate patient-level query on the medications table.
+## The same tables, with the registrations, addresses and the dates below, are used by rolling_eligibility.py to find
+## the patients eligible on any series of index dates (e.g. monthly) without a query for each date.
+## Outputs (in output/medication_events):
+## - prescriptions: one row per prescription, with its date and a TRUE/FALSE column for each medication class.
+##   Prescriptions start a year before the study, for the antihypertensive criterion on the first index dates
+## - medication_reviews: one row per medication review, with its date
+## - registrations: one row per practice registration covering any part of the study, with its start and end dates,
+##   practice and region
+## - addresses: one row per address covering any part of the study, with its start and end dates, whether it has a
+##   postcode and whether it has an IMD
+## - dataset: one row per patient, with the date of birth, the dates of death (from the primary care and ONS
+##   records), the date of the first dementia diagnosis and the patient's sex
+
+from ehrql import create_dataset, days
+from ehrql.tables.tpp import addresses, clinical_events, ons_deaths, patients, practice_registrations
+from analysis.dataset_definition.population import eligible_population
+from datetime import date
+from analysis.dataset_definition.variable_helper_functions import (
+    add_clinical_event_table,
+    add_prescription_event_table,
+)
+
+# Codelists from codelists.py (which pulls all variables from the codelist folder)
+from codelists import antihypertensive_class_codelists, dementia_codelist, medication_review_codelist
+
+## Create dataset
+dataset = create_dataset()
+
+#Get study dates
+from analysis.dataset_definition.study_dates import start_date, end_date
+start_date = date.fromisoformat(start_date)
+end_date = date.fromisoformat(end_date)
+
+## Gaps and stopping events starting in the last year of the study can end up to 365 days after its end
+follow_up_end_date = end_date + days(365)
+
+add_prescription_event_table(
+    dataset,
+    start_date - days(365),
+    follow_up_end_date,
+    antihypertensive_class_codelists,
+    "prescriptions"
+)
+
+add_clinical_event_table(
+    dataset,
+    start_date,
+    follow_up_end_date,
+    medication_review_codelist,
+    "medication_reviews"
+)
+
+## Registrations covering any part of the study, for the 6 month registration and known region criteria
+registrations = practice_registrations.where(
+    practice_registrations.start_date.is_on_or_before(end_date)
+    & (practice_registrations.end_date.is_null() | practice_registrations.end_date.is_on_or_after(start_date))
+)
+dataset.add_event_table(
+    "registrations",
+    start_date=registrations.start_date,
+    end_date=registrations.end_date,
+    practice_pseudo_id=registrations.practice_pseudo_id,
+    region=registrations.practice_nuts1_region_name,
+)
+
+## Addresses covering any part of the study, for the known IMD criterion
+study_addresses = addresses.where(
+    addresses.start_date.is_on_or_before(end_date)
+    & (addresses.end_date.is_null() | addresses.end_date.is_on_or_after(start_date))
+)
+dataset.add_event_table(
+    "addresses",
+    start_date=study_addresses.start_date,
+    end_date=study_addresses.end_date,
+    address_id=study_addresses.address_id,
+    has_postcode=study_addresses.has_postcode,
+    has_imd=study_addresses.imd_rounded.is_not_null(),
+)
+
+## Patient dates for the age, alive and dementia criteria
+dataset.inex_dat_birth = patients.date_of_birth
+dataset.inex_dat_death = patients.date_of_death
+dataset.inex_dat_death_ons = ons_deaths.date
+dataset.inex_dat_dem = (
+    clinical_events.where(clinical_events.snomedct_code.is_in(dementia_codelist))
+    .where(clinical_events.date.is_not_null())
+    .sort_by(clinical_events.date)
+    .first_for_patient()
+    .date)
+dataset.inex_cat_sex = patients.sex
+
+##Define population
+dataset.configure_dummy_data()
+dataset.define_population(eligible_population.exists_for_patient())
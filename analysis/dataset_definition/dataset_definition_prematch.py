@@ -9,18 +9,11 @@ from analysis.dataset_definition.add_variables import(
     add_inex_variables_prematch
 )
 
-# Codelists from codelists.py (which pulls all variables from the codelist folder)
-from codelists import *
-
 ## Create dataset
 dataset = create_dataset()
 
 #Get study dates
-import json
-with open("analysis/config.json") as f:
-    study_dates = json.load(f)
-start_date = study_dates["start_date"]
-end_date = study_dates["end_date"]
+from analysis.dataset_definition.study_dates import start_date, end_date
 
 ## ---------------------------------
 ## Create variables for inclusion / exclusion criteria during the study period
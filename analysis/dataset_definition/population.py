@@ -0,0 +1,10 @@
+## This file defines the eligible population for the dataset definitions which run after the prematch dataset has
+## been cleaned. The population is read from the typed Arrow file written by clean_dataset.py --population (the
+## clean_dataset_prematch action), which is uncompressed so ehrQL can read it without parsing any text.
+
+from ehrql.query_language import table_from_file, PatientFrame, Series
+
+
+@table_from_file("output/dataset_clean/population_prematch.arrow")
+class eligible_population(PatientFrame):
+    qa_num_birth_year = Series(int)
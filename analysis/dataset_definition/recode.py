@@ -0,0 +1,79 @@
+## This file contains the tables used to recode categorical variables (ethnicity, smoking status and IMD), and the
+## functions which turn a table into a single ehrQL operation: a lookup (map_values) for codes, and a division
+## followed by a lookup for equal-width numeric bands. Each grouping of a variable is a column of the same table,
+## so the 6 and 16 category versions of ethnicity (or 5 and 10 IMD bands) don't repeat any branches.
+
+from ehrql import case, when
+
+## Ethnicity categories, one row per 16 category group. The SNOMED CT codelist gives each code a category number
+## (Grouping_16 or Grouping_6), and SUS records give a letter code.
+## Columns: 16 group category, SUS code, 16 group label, 6 group category, 6 group label
+ETHNICITY_GROUPS = [
+    ("1", "A", "White British", "1", "White"),
+    ("2", "B", "White Irish", "1", "White"),
+    ("3", "C", "Other White", "1", "White"),
+    ("4", "D", "White and Caribbean", "2", "Mixed"),
+    ("5", "E", "White and African", "2", "Mixed"),
+    ("6", "F", "White and Asian", "2", "Mixed"),
+    ("7", "G", "Other Mixed", "2", "Mixed"),
+    ("8", "H", "Indian", "3", "Asian"), # Asian or Asian British
+    ("9", "J", "Pakistani", "3", "Asian"),
+    ("10", "K", "Bangladeshi", "3", "Asian"),
+    ("11", "L", "Other Asian", "3", "Asian"),
+    ("12", "M", "Caribbean", "4", "Black"), # Black or Black British
+    ("13", "N", "African", "4", "Black"),
+    ("14", "P", "Other Black", "4", "Black"),
+    ("15", "R", "Chinese", "5", "Other"), # Chinese or Other Ethnic group
+    ("16", "S", "All other ethnic groups", "5", "Other"),
+]
+
+## Smoking status of the most recent smoking code: S (smoker), E (ex-smoker) and N (never smoked)
+SMOKING_STATUS = {"S": "S", "E": "E", "N": "N"}
+
+
+## This function returns the label of each ethnicity category for a grouping (6 or 16), keyed by the SNOMED CT
+## codelist category and by the SUS code
+def get_ethnicity_mappings(grouping=6):
+    if grouping == 6:
+        snomed = {category: label for _, _, _, category, label in ETHNICITY_GROUPS}
+        sus = {sus_code: label for _, sus_code, _, _, label in ETHNICITY_GROUPS}
+    elif grouping == 16:
+        snomed = {category: label for category, _, label, _, _ in ETHNICITY_GROUPS}
+        sus = {sus_code: label for _, sus_code, label, _, _ in ETHNICITY_GROUPS}
+    else:
+        raise ValueError(f"Ethnicity grouping must be 6 or 16, not {grouping}")
+    return snomed, sus
+
+
+## This function returns the labels of the IMD bands, from most to least deprived
+def get_imd_band_labels(groups=5):
+    labels = [str(i + 1) for i in range(groups)]
+    labels[0] = "1 (most deprived)"
+    labels[-1] = f"{groups} (least deprived)"
+    return labels
+
+
+## This function recodes a series with a table of value: label, with default for values not in the table (or missing)
+def recode(series, mapping, default=None):
+    return series.map_values(mapping, default=default)
+
+
+## This function puts an integer series into equal-width bands from 0 to max_value, labelled in order by labels.
+## Band i covers int(max_value * i / n) <= value < int(max_value * (i + 1) / n), where n is the number of labels,
+## and values outside 0 to max_value (or missing) get default. The band number is found with one integer division
+## rather than a comparison for each band.
+def band_equal_width(series, max_value, labels, default=None):
+    n = len(labels)
+    band = ((series + 1) * n - 1) // max_value
+    return recode(band, dict(enumerate(labels)), default=default)
+
+
+## This function returns the smoking status from the category of the most recent smoking code, where a "never
+## smoked" code after any smoking code counts as an ex-smoker, and patients without a code are M (missing)
+## most_recent_category: category of the most recent code in the smoking_clear codelist
+## ever_smoked: whether the patient has ever had a smoking or ex-smoking code
+def get_smoking_status(most_recent_category, ever_smoked):
+    return case(
+        when((most_recent_category == "N") & ever_smoked).then("E"),
+        otherwise=recode(most_recent_category, SMOKING_STATUS, default="M"),
+    )
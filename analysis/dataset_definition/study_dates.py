@@ -0,0 +1,35 @@
+## This file loads the study dates from analysis/config.json, so the dataset definitions don't need editing when
+## the study period changes.
+## start_date / end_date: first and last day of the study period (as ISO date strings)
+## study_years: each calendar year in the study period. Variables defined for each year are suffixed with the year
+
+import argparse
+import json
+from datetime import date
+
+with open("analysis/config.json") as f:
+    study_dates = json.load(f)
+
+start_date = study_dates["start_date"]
+end_date = study_dates["end_date"]
+
+study_years = list(range(date.fromisoformat(start_date).year, date.fromisoformat(end_date).year + 1))
+
+
+## This function returns the part of a dataset definition to create, for definitions partitioned by year (see
+## partition_by_year in config.json). The part is chosen by the arguments given after -- on the ehrQL command line:
+## --year YEAR: only the variables for that year
+## --shared: only the variables which don't depend on the year
+## Returns the years to create variables for, and whether to create the variables which don't depend on the year.
+## Without either argument the whole dataset is created.
+def get_partition():
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument("--year", type=int, choices=study_years)
+    parser.add_argument("--shared", action="store_true")
+    args, _ = parser.parse_known_args()
+
+    if args.year is not None:
+        return [args.year], False
+    if args.shared:
+        return [], True
+    return study_years, True
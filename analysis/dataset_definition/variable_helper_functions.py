@@ -1,78 +1,78 @@
 from datetime import date
 
 from ehrql.tables.tpp import patients, practice_registrations, clinical_events, addresses, ethnicity_from_sus, medications, ons_deaths, apcs
-from ehrql import create_dataset, codelist_from_csv, days, case, when, minimum_of, show
-
-
-## This function creates a column for each prescription date of a medication from a given codelist
-## codelist: list of codes to search for
-## start_date: date to start searching from
-## end_date: date to stop searching
-## limit: number of prescription dates to extract
-## dataset: dataset to add the columns to
-def get_prescription_dates(dataset, start_date, end_date, codelist, column_suffix, limit):
-    prev_drug_date = start_date
-    for i in range(limit):
-        drug_date = (medications.where(medications.dmd_code.is_in(codelist))
-        .where(medications.date.is_after(prev_drug_date))
-        .where(medications.date.is_on_or_before(end_date))
-        .sort_by(medications.date)
-        .first_for_patient()
-        .date)
-        dataset.add_column(f"out_dat_{column_suffix}_{i}", drug_date)
-        prev_drug_date = drug_date
-
-
-## This function counts the frequency of gaps between prescriptions within specified time intervals
-## codelist: list of codes to search for
-## start_date: date to start searching from
-## end_date: date to stop searching
-## limit: number of prescription dates to consider
-## dataset: dataset to add the columns to
-def get_prescription_gaps(dataset, start_date, end_date ,codelist, column_suffix, limit):
-    prev_date = start_date
-    cnt_0_14 = 0
-    cnt_14_30 = 0
-    cnt_30_60 = 0
-    cnt_60_90 = 0
-    cnt_90_180 = 0
-    cnt_180_365 = 0
-    cnt_365_plus = 0
-
-    base_rx = (
-        medications.where(medications.dmd_code.is_in(codelist))
-        .where(medications.date.is_after(start_date))
-        .where(medications.date.is_on_or_before(end_date + days(365)))
-        .sort_by(medications.date)
-    )
-
-    for i in range (limit):
-        presc_date = (base_rx
-        .where(base_rx.date.is_after(prev_date))
-        .where(base_rx.date.is_not_null())
-        .first_for_patient()
-        .date)
-
-        # Don't calculate gap from start date to first prescription
-        if i>0:
-            diff_days = (presc_date - prev_date).days
-
-            cnt_0_14 +=  when(prev_date.is_on_or_before(end_date) &(diff_days < 14)).then(1).otherwise(0)
-            cnt_14_30 += when(prev_date.is_on_or_before(end_date) &(diff_days >= 14) & (diff_days < 30)).then(1).otherwise(0)
-            cnt_30_60 += when(prev_date.is_on_or_before(end_date) &(diff_days >= 30) & (diff_days < 60)).then(1).otherwise(0)
-            cnt_60_90 += when(prev_date.is_on_or_before(end_date) &(diff_days >= 60) & (diff_days < 90)).then(1).otherwise(0)
-            cnt_90_180 += when(prev_date.is_on_or_before(end_date) &(diff_days >= 90) & (diff_days < 180)).then(1).otherwise(0)
-            cnt_180_365 += when(prev_date.is_on_or_before(end_date) &(diff_days >= 180) & (diff_days < 365)).then(1).otherwise(0)
-            cnt_365_plus += when(prev_date.is_on_or_before(end_date) & (diff_days >= 365)).then(1).otherwise(0)
-        prev_date = presc_date
+from ehrql import create_dataset, codelist_from_csv, case, when, show
+from analysis.dataset_definition.recode import band_equal_width, get_ethnicity_mappings, get_imd_band_labels, recode
+
+
+## This function adds an event-level table with one row per prescription from any of the given codelists.
+## Each patient's prescriptions are extracted once, so variables such as the gaps between prescriptions can be
+## derived from the sorted dates afterwards (see analysis/dataset_derive) rather than by chaining ehrQL queries.
+## dataset: dataset to add the table to
+## start_date: date to start searching from (inclusive)
+## end_date: date to stop searching (inclusive)
+## codelists: dict of codelists keyed by medication class. A TRUE/FALSE column is added for each class
+## table_name: name of the event table, which is also the name of its output file
+def add_prescription_event_table(dataset, start_date, end_date, codelists, table_name):
+    all_codes = set().union(*codelists.values())
+
+    rx = (medications.where(medications.dmd_code.is_in(all_codes))
+        .where(medications.date.is_on_or_after(start_date))
+        .where(medications.date.is_on_or_before(end_date)))
+
+    class_columns = {name: rx.dmd_code.is_in(codelist) for name, codelist in codelists.items()}
+
+    dataset.add_event_table(table_name, date=rx.date, **class_columns)
+
+## This function adds an event-level table with one row per clinical event from a codelist, in the same way as
+## add_prescription_event_table
+## dataset: dataset to add the table to
+## start_date: date to start searching from (inclusive)
+## end_date: date to stop searching (inclusive)
+## codelist: list of SNOMED CT codes to search for
+## table_name: name of the event table, which is also the name of its output file
+def add_clinical_event_table(dataset, start_date, end_date, codelist, table_name):
+    events = (clinical_events.where(clinical_events.snomedct_code.is_in(codelist))
+        .where(clinical_events.date.is_on_or_after(start_date))
+        .where(clinical_events.date.is_on_or_before(end_date)))
+
+    dataset.add_event_table(table_name, date=events.date)
+
+## This function counts each patient's prescriptions of each medication class within a time period.
+## The prescriptions of every class are filtered once and tagged with their class, and each count is a sum over
+## the same frame, so all the classes are counted in one pass over medications rather than one pass per class.
+## start_date: date to start counting from (inclusive)
+## end_date: date to stop counting (inclusive)
+## class_by_code: dict of dm+d code: medication class, with codes in more than one class tagged with each class
+## joined by "|" (e.g. codelists.antihypertensive_class_by_code)
+## Returns a dict of medication class: number of prescriptions (0 for patients with none)
+def count_prescriptions_by_class(start_date, end_date, class_by_code):
+    rx = (medications.where(medications.dmd_code.is_in(class_by_code))
+        .where(medications.date.is_on_or_after(start_date))
+        .where(medications.date.is_on_or_before(end_date)))
+    rx_class = rx.dmd_code.to_category(class_by_code)
+
+    tags = sorted(set(class_by_code.values()))
+    class_names = list(dict.fromkeys(name for tag in tags for name in tag.split("|")))
+
+    counts = {}
+    for name in class_names:
+        class_tags = [tag for tag in tags if name in tag.split("|")]
+        counts[name] = (
+            case(when(rx_class.is_in(class_tags)).then(1), otherwise=0)
+            .sum_for_patient()
+            .when_null_then(0)
+        )
+    return counts
 
-    dataset.add_column(f"out_num_gap_0_14_{column_suffix}", cnt_0_14)
-    dataset.add_column(f"out_num_gap_14_30_{column_suffix}", cnt_14_30)
-    dataset.add_column(f"out_num_gap_30_60_{column_suffix}", cnt_30_60)
-    dataset.add_column(f"out_num_gap_60_90_{column_suffix}", cnt_60_90)
-    dataset.add_column(f"out_num_gap_90_180_{column_suffix}", cnt_90_180)
-    dataset.add_column(f"out_num_gap_180_365_{column_suffix}", cnt_180_365)
-    dataset.add_column(f"out_num_gap_365_plus_{column_suffix}", cnt_365_plus)
+## This function is TRUE if a patient has at least min_count prescriptions of any one class in counts, as returned
+## by count_prescriptions_by_class
+def has_any_class_count_at_least(counts, min_count):
+    has_count = None
+    for count in counts.values():
+        has_class_count = count >= min_count
+        has_count = has_class_count if has_count is None else has_count | has_class_count
+    return has_count
 
 ## Helper function to get the last matching clinical event before a given date
 def last_matching_event_clinical_snomed_before(codelist, start_date, where=True):
@@ -84,6 +84,20 @@ def last_matching_event_clinical_snomed_before(codelist, start_date, where=True)
         .last_for_patient()
     )
 
+## Helper function to get the date of the first matching clinical event on or before a given date. The first event
+## ever is found once and compared with the date, so calling this for several dates (e.g. the end of each study year)
+## reuses the same patient-level query instead of building one for each date. Events without a date are left out,
+## as ehrQL sorts them first
+def first_matching_event_clinical_snomed_date_on_or_before(codelist, end_date):
+    first_date = (
+        clinical_events.where(clinical_events.snomedct_code.is_in(codelist))
+        .where(clinical_events.date.is_not_null())
+        .sort_by(clinical_events.date)
+        .first_for_patient()
+        .date
+    )
+    return case(when(first_date.is_on_or_before(end_date)).then(first_date))
+
 ## Helper function to get the last matching APC admission before a given date
 def last_matching_event_apc_before(codelist, start_date, only_prim_diagnoses=False, where=True):
     query = apcs.where(where).where(apcs.admission_date.is_before(start_date))
@@ -118,78 +132,13 @@ def filter_codes_by_category(codelist, include):
     return {k:v for k,v in codelist.items() if v in include}
 
 
-## this function identifies the first date within a time period on which a patient "stops" a medication following a specified clinical event
-## defined by a specified gap size between the event and subsequent prescription. The clinical event is considered as the trigger for identifying stopping events, 
-## so the this date is treated as the date of stopping.
-## Inputs:
-## dataset - the ehrQL dataset which the variables will be added to
-## start_date - the start date for the time period 
-## end_date - the end date of the time period
-## med_codelist - the codelist for the medication for which stopping is being identified
-## event_codelist - the codelist for the clinical event after which stopping is being identified
-## column_name - the name of the column to add for the stopping date
-## limit - the maximum number of clinical events to consider when identifying stopping events, starting from the first event after the start date
-## gap_size - the number of days between prescriptions to define a stopping event
-def get_stopping_dates_after_event(dataset, start_date, end_date ,med_codelist, event_codelist, column_name, limit, gap_size):
-
-    #filter medications table to just prescriptions of interest within the date range, sorted by date
-    base_rx = (
-        medications.where(medications.dmd_code.is_in(med_codelist))
-        .where(medications.date.is_after(start_date - days(365)))
-        .where(medications.date.is_on_or_before(end_date + days(gap_size)))
-        .sort_by(medications.date)
-    )
-
-    #filter events to those of interest within the date range, sorted by date
-    events = (
-    clinical_events
-    .where(clinical_events.snomedct_code.is_in(event_codelist))
-    .where(clinical_events.date.is_on_or_between(start_date, end_date))
-    .sort_by(clinical_events.date)
-    )
-
-    stop_dates = []
-    prev_event_date = start_date
-
-    #This loop cycle through events in the date range and checks if an event preceeds a period greater than n days without a prescription, which we classify as a stopping event.
-    for i in range(limit):
-
-        # next event
-        event_date = (
-            events
-            .where(events.date.is_after(prev_event_date))
-            .first_for_patient()
-            .date)
-
-        # first prescription after event
-        first_rx_after_event = (
-            base_rx
-            .where(base_rx.date.is_on_or_after(event_date))
-            .first_for_patient()
-            .date
-        )
-
-        # calculate gap between event and first prescription after event
-        diff_days = (first_rx_after_event - event_date).days
-
-        # check if the gap spanning the event is larger than the specified size 
-        stop_date = when((event_date.is_not_null()) &
-            ((diff_days >= gap_size) | (first_rx_after_event.is_null()))
-            ).then(event_date).otherwise(None)
-
-        stop_dates = stop_dates + [stop_date]
-        prev_event_date = event_date
-
-    first_stop_after_event = minimum_of(*stop_dates)
-
-    dataset.add_column(
-        f"{column_name}",
-        first_stop_after_event
-    )
-
+## This function returns the latest ethnicity recorded in primary care, or in SUS if there is none, labelled with the
+## 6 or 16 category grouping (see ETHNICITY_GROUPS in recode.py). codelist must have the categories of the same grouping.
 def get_latest_ethnicity(
         index_date, codelist, grouping=6
     ):
+        snomed_labels, sus_labels = get_ethnicity_mappings(grouping)
+
         latest_ethnicity_from_codes_category_num = (
             clinical_events.where(clinical_events.snomedct_code.is_in(codelist))
             .where(clinical_events.date.is_on_or_before(index_date))
@@ -197,61 +146,8 @@ def get_latest_ethnicity(
             .last_for_patient()
             .snomedct_code.to_category(codelist)
         )
-
-        if grouping == 6:
-            latest_ethnicity_from_codes = case(
-                when(latest_ethnicity_from_codes_category_num == "1").then("White"),
-                when(latest_ethnicity_from_codes_category_num == "2").then("Mixed"),
-                when(latest_ethnicity_from_codes_category_num == "3").then("Asian"), # Asian or Asian British
-                when(latest_ethnicity_from_codes_category_num == "4").then("Black"), # Black or Black British
-                when(latest_ethnicity_from_codes_category_num == "5").then("Other"), # Chinese or Other Ethnic group
-            )
-
-            ethnicity_sus = case(
-                when(ethnicity_from_sus.code.is_in(["A", "B", "C"])).then("White"),
-                when(ethnicity_from_sus.code.is_in(["D", "E", "F", "G"])).then("Mixed"),
-                when(ethnicity_from_sus.code.is_in(["H", "J", "K", "L"])).then("Asian"),
-                when(ethnicity_from_sus.code.is_in(["M", "N", "P"])).then("Black"),
-                when(ethnicity_from_sus.code.is_in(["R", "S"])).then("Other"),
-            )
-        elif grouping == 16:
-            latest_ethnicity_from_codes = case(
-                when(latest_ethnicity_from_codes_category_num == "1").then("White British"),
-                when(latest_ethnicity_from_codes_category_num == "2").then("White Irish"),
-                when(latest_ethnicity_from_codes_category_num == "3").then("Other White"),
-                when(latest_ethnicity_from_codes_category_num == "4").then("White and Caribbean"),
-                when(latest_ethnicity_from_codes_category_num == "5").then("White and African"),
-                when(latest_ethnicity_from_codes_category_num == "6").then("White and Asian"),
-                when(latest_ethnicity_from_codes_category_num == "7").then("Other Mixed"),
-                when(latest_ethnicity_from_codes_category_num == "8").then("Indian"),
-                when(latest_ethnicity_from_codes_category_num == "9").then("Pakistani"),
-                when(latest_ethnicity_from_codes_category_num == "10").then("Bangladeshi"),
-                when(latest_ethnicity_from_codes_category_num == "11").then("Other Asian"),
-                when(latest_ethnicity_from_codes_category_num == "12").then("Caribbean"),
-                when(latest_ethnicity_from_codes_category_num == "13").then("African"),
-                when(latest_ethnicity_from_codes_category_num == "14").then("Other Black"),
-                when(latest_ethnicity_from_codes_category_num == "15").then("Chinese"),
-                when(latest_ethnicity_from_codes_category_num == "16").then("All other ethnic groups"),
-            )
-
-            ethnicity_sus = case(
-                when(ethnicity_from_sus.code == "A").then("White British"),
-                when(ethnicity_from_sus.code == "B").then("White Irish"),
-                when(ethnicity_from_sus.code == "C").then("Other White"),
-                when(ethnicity_from_sus.code == "D").then("White and Caribbean"),
-                when(ethnicity_from_sus.code == "E").then("White and African"),
-                when(ethnicity_from_sus.code == "F").then("White and Asian"),
-                when(ethnicity_from_sus.code == "G").then("Other Mixed"),
-                when(ethnicity_from_sus.code == "H").then("Indian"),
-                when(ethnicity_from_sus.code == "J").then("Pakistani"),
-                when(ethnicity_from_sus.code == "K").then("Bangladeshi"),
-                when(ethnicity_from_sus.code == "L").then("Other Asian"),
-                when(ethnicity_from_sus.code == "M").then("Caribbean"),
-                when(ethnicity_from_sus.code == "N").then("African"),
-                when(ethnicity_from_sus.code == "P").then("Other Black"),
-                when(ethnicity_from_sus.code == "R").then("Chinese"),
-                when(ethnicity_from_sus.code == "S").then("All other ethnic groups"),
-            )
+        latest_ethnicity_from_codes = recode(latest_ethnicity_from_codes_category_num, snomed_labels)
+        ethnicity_sus = recode(ethnicity_from_sus.code, sus_labels)
 
         ethnicity_combined = case(
             when(latest_ethnicity_from_codes.is_not_null()).then(
@@ -265,29 +161,17 @@ def get_latest_ethnicity(
 
         return ethnicity_combined
 
-def get_imd(index_date, groups=5, max_imd=32844):
-    step = max_imd / groups
-    whens = []
-
-    imd = addresses.for_patient_on(index_date).imd_rounded
+## These functions return each patient's address and practice registration on a date, with one row per patient.
+## Every variable on that date (IMD, care home status, region...) reads its columns from this row. ehrQL compares
+## queries by value, so the lookups for the same date are the same query and are only run once.
+def get_address_on(index_date):
+    return addresses.for_patient_on(index_date)
 
-    for i in range(groups):
-        lower = int(step * i)
-        upper = int(step * (i + 1))
+def get_registration_on(index_date):
+    return practice_registrations.for_patient_on(index_date)
 
-        if i == 0:
-            label = "1 (most deprived)"
-        elif i == groups - 1:
-            label = f"{groups} (least deprived)"
-        else:
-            label = str(i + 1)
-
-        condition = (imd >= lower) & (imd < upper)
-        whens.append(when(condition).then(label))
-
-    imd_grouped=case(
-        *whens,
-        otherwise="unknown",
-    )
-
-    return imd_grouped
+## This function returns each patient's IMD band on a date, in groups of equal width from 1 (most deprived) to groups
+## (least deprived), or "unknown" if there is no IMD
+def get_imd(index_date, groups=5, max_imd=32844):
+    imd = get_address_on(index_date).imd_rounded
+    return band_equal_width(imd, max_imd, get_imd_band_labels(groups), default="unknown")
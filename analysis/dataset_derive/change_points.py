@@ -0,0 +1,266 @@
+## This file contains functions for storing time-varying covariates as change points rather than a column for each
+## year. A dataset with a column for each covariate in each year (e.g. cov_cat_region_2017, cov_cat_region_2018, ...)
+## is stored as one row per patient, covariate and date on which the value changed: (patient_id, covariate,
+## valid_from, value), where valid_from is the index date (1 January) of the year the value was first seen. Most
+## covariates (sex, region, care home status, IMD band, ...) rarely change, so the rows grow with the number of
+## changes rather than the number of years. A change to a missing value is kept as a row with no value.
+## Values are stored as text, and the type of each covariate in the dataset (including the levels of factors, and
+## whether they are ordered) is stored in the metadata of the Arrow file, so looked up values have the same type as
+## the dataset they came from. Covariates without a stored type are given the type of their name (see dataset_io.py).
+## The value of a covariate on any date is the value of the last change point on or before the date, which is found
+## for many patients and dates at once with a binary search (get_values_as_of).
+## With --check, the value of every covariate on each index date is looked up from the change points written, and
+## compared with the dataset.
+## Run from the root of the repository to store the cleaned cov dataset as change points, e.g.
+##   python analysis/dataset_derive/change_points.py output/dataset_clean/input_clean_cov.arrow output/dataset_clean/cov_change_points.arrow --check
+
+import argparse
+import json
+import sys
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from dataset_io import get_column_type, read_dataset
+from episodes import to_days
+from patient_years import split_year_columns
+
+# The study years are those of the dataset definitions (see study_dates.py)
+sys.path.insert(0, ".")
+from analysis.dataset_definition.study_dates import study_years
+
+
+## This function converts the values of a column to text, with missing values kept as missing
+def to_text(values):
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.dt.strftime("%Y-%m-%d").astype("string")
+    return values.astype(object).where(values.notna()).astype("string")
+
+
+## This function returns the type of a covariate from its name, for covariates without a stored type
+def get_dtype_from_name(covariate):
+    return {
+        "bin": pd.BooleanDtype(),
+        "num": np.dtype("float64"),
+        "dat": np.dtype("datetime64[ns]"),
+        "cat": pd.CategoricalDtype(),
+    }.get(get_column_type(covariate), pd.StringDtype())
+
+
+## This function converts text values back to a type. TRUE/FALSE values are read whatever their case, as they are
+## written as "True"/"False" from booleans and as "TRUE"/"FALSE" from the factors made by clean_dataset.py
+def from_text(values, dtype):
+    if isinstance(dtype, pd.CategoricalDtype):
+        return pd.Series(pd.Categorical(values, dtype=dtype), index=values.index)
+    if pd.api.types.is_bool_dtype(dtype):
+        return values.str.upper().map({"TRUE": True, "FALSE": False}).astype("boolean")
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return pd.to_datetime(values)
+    if pd.api.types.is_integer_dtype(dtype):
+        # Integers with missing values need a nullable type
+        return pd.to_numeric(values).astype(dtype if isinstance(dtype, pd.api.extensions.ExtensionDtype) else "Int64")
+    if pd.api.types.is_numeric_dtype(dtype):
+        return pd.to_numeric(values).astype(dtype)
+    return values
+
+
+## This function returns the type of each covariate with a year suffix in a dataset, from the columns of its years.
+## The levels of a factor are the levels of every year's column, in the order they are first found. Columns of Python
+## objects (e.g. dates read from an Arrow file) are given the type of their name. Integer and TRUE/FALSE columns are
+## given a nullable type whether or not they have missing values, as that is the type they are looked up as
+def get_covariate_dtypes(dataset, years):
+    year_columns, _ = split_year_columns(dataset.columns, years)
+    dtypes = {}
+    for covariate, columns in year_columns.items():
+        column_dtypes = [dataset[columns[year]].dtype for year in years if year in columns]
+        if all(isinstance(dtype, pd.CategoricalDtype) for dtype in column_dtypes):
+            levels = list(dict.fromkeys(level for dtype in column_dtypes for level in dtype.categories))
+            dtypes[covariate] = pd.CategoricalDtype(levels, ordered=column_dtypes[0].ordered)
+        elif column_dtypes[0] == object:
+            dtypes[covariate] = get_dtype_from_name(covariate)
+        elif all(pd.api.types.is_integer_dtype(dtype) for dtype in column_dtypes):
+            dtypes[covariate] = pd.Int64Dtype()
+        elif all(pd.api.types.is_bool_dtype(dtype) for dtype in column_dtypes):
+            dtypes[covariate] = pd.BooleanDtype()
+        else:
+            dtypes[covariate] = column_dtypes[0]
+    return dtypes
+
+
+## This function returns the change points of every covariate with a year suffix in a dataset
+## dataset: data frame with one row per patient and a column for each covariate in each year
+## years: the years of the study, in order
+## Returns a data frame with patient_id, covariate, valid_from and value columns, sorted by patient, covariate and
+## date. Columns without a year suffix aren't included.
+def to_change_points(dataset, years):
+    year_columns, _ = split_year_columns(dataset.columns, years)
+    change_points = []
+    for covariate, columns in year_columns.items():
+        previous = None
+        for year in [year for year in years if year in columns]:
+            values = to_text(dataset[columns[year]])
+            if previous is None:
+                changed = values.notna()
+            else:
+                changed = (values != previous).fillna(values.isna() != previous.isna())
+            change_points.append(pd.DataFrame({
+                "patient_id": dataset["patient_id"][changed].to_numpy(),
+                "covariate": covariate,
+                "valid_from": pd.Timestamp(date(year, 1, 1)),
+                "value": values[changed].to_numpy(),
+            }))
+            previous = values
+
+    if not change_points:
+        return pd.DataFrame(columns=["patient_id", "covariate", "valid_from", "value"])
+    return (
+        pd.concat(change_points, ignore_index=True)
+        .sort_values(["patient_id", "covariate", "valid_from"], kind="stable", ignore_index=True)
+    )
+
+
+## This function returns the value of a covariate for each patient on each date: the value of the patient's last
+## change point on or before the date, which is missing if there is none
+## patient_ids, dates: the patients and dates to look up, of the same length
+## dtype: the type of the covariate (see get_covariate_dtypes). By default, the type of its name
+def get_values_as_of(change_points, covariate, patient_ids, dates, dtype=None):
+    points = change_points[change_points["covariate"] == covariate]
+    patients = pd.Index(points["patient_id"].unique())
+    point_days, _ = to_days(points["valid_from"])
+    query_days, has_date = to_days(dates)
+    origin = min(point_days.min(initial=0), query_days.min(initial=0))
+
+    # Keys combine the patient and the date, so one sorted array holds every patient's change points
+    span = max(point_days.max(initial=0), query_days.max(initial=0)) - origin + 1
+    point_keys = patients.get_indexer(points["patient_id"]).astype(np.int64) * span + (point_days - origin)
+    order = np.argsort(point_keys, kind="stable")
+    point_keys = point_keys[order]
+    point_values = points["value"].to_numpy()[order]
+
+    query_patients = patients.get_indexer(np.asarray(patient_ids))
+    query_keys = query_patients.astype(np.int64) * span + (query_days - origin)
+    positions = np.searchsorted(point_keys, query_keys, side="right") - 1
+
+    # A change point only applies if it is the same patient's
+    found = (query_patients >= 0) & has_date & (positions >= 0)
+    found[found] &= point_keys[positions[found]] // span == query_patients[found]
+    values = pd.Series(pd.NA, index=range(len(query_keys)), dtype="string")
+    values[found] = point_values[positions[found]]
+    return from_text(values, get_dtype_from_name(covariate) if dtype is None else dtype)
+
+
+## This function returns the value of every covariate for each patient and date, as a data frame with patient_id,
+## date and a column for each covariate
+## dtypes: dict of covariate: type (see get_covariate_dtypes). Covariates not in it are given the type of their name
+def as_of_join(change_points, patient_ids, dates, dtypes=None):
+    dtypes = dtypes or {}
+    result = pd.DataFrame({"patient_id": np.asarray(patient_ids), "date": pd.to_datetime(np.asarray(dates))})
+    for covariate in change_points["covariate"].unique():
+        values = get_values_as_of(
+            change_points, covariate, result["patient_id"], result["date"], dtypes.get(covariate)
+        )
+        result[covariate] = values.array
+    return result
+
+
+## This function converts the types of covariates to and from JSON, to store in the metadata of an Arrow file
+def dtypes_to_json(dtypes):
+    return json.dumps({
+        covariate: {"categories": [str(level) for level in dtype.categories], "ordered": bool(dtype.ordered)}
+        if isinstance(dtype, pd.CategoricalDtype) else {"dtype": str(dtype)}
+        for covariate, dtype in dtypes.items()
+    })
+
+
+def dtypes_from_json(text):
+    return {
+        covariate: pd.CategoricalDtype(dtype["categories"], ordered=dtype["ordered"])
+        if "categories" in dtype else pd.api.types.pandas_dtype(dtype["dtype"])
+        for covariate, dtype in json.loads(text).items()
+    }
+
+
+## This function writes change points to an Arrow file, with the type of each covariate in its metadata
+def write_change_points(change_points, dtypes, path):
+    table = pa.table({
+        "patient_id": pa.array(change_points["patient_id"], type=pa.int64()),
+        "covariate": pa.array(change_points["covariate"], type=pa.string()).dictionary_encode(),
+        "valid_from": pa.array(pd.to_datetime(change_points["valid_from"]).dt.date, type=pa.date32()),
+        "value": pa.array(change_points["value"], type=pa.string(), from_pandas=True),
+    })
+    table = table.replace_schema_metadata({"dtypes": dtypes_to_json(dtypes)})
+    feather.write_feather(table, path, compression="zstd")
+
+
+## This function reads change points from an Arrow file, returning them and the type of each covariate
+def read_change_points(path):
+    table = feather.read_table(path)
+    metadata = table.schema.metadata or {}
+    dtypes = dtypes_from_json(metadata[b"dtypes"]) if b"dtypes" in metadata else {}
+    change_points = table.to_pandas(date_as_object=False)
+    change_points["covariate"] = change_points["covariate"].astype(str)
+    return change_points, dtypes
+
+
+## This function returns whether values looked up from change points are the values of a column of a dataset. Factors
+## must have the same values and be ordered in the same way, as their levels are those of every year. Other columns
+## are compared in the type they are looked up as (e.g. integers without missing values as nullable integers)
+def is_same_values(found, expected, dtype):
+    if isinstance(expected.dtype, pd.CategoricalDtype):
+        return (
+            isinstance(found.dtype, pd.CategoricalDtype)
+            and found.cat.ordered == expected.cat.ordered
+            and found.astype(object).equals(expected.astype(object))
+        )
+    if expected.dtype != dtype:
+        expected = from_text(to_text(expected), dtype)
+    return found.dtype == expected.dtype and found.equals(expected)
+
+
+## This function looks up the value of every covariate on the index date of each year, and returns the columns of the
+## dataset whose values differ from those looked up
+def check_round_trip(dataset, years, change_points, dtypes):
+    year_columns, _ = split_year_columns(dataset.columns, years)
+    mismatches = []
+    for year in years:
+        values = as_of_join(change_points, dataset["patient_id"], [date(year, 1, 1)] * len(dataset), dtypes)
+        for covariate, columns in year_columns.items():
+            if year not in columns:
+                continue
+            expected = dataset[columns[year]].reset_index(drop=True)
+            if covariate not in values:
+                if expected.notna().any():
+                    mismatches.append(columns[year])
+                continue
+            if not is_same_values(values[covariate], expected, dtypes[covariate]):
+                mismatches.append(columns[year])
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Store the covariates of a dataset with a column for each year as change points")
+    parser.add_argument("input", help="path of the dataset")
+    parser.add_argument("output", help="path to write the change points to")
+    parser.add_argument("--check", action="store_true", help="check the change points give back the values of the dataset")
+    args = parser.parse_args()
+
+    years = study_years
+    dataset = read_dataset(args.input)
+    change_points = to_change_points(dataset, years)
+    dtypes = get_covariate_dtypes(dataset, years)
+    write_change_points(change_points, dtypes, args.output)
+    print(f"{len(change_points)} change points for {change_points['covariate'].nunique()} covariates")
+
+    if args.check:
+        change_points, dtypes = read_change_points(args.output)
+        mismatches = check_round_trip(dataset, years, change_points, dtypes)
+        if mismatches:
+            sys.exit(f"Values looked up from the change points differ from the dataset: {', '.join(mismatches)}")
+        print("Every value looked up from the change points matches the dataset")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+## This script cleans a dataset generated by a dataset definition a chunk of rows at a time, applying the same rules
+## as the R cleaning functions in analysis/dataset_clean: quality assurance (fn-qa.R), inclusion and exclusion
+## criteria (fn-inex.R), and handling missing values and setting reference levels (fn-ref.R). Each chunk is written
+## to the output as soon as it is cleaned, so memory use depends on the chunk size rather than the size of the
+## dataset. The dataset is read twice: first for the values of the categorical columns, so that every chunk is
+## written with the same factor levels, then to clean it. analysis/dev_tools/check_clean_parity.py compares the
+## results with those of the R scripts.
+## The flow chart counts and the descriptions of the data (output/describe/) are added up over the chunks.
+## With --pack-eligibility, the eligibility columns of each study year (inex_bin_all_YEAR) are replaced by one integer
+## column, inex_num_years (see eligibility.py).
+## The output is a typed Arrow file, or a CSV if the output path ends in .csv or .csv.gz.
+## Run from the root of the repository, e.g.
+##   python analysis/dataset_derive/clean_dataset.py output/dataset/input_desc.arrow output/dataset_clean/input_clean_desc.arrow --suffix desc --pack-eligibility
+##   python analysis/dataset_derive/clean_dataset.py output/dataset/input_prematch.csv.gz output/dataset_clean/input_clean_prematch.csv.gz --suffix prematch --qa --inex --flow output/dataset_clean/flow_prematch.csv --population output/dataset_clean/population_prematch.arrow
+
+import argparse
+import sys
+from collections import Counter
+from datetime import date
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.ipc as ipc
+
+from dataset_io import ChunkWriter, get_column_type, roundmid_any
+from eligibility import pack_eligibility
+
+# The study years are those of the dataset definitions (see study_dates.py)
+sys.path.insert(0, ".")
+from analysis.dataset_definition.study_dates import study_years
+
+CHUNK_SIZE = 100_000
+
+## Levels of the categorical variables handled by fn-ref.R. Values outside these are recoded as missing
+REGIONS = [
+    "East",
+    "East Midlands",
+    "London",
+    "North East",
+    "North West",
+    "South East",
+    "South West",
+    "West Midlands",
+    "Yorkshire and The Humber",
+]
+ETHNICITIES = [
+    # 6 category labels
+    "White", "Mixed", "Asian", "Black", "Other",
+    # 16 category labels
+    "Other White", "White and African", "All other ethnic groups", "African", "White Irish", "Other Mixed",
+    "White British", "Caribbean", "Other Black", "White and Caribbean", "Other Asian", "Chinese", "Pakistani",
+    "White and Asian", "Indian", "Bangladeshi",
+]
+SEXES = {"female": "Female", "male": "Male"}
+SMOKING_STATUSES = {"N": "Never smoker", "E": "Ever smoker", "S": "Current smoker", "M": "Missing"}
+
+
+## This function reads a dataset a chunk of rows at a time, as data frames with the column types given by the
+## column names (see dataset_io.py). Arrow files are memory-mapped, and CSVs are read in chunks.
+## columns: names of the columns to read. By default every column is read
+def read_chunks(path, chunk_size=CHUNK_SIZE, columns=None):
+    if str(path).endswith((".arrow", ".feather")):
+        reader = ipc.open_file(pa.memory_map(str(path)))
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            if columns is not None:
+                batch = batch.select(columns)
+            for start in range(0, batch.num_rows, chunk_size):
+                yield batch.slice(start, chunk_size).to_pandas(date_as_object=False)
+    else:
+        for chunk in pd.read_csv(path, chunksize=chunk_size, usecols=columns, dtype=str, keep_default_na=False,
+                                 na_values=[""]):
+            yield parse_csv_chunk(chunk)
+
+
+## This function converts the text columns of a chunk of a CSV to the types given by their names, as load_data does
+def parse_csv_chunk(chunk):
+    for name in chunk.columns:
+        column_type = get_column_type(name)
+        if name == "patient_id":
+            chunk[name] = pd.to_numeric(chunk[name]).astype("Int64")
+        elif column_type == "cat":
+            chunk[name] = chunk[name].astype("string")
+        elif column_type == "bin":
+            chunk[name] = chunk[name].str.upper().map({"T": True, "TRUE": True, "F": False, "FALSE": False})
+        elif column_type == "num" or name.endswith("_birth_year"):
+            chunk[name] = pd.to_numeric(chunk[name])
+        elif column_type == "dat":
+            chunk[name] = pd.to_datetime(chunk[name])
+    return chunk
+
+
+## This function returns the names of the categorical columns which fn-ref.R turns into factors
+def get_factor_columns(columns):
+    return [name for name in columns if "_cat_" in name]
+
+
+## This function returns the factor levels of a categorical column, and whether they are ordered, from the values
+## found in the dataset, in the same way as fn-ref.R
+def get_levels(name, values):
+    values = {value for value in values if isinstance(value, str)}
+    if name == "cov_cat_sex":
+        return list(SEXES.values()), False
+    if name == "cov_cat_imd":
+        return get_imd_levels(values), True
+    if name == "cov_cat_region":
+        return REGIONS, True
+    if name == "cov_cat_smoking":
+        return ["Never smoker", "Ever smoker", "Current smoker", "Missing"], True
+    if name == "cov_cat_ethnicity":
+        levels = sorted({value if value in ETHNICITIES else "Missing" for value in values})
+        ref = "White British" if "White British" in levels else "White"
+        if ref in levels:
+            levels = [ref] + [level for level in levels if level != ref]
+        return levels, False
+    return sorted(values), False
+
+
+## This function returns the levels of the IMD bands, from the number of the least deprived band in the values. As
+## in fn-ref.R (seq(2, imd_max)), the levels include the number of the least deprived band on its own (e.g. "5" as
+## well as "5 (least deprived)"), which no value has
+def get_imd_levels(values):
+    bands = [int(value.split(" ")[0]) for value in values if value.split(" ")[0].isdigit()]
+    imd_max = max(bands, default=1)
+    return ["1 (most deprived)", *[str(i) for i in range(2, imd_max + 1)], f"{imd_max} (least deprived)"]
+
+
+## This function recodes a categorical column as fn-ref.R does, before it is given its levels. Values which aren't
+## one of the levels are missing
+def recode_categorical(name, values, levels):
+    if name == "cov_cat_sex":
+        if not values.isin(list(SEXES)).all():
+            raise ValueError("cov_cat_sex contains missing values.")
+        values = values.map(SEXES)
+    elif name == "cov_cat_ethnicity":
+        values = values.where(values.isin(ETHNICITIES), "Missing")
+    elif name == "cov_cat_smoking":
+        values = values.where(values.isin(["E", "N", "S"]), "M").map(SMOKING_STATUSES)
+    return values.astype(object).where(values.isin(levels))
+
+
+## This function handles missing values and sets the reference levels of a chunk (see fn-ref.R)
+## levels: dict of column name: (levels, ordered) for each categorical column
+def ref(chunk, levels):
+    for name in chunk.columns:
+        if "_bin_" in name:
+            values = chunk[name].fillna(False).astype(bool)
+            if name.startswith("cov_bin_"):
+                values = pd.Categorical(values.map({False: "FALSE", True: "TRUE"}), categories=["FALSE", "TRUE"])
+            chunk[name] = values
+        elif name in levels:
+            column_levels, ordered = levels[name]
+            chunk[name] = pd.Categorical(
+                recode_categorical(name, chunk[name], column_levels),
+                categories=column_levels,
+                ordered=ordered,
+            )
+    return chunk
+
+
+## This function applies the quality assurance rules to a chunk (see fn-qa.R), adding the number of rows kept by each
+## rule to flow
+def qa(chunk, flow):
+    this_year = date.today().year
+    chunk = chunk[chunk["patient_id"].notna()]
+    flow["Quality assurance: Removed records with missing patient id"] += len(chunk)
+    chunk = chunk[chunk["qa_num_birth_year"].notna() & (chunk["qa_num_birth_year"] < this_year)]
+    flow["Quality assurance: Year of birth must be in the past"] += len(chunk)
+    chunk = chunk[chunk["qa_num_death_year"].isna() | (chunk["qa_num_death_year"] < this_year)]
+    flow["Quality assurance: Year of death must be in the past"] += len(chunk)
+    return chunk
+
+
+## This function applies the inclusion and exclusion criteria to a chunk (see fn-inex.R), adding the number of rows
+## kept by each criterion to flow, and drops the inex variables
+def inex(chunk, flow):
+    for name in [name for name in chunk.columns if "inex_bin" in name]:
+        chunk = chunk[chunk[name] == True]
+        flow[f"Inclusion criteria: {name}"] += len(chunk)
+    return chunk.drop(columns=[name for name in chunk.columns if name.startswith("inex")])
+
+
+## This function adds a chunk to the running description of a dataset: the number of rows, and for each column the
+## number of missing values and either the frequency of each value or the range of the values
+def describe_chunk(description, chunk):
+    description["n_rows"] = description.get("n_rows", 0) + len(chunk)
+    columns = description.setdefault("columns", {})
+    for name in chunk.columns:
+        values = chunk[name]
+        column = columns.setdefault(name, {"type": str(values.dtype), "n_missing": 0})
+        column["n_missing"] += int(values.isna().sum())
+        values = values.dropna()
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values) and name != "patient_id":
+            column["sum"] = column.get("sum", 0) + float(values.sum())
+            column["n"] = column.get("n", 0) + len(values)
+        if (pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values)) or \
+                pd.api.types.is_datetime64_any_dtype(values):
+            if len(values):
+                column["min"] = min(column.get("min", values.min()), values.min())
+                column["max"] = max(column.get("max", values.max()), values.max())
+        else:
+            column.setdefault("counts", Counter()).update(values.astype(str).value_counts().to_dict())
+
+
+## This function writes the description of a dataset to output/describe/{name}.txt
+def write_description(description, name):
+    lines = [f"Number of rows: {description.get('n_rows', 0)}", ""]
+    for column_name, column in description.get("columns", {}).items():
+        lines.append(f"{column_name} ({column['type']}): {column['n_missing']} missing")
+        if column.get("n"):
+            lines.append(f"  mean: {column['sum'] / column['n']:.4g}")
+        if "min" in column:
+            lines.append(f"  min: {column['min']}  max: {column['max']}")
+        for value, count in sorted(column.get("counts", {}).items()):
+            lines.append(f"  {value}: {count}")
+    path = Path("output/describe") / f"{name}.txt"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("\n".join(lines) + "\n")
+    print(f"{path} written successfully.")
+
+
+## This function writes the flow chart counts, and the rounded counts to a file ending in _midpoint6
+def write_flow(flow, path):
+    flow = pd.DataFrame({"Description": list(flow), "N": list(flow.values())})
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    flow.to_csv(path, index=False)
+    flow.assign(N=flow["N"].map(roundmid_any)).to_csv(
+        path.with_name(f"{path.stem}_midpoint6{path.suffix}"), index=False
+    )
+
+
+## This function writes the eligible population (patient IDs, sorted, and birth years) as read by
+## analysis/dataset_definition/population.py
+def write_population(patient_ids, birth_years, path):
+    patient_ids = np.concatenate(patient_ids) if patient_ids else np.array([], dtype=np.int64)
+    birth_years = np.concatenate(birth_years) if birth_years else np.array([], dtype=np.int64)
+    order = np.argsort(patient_ids, kind="stable")
+    table = pa.table(
+        {"patient_id": patient_ids[order], "qa_num_birth_year": birth_years[order]},
+        schema=pa.schema([("patient_id", pa.int64()), ("qa_num_birth_year", pa.int64())]),
+    )
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    feather.write_feather(table, str(path), compression="uncompressed")
+
+
+## This function cleans a dataset, returning the flow chart counts
+def clean_dataset(input_path, output_path, suffix="", apply_qa=False, apply_inex=False, population_path=None,
+                  chunk_size=CHUNK_SIZE, pack_years=False):
+    describe_suffix = f"-{suffix}" if suffix else ""
+
+    # First pass: the values of the categorical columns, to set their levels
+    print("Get factor levels")
+    columns = next(read_chunks(input_path, chunk_size=1)).columns
+    factor_columns = get_factor_columns(columns)
+    values = {name: set() for name in factor_columns}
+    if factor_columns:
+        for chunk in read_chunks(input_path, chunk_size, columns=factor_columns):
+            for name in factor_columns:
+                values[name].update(chunk[name].dropna().unique())
+    levels = {name: get_levels(name, values[name]) for name in factor_columns}
+
+    # Second pass: clean and write each chunk
+    print("Clean dataset")
+    flow = Counter()
+    flow["Input"] = 0
+    descriptions = {stage: {} for stage in ["preprocessed", "qa", "inex", "ref"]}
+    patient_ids = []
+    birth_years = []
+    writer = ChunkWriter(output_path)
+    try:
+        for chunk in read_chunks(input_path, chunk_size):
+            flow["Input"] += len(chunk)
+            describe_chunk(descriptions["preprocessed"], chunk)
+            if apply_qa:
+                chunk = qa(chunk, flow)
+                describe_chunk(descriptions["qa"], chunk)
+            if apply_inex:
+                chunk = inex(chunk, flow)
+                describe_chunk(descriptions["inex"], chunk)
+            if pack_years:
+                chunk = pack_eligibility(chunk, study_years)
+            chunk = ref(chunk.copy(), levels)
+            describe_chunk(descriptions["ref"], chunk)
+            if population_path is not None:
+                patient_ids.append(chunk["patient_id"].to_numpy(dtype=np.int64))
+                birth_years.append(chunk["qa_num_birth_year"].to_numpy(dtype=np.int64))
+            writer.write(chunk)
+    finally:
+        writer.close()
+
+    for stage, description in descriptions.items():
+        if description:
+            write_description(description, f"{stage}{describe_suffix}")
+    if population_path is not None:
+        print("Saving eligible population")
+        write_population(patient_ids, birth_years, population_path)
+
+    return flow
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clean a generated dataset a chunk of rows at a time")
+    parser.add_argument("input", help="path of the generated dataset (.arrow or .csv.gz)")
+    parser.add_argument("output", help="path to write the cleaned dataset to (.arrow or .csv.gz)")
+    parser.add_argument("--suffix", default="", help="suffix of the describe output files, e.g. desc")
+    parser.add_argument("--qa", action="store_true", help="apply the quality assurance rules")
+    parser.add_argument("--inex", action="store_true", help="apply the inclusion and exclusion criteria")
+    parser.add_argument("--flow", help="path to write the flow chart counts to")
+    parser.add_argument("--population", help="path to write the eligible population to")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="number of rows to clean at a time")
+    parser.add_argument("--pack-eligibility", action="store_true", help="store the eligibility in each year as one integer")
+    args = parser.parse_args()
+
+    flow = clean_dataset(
+        args.input, args.output, args.suffix, args.qa, args.inex, args.population, args.chunk_size,
+        args.pack_eligibility
+    )
+    if args.flow:
+        write_flow(flow, args.flow)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+## This file contains functions for reading and writing the datasets passed between the pipeline stages as typed
+## Arrow files. Column types follow the naming convention of the dataset definitions:
+## - *_cat*: categorical (dictionary-encoded text)
+## - *_bin*: TRUE/FALSE
+## - *_num*: numeric (integer if every value is a whole number)
+## - *_dat*: date
+## Reading only the columns a script needs avoids loading the whole of a wide dataset.
+## It also contains the helpers shared by the scripts which write datasets and counts: ChunkWriter, for writing a
+## dataset a chunk of rows at a time, and roundmid_any, for rounding the counts which are released.
+
+import gzip
+import math
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as csv
+import pyarrow.feather as feather
+import pyarrow.ipc as ipc
+
+# Type of each column name pattern, checked in this order
+COLUMN_TYPES = [("_cat", "cat"), ("_bin", "bin"), ("_num", "num"), ("_dat", "dat")]
+
+
+## This function returns the type of a column from its name, or None if the name doesn't follow the convention
+def get_column_type(column_name):
+    for pattern, column_type in COLUMN_TYPES:
+        if pattern in column_name:
+            return column_type
+    return None
+
+
+## This function reads a dataset from an Arrow file (or a CSV, for datasets which haven't been converted)
+## path: path of the dataset
+## columns: names of the columns to read. By default every column is read
+def read_dataset(path, columns=None):
+    if str(path).endswith((".arrow", ".feather")):
+        return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+    return pd.read_csv(path, usecols=columns)
+
+
+## This function converts a column to the Arrow type given by its name
+def to_arrow_column(column_name, values):
+    column_type = get_column_type(column_name)
+    if column_name == "patient_id":
+        return pa.array(values, type=pa.int64())
+    if column_type == "cat":
+        return pa.array(values.astype("string"), from_pandas=True).dictionary_encode()
+    if column_type == "bin":
+        return pa.array(values.astype("boolean"), from_pandas=True)
+    if column_type == "num":
+        values = pd.to_numeric(values)
+        is_whole = values.dropna().mod(1).eq(0).all()
+        return pa.array(values.astype("Int64") if is_whole else values, from_pandas=True)
+    if column_type == "dat":
+        return pa.array(pd.to_datetime(values).dt.date, type=pa.date32(), from_pandas=True)
+    return pa.array(values, from_pandas=True)
+
+
+## This function writes a dataset to an Arrow file, with each column converted to the type given by its name
+def write_dataset(dataset, path):
+    table = pa.table({name: to_arrow_column(name, dataset[name]) for name in dataset.columns})
+    feather.write_feather(table, path, compression="zstd")
+
+
+## This class writes a dataset a chunk of rows at a time to an Arrow file, or to a CSV if the path ends in .csv or
+## .csv.gz, so the whole dataset is never held in memory
+class ChunkWriter:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.is_csv = self.path.name.endswith((".csv", ".csv.gz"))
+        self.schema = None
+        self.sink = None
+        self.writer = None
+
+    def write(self, chunk):
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        # Dates are read as timestamps, and are written as dates
+        table = pa.table({
+            name: column.cast(pa.date32()) if pa.types.is_timestamp(column.type) else column
+            for name, column in zip(table.column_names, table.columns)
+        })
+        if self.is_csv:
+            table = pa.table({
+                name: column.cast(pa.string()) if pa.types.is_dictionary(column.type) else column
+                for name, column in zip(table.column_names, table.columns)
+            })
+        if self.writer is None:
+            self.schema = table.schema.remove_metadata()
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if self.is_csv:
+                self.sink = gzip.open(self.path, "wb") if self.path.suffix == ".gz" else open(self.path, "wb")
+                self.writer = csv.CSVWriter(self.sink, self.schema)
+            else:
+                options = ipc.IpcWriteOptions(compression="zstd")
+                self.writer = ipc.new_file(str(self.path), self.schema, options=options)
+        self.writer.write_table(table.cast(self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+
+## This function rounds a count to the midpoint of groups of 6, for counts which are released (roundmid_any in
+## utility.R)
+def roundmid_any(x, to=6):
+    return math.ceil(x / to) * to - (to // 2) * (x != 0)
@@ -0,0 +1,83 @@
+## This script derives the stopping date variables for the descriptive dataset.
+## For each year of the study, medication class and gap size, it finds the date of the first medication review
+## which was followed by a gap of at least that many days before the next prescription of the class, using the
+## event-level tables extracted by generate_medication_events. The dates are added to the patient-level dataset,
+## which is then cleaned by the clean_dataset_desc action. The gap sizes are set by stop_gap_sizes in config.json.
+## The number of days from each medication review to the next prescription of each class is also saved
+## (desc_med_rev_gaps.arrow), so that stopping can be compared across any gap sizes without extracting the data again:
+## see stopping_dates.py.
+
+import json
+import os
+import sys
+from datetime import date, timedelta
+
+import pandas as pd
+
+from dataset_io import read_dataset, write_dataset
+from episodes import build_prescription_history
+from medication_events import MEDICATION_CLASSES, load_medication_reviews, load_prescriptions, sort_event_dates
+from stopping_dates import get_days_to_next_prescription, get_stopping_dates, select_events
+
+# The study years are those of the dataset definitions (see study_dates.py)
+sys.path.insert(0, ".")
+from analysis.dataset_definition.study_dates import study_years
+
+# Different gap sizes defining stopping events. Other gap sizes can be compared afterwards from the days to the
+# next prescription saved in desc_med_rev_gaps.arrow (see stopping_dates.py)
+# Maximum number of medication reviews considered in each year
+limit = 10
+
+#Get study dates
+with open("analysis/config.json") as f:
+    study_dates = json.load(f)
+gap_sizes = study_dates.get("stop_gap_sizes", [30, 90, 180])
+# Prescriptions are extracted until a year after the end of the study (see dataset_definition_medication_events.py)
+prescriptions_end = pd.Timestamp(study_dates["end_date"]) + pd.Timedelta(days=365)
+
+## Load datasets
+print("Load dataset")
+dataset = read_dataset("output/dataset_desc/dataset.arrow")
+prescriptions = load_prescriptions()
+medication_reviews = sort_event_dates(load_medication_reviews())
+
+## Find the first stopping date after a medication review for each year, medication class and gap size
+## The prescription history of each class is built once and used for every year
+histories = {
+    medication_class: build_prescription_history(sort_event_dates(prescriptions[prescriptions[medication_class] == True]))
+    for medication_class in MEDICATION_CLASSES
+}
+
+## For each medication review, the days to the next prescription of each class and the days of prescriptions
+## observed after it, which are saved so that other gap sizes can be compared without extracting the data again
+stop_dates = []
+event_gaps = []
+for year in study_years:
+    events = select_events(medication_reviews, date(year, 1, 1), date(year, 1, 1) + timedelta(days=365), limit)
+    events = events.assign(year=year, desc_num_days_observed=(prescriptions_end - events["date"]).dt.days)
+
+    for medication_class in MEDICATION_CLASSES:
+        print(f"Finding stopping dates: {medication_class} {year}")
+        days_to_next = get_days_to_next_prescription(histories[medication_class], events)
+        events[f"desc_num_days_to_rx_{medication_class}"] = days_to_next
+        stop_dates.append(
+            get_stopping_dates(
+                events,
+                days_to_next,
+                gap_sizes,
+                f"desc_dat_stop_{medication_class}",
+                year,
+                events["desc_num_days_observed"]
+            )
+        )
+    event_gaps.append(events.rename(columns={"date": "desc_dat_med_rev"}))
+
+## Add dates to the dataset. Patients without a stopping event have no date
+stop_dates = pd.concat(stop_dates, axis=1).reindex(dataset["patient_id"])
+dataset = pd.concat([dataset, stop_dates.reset_index(drop=True)], axis=1)
+
+## Save dataset
+print("Saving dataset")
+os.makedirs("output/dataset", exist_ok=True)
+write_dataset(dataset, "output/dataset/input_desc.arrow")
+write_dataset(pd.concat(event_gaps, ignore_index=True), "output/dataset/desc_med_rev_gaps.arrow")
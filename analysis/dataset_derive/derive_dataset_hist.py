@@ -0,0 +1,56 @@
+## This script derives the prescription gap variables for the histogram dataset.
+## generate_medication_events extracts each patient's antihypertensive prescriptions as an event-level table,
+## which is used here to count the gaps between prescriptions of each medication class in each year of the
+## study. The counts are added to the patient-level dataset, which is then cleaned by clean_dataset.py
+
+import json
+import os
+import sys
+from datetime import date
+
+import pandas as pd
+
+from dataset_io import read_dataset, write_dataset
+from episodes import build_prescription_history
+from medication_events import MEDICATION_CLASSES, load_prescriptions, sort_event_dates
+from prescription_gaps import GAP_BIN_EDGES, count_prescription_gaps
+
+# The study years are those of the dataset definitions (see study_dates.py)
+sys.path.insert(0, ".")
+from analysis.dataset_definition.study_dates import study_years
+
+#Get study dates and gap bins
+with open("analysis/config.json") as f:
+    study_dates = json.load(f)
+bin_edges = study_dates.get("gap_bin_edges", GAP_BIN_EDGES)
+
+## Load datasets
+print("Load dataset")
+dataset = read_dataset("output/dataset_hist/dataset.arrow")
+prescriptions = load_prescriptions()
+
+## Count gaps between prescriptions for each medication class and year
+gap_counts = []
+for medication_class in MEDICATION_CLASSES:
+    print(f"Counting prescription gaps: {medication_class}")
+    history = build_prescription_history(sort_event_dates(prescriptions[prescriptions[medication_class] == True]))
+
+    for year in study_years:
+        gap_counts.append(
+            count_prescription_gaps(
+                history,
+                date(year, 1, 1),
+                date(year, 12, 31),
+                f"{medication_class}_{year}",
+                bin_edges
+            )
+        )
+
+## Add counts to the dataset. Patients without prescriptions have no gaps
+gap_counts = pd.concat(gap_counts, axis=1).reindex(dataset["patient_id"]).fillna(0).astype(int)
+dataset = pd.concat([dataset, gap_counts.reset_index(drop=True)], axis=1)
+
+## Save dataset
+print("Saving dataset")
+os.makedirs("output/dataset", exist_ok=True)
+write_dataset(dataset, "output/dataset/input_hist.arrow")
@@ -0,0 +1,57 @@
+## This file contains functions for storing whether each patient is eligible in each year of the study as one integer
+## per patient (inex_num_years), rather than a column for each year (inex_bin_all_2017, inex_bin_all_2018, ...).
+## Bit i of the integer is set if the patient is eligible in the i-th year of the study, counting from the first year
+## of the study period in config.json, so a longer study period doesn't add columns. Eligibility is stored for up to
+## 62 years. The same questions can be asked in R with the inex_* functions in analysis/utility.R.
+## The functions work on whole columns at once with bit operations.
+
+import numpy as np
+import pandas as pd
+
+ELIGIBLE_YEARS = "inex_num_years"
+ELIGIBLE_PREFIX = "inex_bin_all_"
+
+
+## This function replaces the eligibility column of each year of a data frame with one integer column, in the
+## position of the first. Missing eligibility counts as not eligible. Data frames without eligibility columns are
+## returned unchanged
+## years: the years of the study, in order
+def pack_eligibility(frame, years):
+    columns = [(i, f"{ELIGIBLE_PREFIX}{year}") for i, year in enumerate(years) if f"{ELIGIBLE_PREFIX}{year}" in frame]
+    if not columns:
+        return frame
+    mask = np.zeros(len(frame), dtype=np.int64)
+    for i, name in columns:
+        mask |= frame[name].fillna(False).to_numpy(dtype=bool).astype(np.int64) << i
+    position = frame.columns.get_loc(columns[0][1])
+    frame = frame.drop(columns=[name for _, name in columns])
+    frame.insert(position, ELIGIBLE_YEARS, mask)
+    return frame
+
+
+## This function returns whether each patient is eligible in a year (or in the year on each row, if year is a column)
+## first_year: the first year of the study
+def is_eligible_in(mask, year, first_year):
+    shift = np.asarray(year, dtype=np.int64) - first_year
+    return ((np.asarray(mask, dtype=np.int64) >> shift) & 1) == 1
+
+
+## This function returns whether each patient is eligible in any year of the study
+def is_eligible_in_any(mask):
+    return np.asarray(mask, dtype=np.int64) != 0
+
+
+## This function returns whether each patient is eligible in every one of the n_years years of the study
+def is_eligible_in_all(mask, n_years):
+    return np.asarray(mask, dtype=np.int64) == (1 << n_years) - 1
+
+
+## This function returns the first year each patient is eligible in, which is missing for patients never eligible.
+## The lowest set bit is isolated with mask & -mask, and its position found with log2
+def get_first_eligible_year(mask, first_year):
+    mask = np.asarray(mask, dtype=np.int64)
+    lowest_bit = mask & -mask
+    years = first_year + np.log2(np.where(lowest_bit > 0, lowest_bit, 1)).astype(np.int64)
+    first_years = pd.array(years, dtype="Int64")
+    first_years[mask == 0] = pd.NA
+    return first_years
@@ -0,0 +1,237 @@
+## This file contains functions for storing each patient's prescriptions of a medication as sorted arrays, and for
+## combining them into exposure episodes. An episode is a run of prescriptions in which each prescription is
+## followed by the next within a gap tolerance (gap_days), so a gap of at least gap_days ends an episode, which is
+## the same definition of stopping used by stopping_dates.py.
+## A prescription history is built once per medication and holds every patient's prescriptions in compressed
+## sparse row form: the dates of the i-th patient in patient_ids are rx_dates[rx_offsets[i]:rx_offsets[i + 1]].
+## Episodes for a gap tolerance are built from the history when first needed and kept in it. Looking up the
+## prescription or episode around a date (for many patients and dates at once) is a binary search over keys
+## combining the patient and the date, so it takes O(log n) time rather than a scan of the prescriptions.
+## Dates are stored as whole days since 1970-01-01.
+
+import numpy as np
+import pandas as pd
+
+
+## This function converts dates (a Series, array, or single date) to whole days since 1970-01-01. Missing dates
+## are returned as 0, with has_date set to FALSE
+def to_days(dates):
+    dates = np.asarray(pd.to_datetime(dates), dtype="datetime64[D]")
+    has_date = ~np.isnat(dates)
+    days = np.where(has_date, dates, np.datetime64(0, "D")).astype(np.int64)
+    return days, has_date
+
+
+## This function converts whole days since 1970-01-01 to dates, with missing dates where exists is FALSE
+def from_days(days, exists):
+    dates = days.astype("datetime64[D]").astype("datetime64[ns]")
+    dates[~exists] = np.datetime64("NaT")
+    return pd.Series(dates)
+
+
+## This function builds the prescription history of a medication
+## prescription_dates: distinct prescription dates, sorted by patient and date (see sort_event_dates in
+## medication_events.py)
+def build_prescription_history(prescription_dates):
+    patient_id = prescription_dates["patient_id"].to_numpy()
+    rx_dates, _ = to_days(prescription_dates["date"])
+
+    patient_ids, first_rows = np.unique(patient_id, return_index=True)
+    rx_offsets = np.append(first_rows, len(patient_id))
+    rx_patients = np.repeat(np.arange(len(patient_ids)), np.diff(rx_offsets))
+
+    # Keys are patient index * span + days since the first date + 1, leaving room for dates before and after
+    # every prescription, so sorting by key sorts by patient and then date
+    origin = rx_dates.min() if len(rx_dates) else 0
+    span = (rx_dates.max() - origin + 3) if len(rx_dates) else 3
+
+    history = {
+        "patient_ids": patient_ids,
+        "rx_offsets": rx_offsets,
+        "rx_dates": rx_dates,
+        "origin": origin,
+        "span": span,
+        "episodes": {},
+        "gap_bins": {},
+    }
+    history["rx_keys"] = get_keys(history, rx_patients, rx_dates)
+    return history
+
+
+## This function returns the keys for the given patient indices and dates. Dates outside the history are moved
+## to just before or after every prescription, which doesn't change the result of a search
+def get_keys(history, patient_index, days):
+    offset = np.clip(days - history["origin"] + 1, 0, history["span"] - 1)
+    return patient_index * history["span"] + offset
+
+
+## This function returns whether a history has no prescriptions, e.g. for a medication no patient was prescribed
+def is_empty(history):
+    return len(history["patient_ids"]) == 0
+
+
+## This function returns the index of each patient in the history, and whether the patient has any prescriptions
+def find_patients(history, patient_ids):
+    patient_ids = np.asarray(patient_ids)
+    if is_empty(history):
+        return np.zeros(len(patient_ids), dtype=np.int64), np.zeros(len(patient_ids), dtype=bool)
+    index = np.searchsorted(history["patient_ids"], patient_ids)
+    index = np.minimum(index, len(history["patient_ids"]) - 1)
+    found = history["patient_ids"][index] == patient_ids
+    return index, found
+
+
+## This function returns the date of each patient's first prescription after each date
+## patient_ids, dates: the patients and dates to look up, of the same length
+## inclusive: whether a prescription on the date itself counts
+## Returns a Series of dates, which are missing if there is no later prescription
+def get_next_prescription_dates(history, patient_ids, dates, inclusive=True):
+    index, found = find_patients(history, patient_ids)
+    days, has_date = to_days(dates)
+    if is_empty(history):
+        return from_days(days, found)
+
+    side = "left" if inclusive else "right"
+    position = np.searchsorted(history["rx_keys"], get_keys(history, index, days), side=side)
+    exists = found & has_date & (position < history["rx_offsets"][index + 1])
+
+    position = np.minimum(position, max(len(history["rx_dates"]) - 1, 0))
+    return from_days(history["rx_dates"][position], exists)
+
+
+## This function returns the date of each patient's last prescription before each date, in the same way as
+## get_next_prescription_dates
+def get_previous_prescription_dates(history, patient_ids, dates, inclusive=False):
+    index, found = find_patients(history, patient_ids)
+    days, has_date = to_days(dates)
+    if is_empty(history):
+        return from_days(days, found)
+
+    side = "right" if inclusive else "left"
+    position = np.searchsorted(history["rx_keys"], get_keys(history, index, days), side=side) - 1
+    exists = found & has_date & (position >= history["rx_offsets"][index])
+
+    position = np.maximum(position, 0)
+    return from_days(history["rx_dates"][position], exists)
+
+
+## This function returns the episodes of the history for a gap tolerance, building them the first time.
+## Each episode has the dates of its first and last prescriptions, and the patient is treated as taking the
+## medication from the first prescription until gap_days after the last one
+def get_episodes(history, gap_days):
+    if gap_days in history["episodes"]:
+        return history["episodes"][gap_days]
+
+    rx_dates = history["rx_dates"]
+    rx_offsets = history["rx_offsets"]
+
+    # A prescription starts an episode if it is the patient's first, or comes at least gap_days after the previous one
+    is_start = np.zeros(len(rx_dates), dtype=bool)
+    is_start[1:] = np.diff(rx_dates) >= gap_days
+    is_start[rx_offsets[:-1]] = True
+    first_rx = np.flatnonzero(is_start)
+    last_rx = np.append(first_rx, len(rx_dates))[1:] - 1
+
+    episode_patients = np.repeat(np.arange(len(history["patient_ids"])), np.diff(rx_offsets))[first_rx]
+    episodes = {
+        "offsets": np.searchsorted(episode_patients, np.arange(len(history["patient_ids"]) + 1)),
+        "start": rx_dates[first_rx],
+        "end": rx_dates[last_rx],
+        "n_prescriptions": last_rx - first_rx + 1,
+        "start_keys": history["rx_keys"][first_rx],
+        "end_keys": history["rx_keys"][last_rx],
+    }
+    history["episodes"][gap_days] = episodes
+    return episodes
+
+
+## This function returns whether each patient was taking the medication on each date, i.e. whether the date is
+## on or after the first prescription of an episode and less than gap_days after its last prescription
+def is_on_drug(history, patient_ids, dates, gap_days):
+    episodes = get_episodes(history, gap_days)
+    index, found = find_patients(history, patient_ids)
+    days, has_date = to_days(dates)
+    if is_empty(history):
+        return found
+
+    # The last episode starting on or before the date
+    position = np.searchsorted(episodes["start_keys"], get_keys(history, index, days), side="right") - 1
+    in_patient = found & has_date & (position >= episodes["offsets"][index])
+    position = np.maximum(position, 0)
+
+    return in_patient & (days < episodes["end"][position] + gap_days)
+
+
+## This function returns the date of the last prescription of the first episode ending on or after each date, which
+## is the episode the patient is taking the medication in on the date, or else the next episode. The patient stops
+## taking the medication gap_days after this date.
+## Returns a Series of dates, which are missing if no episode ends on or after the date
+def get_episode_end_dates_after(history, patient_ids, dates, gap_days):
+    episodes = get_episodes(history, gap_days)
+    index, found = find_patients(history, patient_ids)
+    days, has_date = to_days(dates)
+    if is_empty(history):
+        return from_days(days, found)
+
+    position = np.searchsorted(episodes["end_keys"], get_keys(history, index, days), side="left")
+    exists = found & has_date & (position < episodes["offsets"][index + 1])
+
+    position = np.minimum(position, max(len(episodes["end"]) - 1, 0))
+    return from_days(episodes["end"][position], exists)
+
+
+## This function returns, for each gap bin, the positions of the prescriptions followed by a gap in that bin.
+## The bin of each gap is found once per set of bin edges and kept in the history.
+## bin_edges: edges (in days) of the gap bins. Each bin covers [edge, next edge), the first bin also includes
+## anything shorter and the last bin is open ended
+def get_gap_bins(history, bin_edges):
+    bin_edges = tuple(bin_edges)
+    if bin_edges in history["gap_bins"]:
+        return history["gap_bins"][bin_edges]
+
+    rx_dates = history["rx_dates"]
+    gap_days = np.diff(rx_dates)
+    bins = np.clip(np.searchsorted(bin_edges, gap_days, side="right") - 1, 0, len(bin_edges) - 1)
+
+    # The last prescription of each patient isn't followed by a gap
+    is_gap = np.ones(len(gap_days), dtype=bool)
+    is_gap[history["rx_offsets"][1:-1] - 1] = False
+
+    gap_bins = {
+        "bins": np.append(np.where(is_gap, bins, -1), -1),
+        "positions": [np.flatnonzero(is_gap & (bins == i)) for i in range(len(bin_edges))],
+    }
+    history["gap_bins"][bin_edges] = gap_bins
+    return gap_bins
+
+
+## This function counts each patient's gaps between consecutive prescriptions in each gap bin. A gap is counted
+## when the earlier prescription is after start_date and on or before end_date, and the later prescription is no
+## more than follow_up_days after end_date.
+## Returns an array with a row for each patient in the history (in the order of patient_ids) and a column for each
+## gap bin
+def count_gaps(history, start_date, end_date, bin_edges, follow_up_days):
+    gap_bins = get_gap_bins(history, bin_edges)
+    rx_dates = history["rx_dates"]
+    patient_index = np.arange(len(history["patient_ids"]))
+    start_days, _ = to_days(start_date)
+    end_days, _ = to_days(end_date)
+
+    # Each patient's prescriptions in the period are rx_dates[first:stop]
+    first = np.searchsorted(history["rx_keys"], get_keys(history, patient_index, start_days), side="right")
+    stop = np.searchsorted(history["rx_keys"], get_keys(history, patient_index, end_days), side="right")
+
+    counts = np.column_stack([
+        np.searchsorted(positions, stop) - np.searchsorted(positions, first)
+        for positions in gap_bins["positions"]
+    ]).reshape(len(patient_index), len(bin_edges))
+
+    # Only the gap after a patient's last prescription in the period can end too late to be counted
+    last = stop - 1
+    has_last = stop > first
+    last_bin = gap_bins["bins"][np.maximum(last, 0)]
+    next_date = rx_dates[np.minimum(stop, max(len(rx_dates) - 1, 0))]
+    too_late = has_last & (last_bin >= 0) & (next_date > end_days + follow_up_days)
+    np.subtract.at(counts, (patient_index[too_late], last_bin[too_late]), 1)
+
+    return counts
@@ -0,0 +1,74 @@
+## This file contains functions for loading the event-level tables extracted by
+## dataset_definition_medication_events.py, which the medication-derived variables and the eligibility on any
+## index date (rolling_eligibility.py) are calculated from.
+
+import pandas as pd
+
+from dataset_io import read_dataset
+
+MEDICATION_EVENTS_DIR = "output/medication_events"
+
+# Medication classes, matching the suffixes of the class columns in the prescriptions table
+MEDICATION_CLASSES = ["acei", "aab", "arb", "bb", "ccb", "caa", "psd"]
+
+
+## This function loads the dates of the prescriptions of the given medication classes, with one row per
+## prescription and a TRUE/FALSE column for each class
+def load_prescriptions(medication_classes=MEDICATION_CLASSES, events_dir=MEDICATION_EVENTS_DIR):
+    prescriptions = read_dataset(
+        f"{events_dir}/prescriptions.arrow",
+        columns=["patient_id", "date", *medication_classes]
+    )
+    prescriptions["date"] = pd.to_datetime(prescriptions["date"])
+    return prescriptions
+
+
+## This function loads the medication reviews table, with one row per medication review
+def load_medication_reviews(events_dir=MEDICATION_EVENTS_DIR):
+    medication_reviews = read_dataset(f"{events_dir}/medication_reviews.arrow", columns=["patient_id", "date"])
+    medication_reviews["date"] = pd.to_datetime(medication_reviews["date"])
+    return medication_reviews
+
+
+## This function loads the practice registrations table, with one row per registration. Registrations which haven't
+## ended have no end date
+def load_registrations(events_dir=MEDICATION_EVENTS_DIR):
+    registrations = read_dataset(
+        f"{events_dir}/registrations.arrow",
+        columns=["patient_id", "start_date", "end_date", "practice_pseudo_id", "region"]
+    )
+    registrations["start_date"] = pd.to_datetime(registrations["start_date"])
+    registrations["end_date"] = pd.to_datetime(registrations["end_date"])
+    return registrations
+
+
+## This function loads the addresses table, with one row per address. Addresses which haven't ended have no end date
+def load_addresses(events_dir=MEDICATION_EVENTS_DIR):
+    addresses = read_dataset(
+        f"{events_dir}/addresses.arrow",
+        columns=["patient_id", "start_date", "end_date", "address_id", "has_postcode", "has_imd"]
+    )
+    addresses["start_date"] = pd.to_datetime(addresses["start_date"])
+    addresses["end_date"] = pd.to_datetime(addresses["end_date"])
+    # for_patient_on sorts addresses with a postcode after those without
+    addresses["has_postcode"] = addresses["has_postcode"].eq(True).astype(int)
+    return addresses
+
+
+## This function loads the patient-level dates used by the eligibility criteria, with one row per patient
+def load_patient_dates(events_dir=MEDICATION_EVENTS_DIR):
+    patient_dates = read_dataset(f"{events_dir}/dataset.arrow")
+    for name in ["inex_dat_birth", "inex_dat_death", "inex_dat_death_ons", "inex_dat_dem"]:
+        patient_dates[name] = pd.to_datetime(patient_dates[name])
+    return patient_dates
+
+
+## This function returns the distinct event dates for each patient, sorted by patient and date
+## events: data frame with one row per event, with patient_id and date columns
+def sort_event_dates(events):
+    return (
+        events[["patient_id", "date"]]
+        .dropna()
+        .drop_duplicates()
+        .sort_values(["patient_id", "date"], ignore_index=True)
+    )
@@ -0,0 +1,152 @@
+## This script joins the partitions of a dataset generated by year (see partition_by_year in config.json) into
+## one dataset, matching rows on patient_id.
+## The partitions are read one record batch at a time and the merged dataset is written a block of patients at a
+## time, so memory use depends on the block and batch sizes rather than the size of the dataset. Only patient_id
+## and the dictionaries of the categorical columns are read from every batch up front: the patient_ids to match
+## the rows of the partitions, and the dictionaries so that each categorical column is written with one dictionary
+## made from all of its values.
+## Columns are written in the order of the partitions given, without repeating patient_id.
+## Run from the root of the repository, e.g.
+##   python analysis/dataset_derive/merge_partitions.py output/dataset_desc/dataset.arrow output/dataset_desc/partitions/dataset_shared.arrow output/dataset_desc/partitions/dataset_2017.arrow ...
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+
+BLOCK_SIZE = 100_000
+
+
+## This function returns an array of dictionary values as indices into a given dictionary
+def to_dictionary(array, dictionary, ordered=False):
+    indices = pc.take(pc.index_in(array.dictionary, value_set=dictionary), array.indices)
+    return pa.DictionaryArray.from_arrays(indices, dictionary, ordered=ordered)
+
+
+## Reader for a partition, which reads the record batches holding the rows asked for. The batches read for the
+## last block of rows are kept, as the next block usually starts in the last of them.
+class PartitionReader:
+    def __init__(self, path):
+        self.path = str(path)
+        self.reader = ipc.open_file(pa.memory_map(self.path))
+        self.schema = self.reader.schema
+        self.batches = {}
+
+        # Read patient_id and the categorical columns from each batch, for the rows of each batch and the values
+        # of every dictionary
+        dictionary_names = [field.name for field in self.schema if pa.types.is_dictionary(field.type)]
+        names = ["patient_id", *dictionary_names]
+        options = ipc.IpcReadOptions(included_fields=[self.schema.get_field_index(name) for name in names])
+        header_reader = ipc.open_file(pa.memory_map(self.path), options=options)
+        patient_ids = []
+        dictionaries = {name: [] for name in dictionary_names}
+        for i in range(header_reader.num_record_batches):
+            batch = header_reader.get_batch(i)
+            patient_ids.append(batch.column("patient_id").to_numpy())
+            for name in dictionary_names:
+                dictionaries[name].append(batch.column(name).dictionary)
+        self.patient_ids = np.concatenate(patient_ids) if patient_ids else np.array([], dtype=np.int64)
+        self.batch_starts = np.cumsum([0] + [len(ids) for ids in patient_ids])
+        self.dictionaries = {
+            name: pc.unique(pa.chunked_array(values, type=self.schema.field(name).type.value_type))
+            for name, values in dictionaries.items()
+        }
+
+    ## The fields of the merged dataset for the columns of this partition, other than patient_id. Categorical
+    ## columns are written with 32-bit indices into their one dictionary
+    def get_fields(self):
+        fields = []
+        for field in self.schema:
+            if field.name == "patient_id":
+                continue
+            if pa.types.is_dictionary(field.type):
+                field = field.with_type(pa.dictionary(pa.int32(), field.type.value_type, field.type.ordered))
+            fields.append(field)
+        return fields
+
+    def get_batch(self, number):
+        if number not in self.batches:
+            self.batches[number] = self.reader.get_batch(number)
+        return self.batches[number]
+
+    ## This function returns the columns of the partition, other than patient_id, for the given rows. Rows of -1
+    ## are patients missing from the partition, which get null values
+    def read_rows(self, rows):
+        found = rows >= 0
+        batch_numbers = np.searchsorted(self.batch_starts, rows, side="right") - 1
+        needed = np.unique(batch_numbers[found])
+        batches = {number: self.get_batch(number) for number in needed}
+        self.batches = batches
+
+        # Positions of the rows in the batches read, once they are joined
+        starts = np.cumsum([0] + [batches[number].num_rows for number in needed])
+        positions = np.zeros(len(rows), dtype=np.int64)
+        if found.any():
+            batch_positions = np.searchsorted(needed, batch_numbers[found])
+            positions[found] = rows[found] - self.batch_starts[batch_numbers[found]] + starts[batch_positions]
+        table = pa.Table.from_batches(list(batches.values()), schema=self.schema)
+        block = table.take(pa.array(positions, mask=~found))
+
+        columns = []
+        for field in self.get_fields():
+            column = block.column(field.name).combine_chunks()
+            if pa.types.is_dictionary(field.type):
+                column = to_dictionary(column, self.dictionaries[field.name], field.type.ordered)
+            columns.append(column)
+        return columns
+
+
+## This function returns the row of each partition which matches each patient in the first partition. Partitions
+## of the same dataset normally list the patients in the same order, in which case the rows are those of the
+## first partition. Patients missing from a partition are given a row of -1.
+def get_row_indices(partitions):
+    patient_ids = partitions[0].patient_ids
+    row_indices = []
+    for partition in partitions:
+        if len(partition.patient_ids) == len(patient_ids) and (partition.patient_ids == patient_ids).all():
+            row_indices.append(np.arange(len(patient_ids)))
+        else:
+            row_indices.append(pd.Index(partition.patient_ids).get_indexer(patient_ids))
+    return patient_ids, row_indices
+
+
+## This function writes the merged dataset a block of patients at a time
+def merge_partitions(output_path, partition_paths, block_size=BLOCK_SIZE):
+    partitions = [PartitionReader(path) for path in partition_paths]
+    patient_ids, row_indices = get_row_indices(partitions)
+
+    fields = [partitions[0].schema.field("patient_id")]
+    for partition in partitions:
+        fields.extend(partition.get_fields())
+    names = [field.name for field in fields]
+    if len(set(names)) != len(names):
+        raise ValueError("Partitions contain the same column more than once")
+    schema = pa.schema(fields)
+
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    options = ipc.IpcWriteOptions(compression="zstd")
+    with ipc.new_file(str(output_path), schema, options=options) as writer:
+        for start in range(0, len(patient_ids), block_size):
+            stop = min(start + block_size, len(patient_ids))
+            columns = [pa.array(patient_ids[start:stop], type=schema.field("patient_id").type)]
+            for partition, rows in zip(partitions, row_indices):
+                columns.extend(partition.read_rows(rows[start:stop]))
+            writer.write_batch(pa.record_batch(columns, schema=schema))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Join the partitions of a dataset on patient_id")
+    parser.add_argument("output", help="path to write the merged dataset to")
+    parser.add_argument("partitions", nargs="+", help="paths of the partitions, in the order of their columns")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE, help="number of patients to write at a time")
+    args = parser.parse_args()
+
+    merge_partitions(args.output, args.partitions, args.block_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+## This file contains functions for reshaping a dataset with a column for each variable in each year of the study
+## (e.g. inex_bin_all_2017, inex_bin_all_2018, ...) into one row per patient per year, with a year column and one
+## column for each variable (e.g. inex_bin_all). Columns without a year suffix are repeated on each of a
+## patient's rows. If the eligibility in each year is stored as one integer (inex_num_years, see eligibility.py),
+## inex_bin_all is the eligibility in the year of each row.
+## Only the output is reshaped: ehrQL datasets have one row per patient, so the dataset definitions still define
+## each variable once per year, and their queries still grow with the number of years.
+## Run from the root of the repository to reshape a dataset file, e.g.
+##   python analysis/dataset_derive/patient_years.py output/dataset_clean/input_clean_desc.arrow output/dataset_clean/input_clean_desc_long.arrow
+
+import re
+import sys
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from eligibility import ELIGIBLE_YEARS, is_eligible_in
+
+# The study years are those of the dataset definitions (see study_dates.py)
+sys.path.insert(0, ".")
+from analysis.dataset_definition.study_dates import study_years
+
+# Name of a variable followed by a year, with or without an underscore between them (e.g. desc_cat_region2017)
+YEAR_SUFFIX = re.compile(r"^(.*?)_?(\d{4})$")
+
+
+## This function splits the columns of a dataset into those with a year suffix, as a dict of variable name:
+## {year: column name}, and the remaining columns
+def split_year_columns(columns, years):
+    year_columns = {}
+    other_columns = []
+    for column in columns:
+        match = YEAR_SUFFIX.match(column)
+        if match and int(match.group(2)) in years:
+            year_columns.setdefault(match.group(1), {})[int(match.group(2))] = column
+        else:
+            other_columns.append(column)
+    return year_columns, other_columns
+
+
+## This function reshapes a dataset to one row per patient per year
+## dataset: data frame with one row per patient
+## years: years to reshape. Variables missing for a year are empty on that year's rows
+## Returns a data frame of the columns without a year suffix, then year, then each variable
+def to_patient_years(dataset, years):
+    year_columns, other_columns = split_year_columns(dataset.columns, years)
+
+    # Categorical variables get the categories of every year, in order, so the years can be stacked without
+    # losing the order of the categories
+    categories = {}
+    for variable, columns in year_columns.items():
+        values = [dataset[column] for column in columns.values()]
+        if all(isinstance(value.dtype, pd.CategoricalDtype) for value in values):
+            categories[variable] = pd.api.types.union_categoricals(values, ignore_order=True).categories
+
+    year_frames = []
+    for year in years:
+        year_frame = dataset[other_columns].copy()
+        year_frame["year"] = year
+        for variable, columns in year_columns.items():
+            if year in columns:
+                values = dataset[columns[year]]
+            else:
+                values = pd.Series(None, index=dataset.index, dtype="category" if variable in categories else object)
+            if variable in categories:
+                values = values.cat.set_categories(categories[variable])
+            year_frame[variable] = values
+        year_frames.append(year_frame)
+
+    patient_years = pd.concat(year_frames, ignore_index=True)
+    if ELIGIBLE_YEARS in patient_years:
+        patient_years["inex_bin_all"] = is_eligible_in(
+            patient_years[ELIGIBLE_YEARS], patient_years["year"], study_years[0]
+        )
+    return patient_years
+
+
+if __name__ == "__main__":
+    input_path, output_path = sys.argv[1:3]
+    dataset = feather.read_table(input_path).to_pandas()
+    patient_years = to_patient_years(dataset, study_years)
+    table = pa.Table.from_pandas(patient_years, preserve_index=False).replace_schema_metadata(None)
+    feather.write_feather(table, output_path, compression="zstd")
@@ -0,0 +1,40 @@
+## This file contains functions for counting the gaps between consecutive prescriptions of a medication.
+## All patients are handled together, using the prescription history of the medication (see episodes.py): the gap
+## from each prescription to the next is binned once, and each patient's gaps in a period are counted with a binary
+## search, so there is no limit on the number of prescriptions considered per patient.
+
+import pandas as pd
+
+from episodes import count_gaps
+
+## Default edges (in days) of the gap bins. Each bin covers [edge, next edge), the first bin also includes
+## anything shorter and the last bin is open ended, giving the bins 0_14, 14_30, ..., 180_365 and 365_plus
+GAP_BIN_EDGES = [0, 14, 30, 60, 90, 180, 365]
+
+
+## This function returns the label used in the column name for each gap bin
+## bin_edges: edges (in days) of the gap bins
+def get_gap_bin_labels(bin_edges=GAP_BIN_EDGES):
+    labels = [f"{lower}_{upper}" for lower, upper in zip(bin_edges[:-1], bin_edges[1:])]
+    return labels + [f"{bin_edges[-1]}_plus"]
+
+
+## This function counts the frequency of gaps between consecutive prescriptions within each gap bin.
+## A gap is counted when the earlier prescription is after start_date and on or before end_date. The later
+## prescription can be up to follow_up_days after end_date.
+## history: prescription history of the medication (see build_prescription_history in episodes.py)
+## start_date: date to start searching from
+## end_date: date to stop searching
+## column_suffix: suffix added to the out_num_gap_* column names
+## bin_edges: edges (in days) of the gap bins
+## follow_up_days: number of days after end_date in which to look for the prescription ending a gap
+## Returns a data frame indexed by patient_id with one column per gap bin. Patients without any prescriptions are
+## not included, so missing counts should be treated as 0.
+def count_prescription_gaps(history, start_date, end_date, column_suffix,
+                            bin_edges=GAP_BIN_EDGES, follow_up_days=365):
+    labels = get_gap_bin_labels(bin_edges)
+    return pd.DataFrame(
+        count_gaps(history, start_date, end_date, bin_edges, follow_up_days),
+        index=pd.Index(history["patient_ids"], name="patient_id"),
+        columns=[f"out_num_gap_{label}_{column_suffix}" for label in labels],
+    )
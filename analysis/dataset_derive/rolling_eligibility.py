@@ -0,0 +1,218 @@
+## This script finds the patients who meet the eligibility criteria of add_inex_variables on each of a series of index
+## dates (e.g. the first of every month of the study), from the tables extracted once by
+## dataset_definition_medication_events.py, rather than building the ehrQL queries again for every index date.
+## The criteria evaluated on each index date are:
+## - inex_bin_has_dem: a dementia diagnosis on or before the index date
+## - inex_bin_antihyp: at least 3 prescriptions of any one antihypertensive class in the 365 days up to the index date
+## - inex_bin_alive: no date of death (primary care or ONS) on or before the index date
+## - inex_bin_over_64: aged 65 or over on the index date
+## - inex_bin_6m_reg: a registration spanning the 180 days up to the index date
+## - inex_bin_known_sex: sex recorded as male or female
+## - inex_bin_known_imd: an IMD for the address on the index date
+## - inex_bin_known_region: a region for the practice registration on the index date
+## The address and registration on the index date are those ehrQL's for_patient_on picks: the last of the rows spanning
+## the index date, in the order for_patient_on sorts them. Each table is sorted once, in that order within each patient.
+## Each patient's prescriptions of each class are sorted once, by a key combining the patient and the date, and the
+## number in the window before an index date is the difference between two binary searches, so every patient is
+## evaluated on an index date in one vectorised step and the index dates are evaluated one after another. The cost
+## grows with the number of index dates only through these searches, not by building and running the queries again.
+## Outputs:
+## - the patients eligible on each index date (patient_id, inex_dat_index), written an index date at a time
+## - with --counts, the number of patients meeting each criterion on each index date, and a _midpoint6 version. The
+##   number meeting all of them is inex_bin_all
+## Run from the root of the repository, e.g.
+##   python analysis/dataset_derive/rolling_eligibility.py output/dataset/eligibility_monthly.arrow --frequency MS --counts output/tables/eligibility_monthly.csv
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataset_io import ChunkWriter, roundmid_any
+from episodes import to_days
+from medication_events import (
+    MEDICATION_CLASSES,
+    load_addresses,
+    load_patient_dates,
+    load_prescriptions,
+    load_registrations,
+)
+
+ANTIHYPERTENSIVE_WINDOW_DAYS = 365
+ANTIHYPERTENSIVE_MIN_COUNT = 3
+REGISTRATION_DAYS = 180
+# The columns for_patient_on sorts registrations and addresses by, before picking the last row spanning the date
+REGISTRATION_SORT = ["start_date", "end_date", "practice_pseudo_id"]
+ADDRESS_SORT = ["has_postcode", "start_date", "end_date", "address_id"]
+# Dates are stored in the low bits of a key, after the index of the patient
+DATE_BITS = 20
+
+
+## This function returns the index dates from the start to the end of the study
+## frequency: a pandas offset alias, e.g. "MS" for the first of each month or "YS" for the first of each year
+def get_index_dates(start_date, end_date, frequency):
+    return pd.date_range(start_date, end_date, freq=frequency)
+
+
+## This function returns keys combining the index of each patient and a date, which sort by patient then date
+def get_keys(patient_index, days, origin):
+    return (np.asarray(patient_index, dtype=np.int64) << DATE_BITS) + (np.asarray(days, dtype=np.int64) - origin)
+
+
+## This function sorts the prescriptions of each medication class by patient and date, as keys
+## patient_ids: the patients to evaluate, in order. Prescriptions of other patients are dropped
+def build_prescription_keys(prescriptions, patient_ids, origin):
+    patient_index = pd.Index(patient_ids).get_indexer(prescriptions["patient_id"])
+    days, has_date = to_days(prescriptions["date"])
+    keep = (patient_index >= 0) & has_date
+    return {
+        medication_class: np.sort(get_keys(
+            patient_index[keep & (prescriptions[medication_class] == True).to_numpy()],
+            days[keep & (prescriptions[medication_class] == True).to_numpy()],
+            origin
+        ))
+        for medication_class in MEDICATION_CLASSES
+    }
+
+
+## This function counts each patient's prescriptions in a sorted array of keys from first_day to last_day (inclusive)
+def count_in_window(keys, patient_index, first_day, last_day, origin):
+    upper = np.searchsorted(keys, get_keys(patient_index, last_day, origin), side="right")
+    lower = np.searchsorted(keys, get_keys(patient_index, first_day, origin), side="left")
+    return upper - lower
+
+
+## This function returns the age of each patient in whole years on a date, from dates as yyyymmdd numbers
+def get_age_on(birth_dates, index_date):
+    index_number = index_date.year * 10_000 + index_date.month * 100 + index_date.day
+    birth_numbers = birth_dates.dt.year * 10_000 + birth_dates.dt.month * 100 + birth_dates.dt.day
+    return (index_number - birth_numbers.to_numpy(dtype=float, na_value=np.nan)) // 10_000
+
+
+## This function returns whether each patient has a registration spanning the days up to an index date, i.e. starting
+## on or before the first day and not ending on or before the index date
+def has_registration_spanning(registrations, n_patients, index_date, days):
+    first_date = index_date - pd.Timedelta(days=days)
+    spanning = (registrations["start_date"] <= first_date).to_numpy() & (
+        registrations["end_date"].isna() | (registrations["end_date"] > index_date)
+    ).to_numpy()
+    registered = np.zeros(n_patients, dtype=bool)
+    registered[registrations["patient_index"].to_numpy()[spanning]] = True
+    return registered
+
+
+## This function sorts the registrations or addresses of each patient in the order for_patient_on sorts them, with
+## missing values first as in ehrQL, after dropping the rows of patients not evaluated
+def sort_for_patient_on(table, patient_ids, sort_columns):
+    table = table.assign(patient_index=pd.Index(patient_ids).get_indexer(table["patient_id"]))
+    table = table[table["patient_index"] >= 0]
+    return table.sort_values(["patient_index", *sort_columns], na_position="first", kind="stable", ignore_index=True)
+
+
+## This function returns whether the row for_patient_on picks for each patient on an index date, i.e. the last row
+## spanning the date in a table sorted by sort_for_patient_on, meets a condition. Patients with no row spanning the
+## date don't meet it
+## is_met: a TRUE/FALSE array of whether each row of the table meets the condition
+def is_met_for_patient_on(table, is_met, n_patients, index_date):
+    spanning = (table["start_date"] <= index_date).to_numpy() & ~(table["end_date"] < index_date).to_numpy()
+    patient_index = table["patient_index"].to_numpy()[spanning]
+    is_last = np.append(patient_index[1:] != patient_index[:-1], True)
+    met = np.zeros(n_patients, dtype=bool)
+    met[patient_index[is_last]] = is_met[spanning][is_last]
+    return met
+
+
+## This function evaluates each criterion for every patient on an index date
+## Returns a dict of criterion: TRUE/FALSE array, in the order of the patient dates
+def evaluate_criteria(index_date, patient_dates, prescription_keys, registrations, addresses, origin):
+    n_patients = len(patient_dates)
+    patient_index = np.arange(n_patients)
+    index_day = int(to_days(index_date)[0])
+
+    has_class_count = np.zeros(n_patients, dtype=bool)
+    for keys in prescription_keys.values():
+        counts = count_in_window(keys, patient_index, index_day - ANTIHYPERTENSIVE_WINDOW_DAYS, index_day, origin)
+        has_class_count |= counts >= ANTIHYPERTENSIVE_MIN_COUNT
+
+    return {
+        "inex_bin_has_dem": (patient_dates["inex_dat_dem"] <= index_date).to_numpy(),
+        "inex_bin_antihyp": has_class_count,
+        "inex_bin_alive": (
+            (patient_dates["inex_dat_death"].isna() | (patient_dates["inex_dat_death"] > index_date))
+            & (patient_dates["inex_dat_death_ons"].isna() | (patient_dates["inex_dat_death_ons"] > index_date))
+        ).to_numpy(),
+        "inex_bin_over_64": get_age_on(patient_dates["inex_dat_birth"], index_date) > 64,
+        "inex_bin_6m_reg": has_registration_spanning(registrations, n_patients, index_date, REGISTRATION_DAYS),
+        "inex_bin_known_sex": patient_dates["inex_cat_sex"].isin(["male", "female"]).to_numpy(),
+        "inex_bin_known_imd": is_met_for_patient_on(
+            addresses, addresses["has_imd"].eq(True).to_numpy(), n_patients, index_date
+        ),
+        "inex_bin_known_region": is_met_for_patient_on(
+            registrations, registrations["region"].notna().to_numpy(), n_patients, index_date
+        ),
+    }
+
+
+## This function finds the eligible patients on each index date, writing them to output_path, and returns the number
+## of patients meeting each criterion on each index date
+def find_eligible_patients(index_dates, patient_dates, prescriptions, registrations, addresses, output_path):
+    patient_ids = patient_dates["patient_id"].to_numpy()
+    # Days are counted from a year before the first index date, so every window starts after the origin
+    origin = int(to_days(index_dates[0])[0]) - ANTIHYPERTENSIVE_WINDOW_DAYS - 1
+    prescriptions = prescriptions[prescriptions["date"] >= pd.Timestamp(index_dates[0]) - pd.Timedelta(days=366)]
+    prescription_keys = build_prescription_keys(prescriptions, patient_ids, origin)
+    registrations = sort_for_patient_on(registrations, patient_ids, REGISTRATION_SORT)
+    addresses = sort_for_patient_on(addresses, patient_ids, ADDRESS_SORT)
+
+    counts = []
+    writer = ChunkWriter(output_path)
+    try:
+        for index_date in index_dates:
+            criteria = evaluate_criteria(index_date, patient_dates, prescription_keys, registrations, addresses, origin)
+            eligible = np.logical_and.reduce(list(criteria.values()))
+            writer.write(pd.DataFrame({"patient_id": patient_ids[eligible], "inex_dat_index": index_date}))
+            counts.append({
+                "index_date": index_date.date(),
+                **{name: int(values.sum()) for name, values in criteria.items()},
+                "inex_bin_all": int(eligible.sum()),
+            })
+    finally:
+        writer.close()
+    return pd.DataFrame(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the patients eligible on each of a series of index dates")
+    parser.add_argument("output", help="path to write the eligible patients on each index date to")
+    parser.add_argument("--frequency", default="MS", help="pandas offset alias of the index dates (default: MS, monthly)")
+    parser.add_argument("--counts", help="path to write the number of patients meeting each criterion to")
+    args = parser.parse_args()
+
+    with open("analysis/config.json") as f:
+        study_dates = json.load(f)
+    index_dates = get_index_dates(study_dates["start_date"], study_dates["end_date"], args.frequency)
+    print(f"Evaluating eligibility on {len(index_dates)} index dates")
+
+    counts = find_eligible_patients(
+        index_dates,
+        load_patient_dates(),
+        load_prescriptions(),
+        load_registrations(),
+        load_addresses(),
+        args.output,
+    )
+
+    if args.counts:
+        path = Path(args.counts)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        counts.to_csv(path, index=False)
+        count_columns = [name for name in counts.columns if name.startswith("inex_")]
+        counts.assign(**{name: counts[name].map(roundmid_any) for name in count_columns}).to_csv(
+            path.with_name(f"{path.stem}_midpoint6{path.suffix}"), index=False
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+## This file contains functions for finding the first date on which a patient "stops" a medication following a
+## clinical event (e.g. a medication review), calculated for every patient at once from the sorted event and
+## prescription dates.
+## A stopping event is an event which is followed by a gap of at least gap_size days before the next prescription,
+## and the event date is treated as the date of stopping. Events with no later prescription are censored at the end
+## of the prescriptions extracted: they count as stopping events only for gap sizes up to the number of days observed
+## after the event (days_observed). Without days_observed, they count as stopping events for every gap size.
+## The number of days from each event to the next prescription doesn't depend on the gap size, so it is found once
+## and any number of gap sizes can then be compared with it.
+## Run from the root of the repository to count the patients with a stopping event for each of a set of gap sizes,
+## from the days to the next prescription saved by derive_dataset_desc.py, e.g.
+##   python analysis/dataset_derive/stopping_dates.py output/dataset/desc_med_rev_gaps.arrow output/tables/stopping_gap_sizes.csv --gap-sizes 7 14 30 60 90 180 365
+
+import argparse
+from pathlib import Path
+
+import pandas as pd
+
+from dataset_io import read_dataset, roundmid_any
+from episodes import get_next_prescription_dates
+
+
+## This function selects the events within a time period
+## event_dates: distinct event dates, sorted by patient and date
+## start_date: the start date of the time period. Events on this date are not included
+## end_date: the end date of the time period (inclusive)
+## limit: the maximum number of events to consider per patient, starting from the first event after the start date
+def select_events(event_dates, start_date, end_date, limit):
+    start_date = pd.Timestamp(start_date)
+    end_date = pd.Timestamp(end_date)
+    events = event_dates[(event_dates["date"] > start_date) & (event_dates["date"] <= end_date)]
+    return events[events.groupby("patient_id").cumcount() < limit]
+
+
+## This function returns the number of days from each event to the patient's first prescription on or after it, which
+## is missing if there is no later prescription
+## history: prescription history of the medication (see build_prescription_history in episodes.py)
+## events: data frame with patient_id and date columns, e.g. from select_events
+def get_days_to_next_prescription(history, events):
+    next_rx = get_next_prescription_dates(history, events["patient_id"], events["date"]).to_numpy()
+    return pd.Series((next_rx - events["date"].to_numpy()) / pd.Timedelta(days=1), index=events.index)
+
+
+## This function returns whether each event is a stopping event for a gap size
+## days_to_next: days from each event to the next prescription (see get_days_to_next_prescription)
+## days_observed: days from each event to the end of the prescriptions extracted. If not given, events with no later
+## prescription are stopping events for every gap size
+def is_stopping_event(days_to_next, gap_size, days_observed=None):
+    no_next_rx = days_to_next.isna()
+    is_stop = (days_to_next >= gap_size) | no_next_rx
+    if days_observed is not None:
+        is_stop &= ~no_next_rx | (days_observed >= gap_size)
+    return is_stop
+
+
+## This function finds the first stopping event for each patient for each of several gap sizes
+## events: data frame with patient_id and date columns, e.g. from select_events
+## days_to_next, days_observed: see is_stopping_event
+## gap_sizes: list of the number of days between prescriptions to define a stopping event
+## column_prefix, column_suffix: a column {column_prefix}_{gap_size}_{column_suffix} is returned for each gap size
+## Returns a data frame indexed by patient_id with one date column per gap size. Patients without a stopping event
+## for any gap size are not included.
+def get_stopping_dates(events, days_to_next, gap_sizes, column_prefix, column_suffix, days_observed=None):
+    stop_dates = {}
+    for gap_size in gap_sizes:
+        is_stop = is_stopping_event(days_to_next, gap_size, days_observed)
+        stop_dates[f"{column_prefix}_{gap_size}_{column_suffix}"] = (
+            events[is_stop].groupby("patient_id")["date"].min()
+        )
+
+    return pd.DataFrame(stop_dates)
+
+
+## This function counts the patients with a stopping event in each year for each medication class and gap size
+## event_gaps: event-level table written by derive_dataset_desc.py, with patient_id, year, desc_num_days_observed
+## and a desc_num_days_to_rx_{class} column for each medication class
+## gap_sizes: list of gap sizes to count stopping events for
+def count_stopping_patients(event_gaps, gap_sizes):
+    days_observed = event_gaps["desc_num_days_observed"]
+    counts = []
+    for column in [name for name in event_gaps.columns if name.startswith("desc_num_days_to_rx_")]:
+        medication_class = column.removeprefix("desc_num_days_to_rx_")
+        for gap_size in gap_sizes:
+            is_stop = is_stopping_event(event_gaps[column], gap_size, days_observed)
+            n_patients = event_gaps[is_stop].groupby("year")["patient_id"].nunique()
+            counts.append(pd.DataFrame({
+                "year": n_patients.index,
+                "medication_class": medication_class,
+                "gap_size": gap_size,
+                "n_patients": n_patients.to_numpy(),
+            }))
+    return pd.concat(counts, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count the patients with a stopping event for each gap size")
+    parser.add_argument("input", help="event-level table of the days to the next prescription")
+    parser.add_argument("output", help="path to write the counts to (a _midpoint6 version is also written)")
+    parser.add_argument("--gap-sizes", type=int, nargs="+", required=True, help="gap sizes in days")
+    args = parser.parse_args()
+
+    counts = count_stopping_patients(read_dataset(args.input), args.gap_sizes)
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    counts.to_csv(output, index=False)
+    counts.assign(n_patients=counts["n_patients"].map(roundmid_any)).to_csv(
+        output.with_name(f"{output.stem}_midpoint6{output.suffix}"), index=False
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+## This script benchmarks each generate_dataset_* action in project.yaml against synthetic data of increasing size.
+## For each number of patients it generates a set of dummy tables with generate_dummy_tables.py, then runs every
+## dataset definition through ehrQL's local engine and records:
+## - wall_s: wall time of generate-dataset
+## - peak_rss_mb: peak memory of generate-dataset
+## - columns, distinct_nodes, tree_size, max_depth: size of the query graph (see query_graph.py)
+## - output_bytes: size of the files written
+## The results are written to output/benchmarks/benchmark.json and .csv. If --baseline is given, the results are
+## compared with a previous report and the script fails if any measure has grown by more than --tolerance times.
+## Run from the root of the repository with ehrql importable, e.g. in the codespace:
+##   PYTHONPATH=.devcontainer/ehrql-main python analysis/dev_tools/benchmark_definitions.py --patients 1000 10000
+
+import argparse
+import csv
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import yaml
+
+from generate_dummy_tables import write_dummy_tables
+
+BENCHMARK_DIR = Path("output/benchmarks")
+PATIENTS = [1_000, 10_000, 100_000, 1_000_000]
+# Measures compared against the baseline
+COMPARED_MEASURES = ["wall_s", "peak_rss_mb", "tree_size", "output_bytes"]
+
+
+## This function returns the dataset definition, the --output argument and the arguments passed to the definition
+## (after --) of each generate_dataset_* action
+def get_generate_actions(project_yaml="project.yaml"):
+    with open(project_yaml) as f:
+        actions = yaml.safe_load(f)["actions"]
+    generate_actions = {}
+    for name, action in actions.items():
+        args = shlex.split(action["run"])
+        if "generate-dataset" not in args:
+            continue
+        definition = args[args.index("generate-dataset") + 1]
+        output = args[args.index("--output") + 1]
+        user_args = args[args.index("--") + 1:] if "--" in args else []
+        generate_actions[name] = {"definition": definition, "output": output, "user_args": user_args}
+    return generate_actions
+
+
+## This function writes the eligible population which the later dataset definitions read (see population.py),
+## using every patient in the dummy tables
+def write_prematch_population(tables_dir, work_dir):
+    patients = pd.read_csv(tables_dir / "patients.csv", usecols=["patient_id", "date_of_birth"])
+    population = pa.table({
+        "patient_id": pa.array(patients["patient_id"], type=pa.int64()),
+        "qa_num_birth_year": pa.array(pd.to_datetime(patients["date_of_birth"]).dt.year, type=pa.int64()),
+    }).sort_by("patient_id")
+    path = work_dir / "output/dataset_clean/population_prematch.arrow"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    feather.write_feather(population, path, compression="uncompressed")
+
+
+## This function sets up a directory to run the dataset definitions in, linking to the analysis and codelists folders
+def make_work_dir(work_dir):
+    work_dir.mkdir(parents=True, exist_ok=True)
+    for name in ["analysis", "codelists", ".codelist_cache"]:
+        link = work_dir / name
+        if not link.exists() and Path(name).exists():
+            link.symlink_to(Path(name).resolve())
+    return work_dir
+
+
+## This function returns the paths written to by an --output argument (a file, or a directory:format)
+def get_output_paths(work_dir, output):
+    if ":" in output:
+        return list((work_dir / output.split(":")[0]).glob("*"))
+    return [work_dir / output]
+
+
+## This function runs generate-dataset for one action and returns its wall time and peak memory
+def run_generate_dataset(work_dir, action, tables_dir, log_path):
+    command = [
+        sys.executable, "-m", "ehrql", "generate-dataset", action["definition"],
+        "--output", action["output"],
+        "--dummy-tables", str(tables_dir.resolve()),
+    ]
+    if action["user_args"]:
+        command += ["--", *action["user_args"]]
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(command, cwd=work_dir, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 gives the resource usage of this process alone
+        _, status, usage = os.wait4(process.pid, 0)
+    wall_s = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"{action['definition']} failed, see {log_path}")
+    # ru_maxrss is in kilobytes on Linux
+    return wall_s, usage.ru_maxrss / 1024
+
+
+## This function measures the query graph of a dataset definition in a separate process
+def measure_query_graph(work_dir, definition, user_args):
+    result = subprocess.run(
+        [sys.executable, str(Path(__file__).resolve().with_name("query_graph.py")), definition, "--", *user_args],
+        cwd=work_dir, capture_output=True, text=True, check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+## This function benchmarks every generate action for one number of patients
+def benchmark(n_patients, actions, seed):
+    work_dir = make_work_dir(BENCHMARK_DIR / "work" / str(n_patients))
+    tables_dir = work_dir / "dummy_tables"
+    print(f"Creating dummy tables for {n_patients} patients")
+    write_dummy_tables(tables_dir, n_patients, seed=seed)
+    write_prematch_population(tables_dir, work_dir)
+
+    results = []
+    for name, action in actions.items():
+        print(f"Running {name} for {n_patients} patients")
+        wall_s, peak_rss_mb = run_generate_dataset(work_dir, action, tables_dir, work_dir / f"{name}.log")
+        graph = measure_query_graph(work_dir, action["definition"], action["user_args"])
+        output_bytes = sum(path.stat().st_size for path in get_output_paths(work_dir, action["output"]))
+        results.append({
+            "action": name,
+            "patients": n_patients,
+            "wall_s": round(wall_s, 3),
+            "peak_rss_mb": round(peak_rss_mb, 1),
+            **graph,
+            "output_bytes": output_bytes,
+        })
+    return results
+
+
+## This function compares results with a baseline report and returns a description of each regression
+def compare_with_baseline(results, baseline, tolerance):
+    baseline = {(row["action"], row["patients"]): row for row in baseline}
+    regressions = []
+    for row in results:
+        previous = baseline.get((row["action"], row["patients"]))
+        if previous is None:
+            continue
+        for measure in COMPARED_MEASURES:
+            if previous.get(measure) and row[measure] > previous[measure] * tolerance:
+                regressions.append(
+                    f"{row['action']} ({row['patients']} patients): {measure} "
+                    f"{previous[measure]} -> {row[measure]}"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dataset definitions on synthetic data")
+    parser.add_argument("--patients", type=int, nargs="+", default=PATIENTS, help="numbers of patients to run")
+    parser.add_argument("--actions", nargs="+", help="generate actions to run (default: all)")
+    parser.add_argument("--seed", type=int, default=1, help="seed for generating the dummy tables")
+    parser.add_argument("--baseline", type=Path, help="previous benchmark.json to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="ratio to the baseline counted as a regression")
+    args = parser.parse_args()
+
+    actions = get_generate_actions()
+    if args.actions:
+        actions = {name: actions[name] for name in args.actions}
+
+    results = []
+    for n_patients in args.patients:
+        results.extend(benchmark(n_patients, actions, args.seed))
+
+    BENCHMARK_DIR.mkdir(parents=True, exist_ok=True)
+    (BENCHMARK_DIR / "benchmark.json").write_text(json.dumps(results, indent=2))
+    with open(BENCHMARK_DIR / "benchmark.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+    print(pd.DataFrame(results).to_string(index=False))
+
+    if args.baseline:
+        regressions = compare_with_baseline(results, json.loads(args.baseline.read_text()), args.tolerance)
+        if regressions:
+            sys.exit("Regressions against baseline:\n" + "\n".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
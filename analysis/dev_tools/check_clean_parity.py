@@ -0,0 +1,98 @@
+## This script checks that clean_dataset.py cleans a dataset in the same way as the R cleaning scripts in
+## analysis/dataset_clean, which are kept as the reference for the cleaning rules. It cleans a generated dataset with
+## clean_dataset.py into a temporary folder, and compares the cleaned dataset and the flow chart counts with those
+## written by the R script for the same dataset. Values are compared as text: factor levels by their labels, numbers
+## by their value and TRUE/FALSE whatever their case. The output/describe/ summaries aren't compared, as
+## clean_dataset.py writes plain per-column summaries rather than skimr output.
+## Eligibility isn't packed (--pack-eligibility), as the R scripts keep a column for each year.
+## Run from the root of the repository after the R script, e.g.
+##   Rscript analysis/dataset_clean/dataset_clean_prematch.R
+##   python analysis/dev_tools/check_clean_parity.py output/dataset/input_prematch.csv.gz output/dataset_clean/input_clean_prematch.csv.gz --r-flow output/dataset_clean/flow_prematch.csv --qa --inex
+
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+import pyarrow.feather as feather
+
+sys.path.insert(0, "analysis/dataset_derive")
+from clean_dataset import clean_dataset
+
+
+## This function converts the values of a column to text, with missing values as None
+def to_text(values):
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.dt.strftime("%Y-%m-%d").astype(object).where(values.notna(), None)
+    values = values.astype(object).where(values.notna(), None)
+    values = values.map(lambda value: value if value is None else str(value))
+    values = values.replace({"": None, "NA": None, "True": "TRUE", "False": "FALSE", "true": "TRUE", "false": "FALSE"})
+
+    # Numbers are compared by value, as R and Python write them differently (e.g. 1940 and 1940.0)
+    numbers = pd.to_numeric(values, errors="coerce")
+    if numbers.notna().sum() == values.notna().sum():
+        return numbers.map(lambda value: None if pd.isna(value) else f"{value:.10g}")
+    return values
+
+
+## This function reads a cleaned dataset (CSV or Arrow) as text, sorted by patient_id
+def read_as_text(path):
+    if str(path).endswith((".csv", ".csv.gz")):
+        dataset = pd.read_csv(path, dtype=str, keep_default_na=False)
+    else:
+        dataset = feather.read_table(path).to_pandas()
+    dataset = pd.DataFrame({name: to_text(dataset[name]) for name in dataset.columns})
+    return dataset.sort_values("patient_id", key=lambda ids: ids.astype(float), ignore_index=True)
+
+
+## This function returns the differences between two cleaned datasets, as a list of messages
+def compare_datasets(expected, found):
+    differences = []
+    for name in expected.columns.difference(found.columns):
+        differences.append(f"Column {name} is only in the R output")
+    for name in found.columns.difference(expected.columns):
+        differences.append(f"Column {name} is only in the clean_dataset.py output")
+    if len(expected) != len(found) or not expected["patient_id"].equals(found["patient_id"]):
+        differences.append(f"The patients differ: {len(expected)} rows in the R output, {len(found)} from clean_dataset.py")
+        return differences
+    for name in expected.columns.intersection(found.columns):
+        n_different = int((expected[name].fillna("<missing>") != found[name].fillna("<missing>")).sum())
+        if n_different:
+            differences.append(f"Column {name} differs in {n_different} rows")
+    return differences
+
+
+## This function returns the differences between the flow chart counts written by the R script and clean_dataset.py
+def compare_flow(r_flow_path, flow):
+    r_flow = pd.read_csv(r_flow_path)
+    expected = list(zip(r_flow["Description"], r_flow["N"].astype(int)))
+    found = list(flow.items())
+    if expected == found:
+        return []
+    return [f"Flow chart counts differ:\n  R: {expected}\n  clean_dataset.py: {found}"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare clean_dataset.py with the R cleaning scripts")
+    parser.add_argument("input", help="path of the generated dataset cleaned by the R script")
+    parser.add_argument("r_output", help="path of the dataset cleaned by the R script")
+    parser.add_argument("--r-flow", help="path of the flow chart counts written by the R script")
+    parser.add_argument("--qa", action="store_true", help="apply the quality assurance rules, as the R script does")
+    parser.add_argument("--inex", action="store_true", help="apply the inclusion and exclusion criteria, as the R script does")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_path = Path(tmp_dir) / "cleaned.csv.gz"
+        flow = clean_dataset(args.input, output_path, "parity", args.qa, args.inex)
+        differences = compare_datasets(read_as_text(args.r_output), read_as_text(output_path))
+    if args.r_flow:
+        differences += compare_flow(args.r_flow, flow)
+
+    if differences:
+        sys.exit("clean_dataset.py differs from the R cleaning scripts:\n" + "\n".join(differences))
+    print("clean_dataset.py gives the same cleaned dataset as the R cleaning scripts")
+
+
+if __name__ == "__main__":
+    main()
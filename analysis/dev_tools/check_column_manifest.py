@@ -0,0 +1,113 @@
+## This script checks analysis/column_manifest.json against the table scripts, so that a column a script reads can't
+## be pruned from its dataset (see column_manifest.py). It fails if:
+## - a script in analysis/tables reads a cleaned dataset (output/dataset_clean/input_clean_<dataset>[_long].arrow)
+##   without being listed in the manifest for that dataset
+## - a column a script selects with col_select (by name or starts_with) isn't matched by the script's patterns in
+##   the manifest, and so would be pruned
+## Scripts which read a dataset without col_select can't be checked, and are reported.
+## Run from the root of the repository (ehrql isn't needed), e.g.
+##   python analysis/dev_tools/check_column_manifest.py
+
+import re
+import sys
+from pathlib import Path
+
+sys.path.insert(0, ".")
+from analysis.dataset_definition.column_manifest import get_consumers, is_consumed
+
+TABLES_DIR = Path("analysis/tables")
+DATASETS = ["desc", "hist", "cov"]
+CLEAN_DATASET = re.compile(r"input_clean_([a-z]+?)(?:_long)?\.arrow")
+
+
+## This function returns the text inside the brackets which start at a position in a script
+def get_bracketed(text, start):
+    depth = 0
+    for position in range(start, len(text)):
+        if text[position] == "(":
+            depth += 1
+        elif text[position] == ")":
+            depth -= 1
+            if depth == 0:
+                return text[start + 1:position]
+    raise ValueError("Unmatched bracket")
+
+
+## This function splits R arguments at the commas which aren't inside brackets
+def split_arguments(text):
+    arguments = [""]
+    depth = 0
+    for character in text:
+        if character == "," and depth == 0:
+            arguments.append("")
+            continue
+        depth += {"(": 1, ")": -1}.get(character, 0)
+        arguments[-1] += character
+    return [argument.strip() for argument in arguments if argument.strip()]
+
+
+## This function returns the columns selected by the col_select arguments of a script, as names or patterns, and
+## any selections which can't be checked (e.g. all_of())
+def get_selected_columns(script):
+    selected = []
+    unchecked = []
+    for match in re.finditer(r"col_select\s*=\s*c\s*\(", script):
+        for argument in split_arguments(get_bracketed(script, match.end() - 1)):
+            prefix = re.fullmatch(r"""starts_with\(\s*["']([^"']+)["']\s*\)""", argument)
+            if prefix:
+                selected.append(f"{prefix.group(1)}*")
+            elif re.fullmatch(r"[A-Za-z_][A-Za-z0-9_.]*", argument):
+                selected.append(argument)
+            else:
+                unchecked.append(argument)
+    return selected, unchecked
+
+
+## This function returns the problems found with the manifest for one table script
+def check_script(path, consumers_by_dataset):
+    script = path.read_text()
+    datasets = sorted({match.group(1) for match in CLEAN_DATASET.finditer(script)} & set(DATASETS))
+    if not datasets:
+        return [], []
+
+    problems = []
+    notes = []
+    selected, unchecked = get_selected_columns(script)
+    for dataset_name in datasets:
+        patterns = consumers_by_dataset[dataset_name].get(str(path))
+        if patterns is None:
+            problems.append(f"{path} reads the {dataset_name} dataset but isn't listed for it in the manifest")
+            continue
+        for column in selected:
+            if not is_consumed(column, patterns):
+                problems.append(f"{path} selects {column} from the {dataset_name} dataset, which would be pruned")
+    if not selected:
+        notes.append(f"{path} doesn't use col_select, so the columns it reads can't be checked")
+    for argument in unchecked:
+        notes.append(f"{path} selects {argument}, which can't be checked")
+    return problems, notes
+
+
+def main():
+    consumers_by_dataset = {dataset_name: get_consumers(dataset_name) for dataset_name in DATASETS}
+    problems = []
+    for path in sorted(TABLES_DIR.glob("*.R")):
+        script_problems, notes = check_script(path, consumers_by_dataset)
+        problems.extend(script_problems)
+        for note in notes:
+            print(f"Note: {note}")
+
+    for dataset_name, consumers in consumers_by_dataset.items():
+        for script in consumers:
+            if not Path(script).exists():
+                problems.append(f"The manifest lists {script} for the {dataset_name} dataset, but it doesn't exist")
+
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(f"{len(problems)} problems with {Path('analysis/column_manifest.json')}")
+    print("Every column selected by the table scripts is in the manifest")
+
+
+if __name__ == "__main__":
+    main()
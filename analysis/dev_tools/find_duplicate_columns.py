@@ -0,0 +1,64 @@
+## This script finds the columns of a dataset definition which are calculated by the same ehrQL query under different
+## names, without running any queries. ehrQL query model nodes are compared by value, so two columns whose query
+## graphs are built separately but identically (e.g. the same variable added for every year by a loop, or a variable
+## defined with the study dates inside a loop over years) have equal nodes and are reported as one group.
+## For each group the first column added is kept and the others are listed as aliases of it, with the line of the
+## definition which added each column. A column can be dropped from the definition and recreated from the one it is
+## an alias of (for year-suffixed columns, a column without the suffix is repeated on every year's row by
+## patient_years.py). --output writes the aliases as JSON, and --fail makes the script fail if there are any.
+## Run from the root of the repository with ehrql importable, e.g.
+##   PYTHONPATH=.devcontainer/ehrql-main python analysis/dev_tools/find_duplicate_columns.py analysis/dataset_definition/dataset_definition_cov.py
+## Arguments after -- are passed to the definition, as with ehrQL (e.g. -- --year 2017 for one partition).
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+from profile_queries import load_dataset_with_call_sites
+from query_graph import get_column_nodes
+
+
+## This function groups the columns of a dataset by their query, in the order they were added, and returns the
+## groups with more than one column
+def find_duplicate_columns(dataset):
+    columns_by_node = {}
+    for name, node in get_column_nodes(dataset).items():
+        columns_by_node.setdefault(node, []).append(name)
+    return [names for names in columns_by_node.values() if len(names) > 1]
+
+
+## This function returns the column each duplicate column is an alias of
+def get_aliases(duplicate_groups):
+    return {name: names[0] for names in duplicate_groups for name in names[1:]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find columns of a dataset definition with the same query")
+    parser.add_argument("definition", type=Path)
+    parser.add_argument("--output", type=Path, help="file to write the aliases to as JSON")
+    parser.add_argument("--fail", action="store_true", help="fail if any columns are duplicated")
+    args, user_args = parser.parse_known_args()
+    user_args = user_args[1:] if user_args[:1] == ["--"] else user_args
+
+    sys.setrecursionlimit(100_000)
+    dataset, call_sites = load_dataset_with_call_sites(args.definition, user_args)
+    duplicate_groups = find_duplicate_columns(dataset)
+
+    for names in duplicate_groups:
+        print(f"\n{names[0]} ({call_sites.get(names[0].split('.')[0], '(unknown)')}) is also added as:")
+        for name in names[1:]:
+            print(f"  {name} ({call_sites.get(name.split('.')[0], '(unknown)')})")
+    n_duplicates = sum(len(names) - 1 for names in duplicate_groups)
+    print(f"\n{n_duplicates} duplicate columns in {len(duplicate_groups)} groups in {args.definition}")
+
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps({"aliases": get_aliases(duplicate_groups)}, indent=2))
+
+    if args.fail and n_duplicates:
+        sys.exit(f"{n_duplicates} duplicate columns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,514 @@
+## This script generates synthetic dummy tables, in the format read by `--dummy-tables`, for every table used by
+## the dataset definitions, including medications.
+## Patients are generated in chunks and each chunk is appended to the output files before the next one is made, so
+## memory use depends on the chunk size rather than the number of patients. Within a chunk, every table is built
+## with numpy array operations rather than patient by patient.
+## Codes are drawn from the project's codelists, so the generated records match the definitions' criteria:
+## - most patients are aged 65 or over during the study and many have a dementia diagnosis
+## - antihypertensive users have one or more courses of repeat prescriptions per medication class, issued every
+##   28, 56 or 84 days with some late or missed issues, which stop at the end of the course
+## - medication reviews happen about once a year, and courses sometimes stop shortly after a review
+## Run from the root of the repository, e.g.
+##   python analysis/dev_tools/generate_dummy_tables.py --patients 1000000 --output output/dummy_tables_1m
+## or, to add medications for the patients already in dummy_tables, prescribed around the medication reviews in
+## their clinical_events.csv:
+##   python analysis/dev_tools/generate_dummy_tables.py --medications-for dummy_tables/patients.csv --output dummy_tables
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Codelists to draw codes from. The code column of each CSV is used
+CODELIST_FILES = {
+    "dementia": ("codelists/nhsd-primary-care-domain-refsets-dem_cod.csv", "code"),
+    "alzheimers": ("codelists/nhsd-primary-care-domain-refsets-alzheimers-disease-dementia-codes.csv", "code"),
+    "vascular_dementia": ("codelists/nhsd-primary-care-domain-refsets-vascular-dementia-codes.csv", "code"),
+    "medication_review": ("codelists/nhsd-primary-care-domain-refsets-demmedrvw_cod.csv", "code"),
+    "ethnicity": ("codelists/opensafely-ethnicity-snomed-0removed.csv", "code"),
+    "hypertension": ("codelists/nhsd-primary-care-domain-refsets-hyp_cod.csv", "code"),
+    "chd": ("codelists/primis-covid19-vacc-uptake-chd_cov.csv", "code"),
+    "ami": ("codelists/user-elsie_horne-ami_snomed.csv", "code"),
+    "stroke": ("codelists/user-elsie_horne-stroke_isch_snomed.csv", "code"),
+    "cancer": ("codelists/user-elsie_horne-cancer_snomed.csv", "code"),
+    "smoking": ("codelists/opensafely-smoking-clear.csv", "CTV3Code"),
+    "ami_icd10": ("codelists/user-RochelleKnight-ami_icd10.csv", "code"),
+    "stroke_icd10": ("codelists/user-RochelleKnight-stroke_isch_icd10.csv", "code"),
+    "cancer_icd10": ("codelists/user-elsie_horne-cancer_icd10.csv", "code"),
+    "hypertension_icd10": ("codelists/user-elsie_horne-hypertension_icd10.csv", "code"),
+}
+# Antihypertensive class codelists, keyed by the suffix used for each class in variable names
+MEDICATION_CLASS_FILES = {
+    "acei": "codelists/opensafely-ace-inhibitor-medications.csv",
+    "aab": "codelists/opensafely-alpha-adrenoceptor-blocking-drugs.csv",
+    "arb": "codelists/opensafely-angiotensin-ii-receptor-blockers-arbs.csv",
+    "bb": "codelists/opensafely-beta-blocker-medications.csv",
+    "ccb": "codelists/opensafely-calcium-channel-blockers.csv",
+    "caa": "codelists/user-robert_porteous-centrally-acting-antihypertensives-dmd.csv",
+    "psd": "codelists/user-robert_porteous-potassium-sparing-diuretics-aldosterone-antagonists-and-compounds-dmd.csv",
+}
+# Relative frequency of each antihypertensive class
+MEDICATION_CLASS_WEIGHTS = np.array([0.30, 0.05, 0.15, 0.20, 0.22, 0.02, 0.06])
+REGIONS = np.array([
+    "East", "East Midlands", "London", "North East", "North West",
+    "South East", "South West", "West Midlands", "Yorkshire and The Humber",
+])
+SUS_ETHNICITY_CODES = np.array(list("ABCDEFGHJKLMNPRS"))
+EFI_DESCRIPTION = "UK Electronic Frailty Index (eFI)"
+
+# Period covered by the generated records
+with open("analysis/config.json") as f:
+    study_dates = json.load(f)
+DATA_START = np.datetime64(study_dates["start_date"]) - np.timedelta64(3 * 365, "D")
+DATA_END = np.datetime64(study_dates["end_date"]) + np.timedelta64(2 * 365, "D")
+
+
+## This function reads the codes in each codelist as numpy arrays
+def load_codes():
+    codes = {
+        name: pd.read_csv(filename, usecols=[column], dtype=str)[column].dropna().str.strip().to_numpy()
+        for name, (filename, column) in CODELIST_FILES.items()
+    }
+    medication_codes = {
+        name: pd.read_csv(filename, usecols=["code"], dtype=str)["code"].dropna().str.strip().to_numpy()
+        for name, filename in MEDICATION_CLASS_FILES.items()
+    }
+    return codes, medication_codes
+
+
+## This function returns a random date between start and end (inclusive) for each pair of dates
+def random_dates(rng, start, end):
+    days = (end - start).astype("timedelta64[D]").astype(np.int64)
+    return start + (rng.random(len(days)) * (np.maximum(days, 0) + 1)).astype(np.int64).astype("timedelta64[D]")
+
+
+## This function picks a random code from codes for each of n records
+def random_codes(rng, codes, n):
+    return codes[rng.integers(0, len(codes), n)]
+
+
+## This function returns the dates as strings, with missing dates as empty strings
+def format_dates(dates):
+    return np.where(np.isnat(dates), "", np.datetime_as_string(dates, unit="D"))
+
+
+## This function generates the patients table, and returns it with each patient's date of death and the end of
+## their records (the earlier of death and the end of the data)
+def generate_patients(rng, patient_ids):
+    n = len(patient_ids)
+    # Ages at the start of the study are skewed towards older ages; dates of birth are the first of the month
+    age_at_start = 55 + rng.gamma(4.0, 5.0, n).astype(np.int64)
+    date_of_birth = (
+        (np.datetime64(study_dates["start_date"]) - (age_at_start * 365.25).astype(np.int64).astype("timedelta64[D]"))
+        .astype("datetime64[M]")
+        .astype("datetime64[D]")
+    )
+    sex = rng.choice(np.array(["female", "male", "unknown"]), n, p=[0.56, 0.435, 0.005])
+
+    dies = rng.random(n) < 0.35
+    date_of_death = np.where(
+        dies,
+        random_dates(rng, np.full(n, DATA_START), np.full(n, DATA_END)),
+        np.datetime64("NaT"),
+    ).astype("datetime64[D]")
+    records_end = np.where(dies, np.minimum(date_of_death, DATA_END), DATA_END).astype("datetime64[D]")
+
+    patients = pd.DataFrame({
+        "patient_id": patient_ids,
+        "date_of_birth": format_dates(date_of_birth),
+        "sex": sex,
+        "date_of_death": format_dates(date_of_death),
+    })
+    return patients, date_of_death, records_end
+
+
+## This function generates practice registrations. Most patients have one open registration and some moved
+## practice during the data period.
+def generate_registrations(rng, patient_ids, records_end):
+    n = len(patient_ids)
+    first_start = DATA_START - (rng.random(n) * 30 * 365).astype(np.int64).astype("timedelta64[D]")
+    moves = rng.random(n) < 0.15
+    move_date = random_dates(rng, np.full(n, DATA_START), records_end)
+
+    first_end = np.where(moves, move_date - np.timedelta64(1, "D"), np.datetime64("NaT")).astype("datetime64[D]")
+    patient_index = np.concatenate([np.arange(n), np.flatnonzero(moves)])
+    start_date = np.concatenate([first_start, move_date[moves]])
+    end_date = np.concatenate([first_end, np.full(moves.sum(), np.datetime64("NaT", "D"))])
+    practice = rng.integers(1, 6000, len(patient_index))
+
+    return pd.DataFrame({
+        "patient_id": patient_ids[patient_index],
+        "start_date": format_dates(start_date),
+        "end_date": format_dates(end_date),
+        "practice_pseudo_id": practice,
+        "practice_stp": [f"E54000{stp:03d}" for stp in 20 + practice % 42],
+        "practice_nuts1_region_name": REGIONS[practice % len(REGIONS)],
+        "practice_systmone_go_live_date": "2009-01-01",
+    })
+
+
+## This function generates addresses. Most patients have one address and some move during the data period,
+## with some moving into a care home.
+def generate_addresses(rng, patient_ids, records_end, first_address_id):
+    n = len(patient_ids)
+    moves = rng.random(n) < 0.2
+    move_date = random_dates(rng, np.full(n, DATA_START), records_end)
+
+    patient_index = np.concatenate([np.arange(n), np.flatnonzero(moves)])
+    start_date = np.concatenate([
+        DATA_START - (rng.random(n) * 40 * 365).astype(np.int64).astype("timedelta64[D]"),
+        move_date[moves],
+    ])
+    end_date = np.concatenate([
+        np.where(moves, move_date - np.timedelta64(1, "D"), np.datetime64("NaT")).astype("datetime64[D]"),
+        np.full(moves.sum(), np.datetime64("NaT", "D")),
+    ])
+    n_addresses = len(patient_index)
+    imd_rounded = rng.integers(0, 329, n_addresses) * 100
+    has_imd = rng.random(n_addresses) < 0.97
+    second_address = np.arange(n_addresses) >= n
+    care_home = rng.random(n_addresses) < np.where(second_address, 0.3, 0.05)
+    nursing = care_home & (rng.random(n_addresses) < 0.5)
+
+    return pd.DataFrame({
+        "address_id": first_address_id + np.arange(n_addresses),
+        "patient_id": patient_ids[patient_index],
+        "start_date": format_dates(start_date),
+        "end_date": format_dates(end_date),
+        "address_type": 1,
+        "rural_urban_classification": rng.integers(1, 9, n_addresses),
+        "practice_nuts1_region_name": REGIONS[rng.integers(0, len(REGIONS), n_addresses)],
+        "imd_rounded": np.where(has_imd, imd_rounded.astype(str), ""),
+        "imd_quintile": np.where(has_imd, (imd_rounded * 5 // 32900 + 1).astype(str), ""),
+        "imd_decile": np.where(has_imd, (imd_rounded * 10 // 32900 + 1).astype(str), ""),
+        "msoa_code": [f"E0{code:07d}" for code in rng.integers(2000001, 2007202, n_addresses)],
+        "has_postcode": "T",
+        "care_home_is_potential_match": np.where(care_home, "T", "F"),
+        "care_home_requires_nursing": np.where(nursing, "T", "F"),
+        "care_home_does_not_require_nursing": np.where(care_home & ~nursing, "T", "F"),
+    })
+
+
+## This function generates records with probability `prevalence` per patient, with a Poisson number of records
+## (mean `mean_records`, at least one) for each patient who has any, on random dates up to the end of their records.
+## Returns the index of the patient and the date of each record.
+def generate_patient_events(rng, records_end, prevalence, mean_records, earliest=DATA_START):
+    n = len(records_end)
+    has_event = rng.random(n) < prevalence
+    n_records = np.where(has_event, 1 + rng.poisson(max(mean_records - 1, 0), n), 0)
+    patient_index = np.repeat(np.arange(n), n_records)
+    dates = random_dates(rng, np.full(len(patient_index), earliest), records_end[patient_index])
+    return patient_index, dates
+
+
+## This function generates clinical events: dementia diagnoses, medication reviews, ethnicity, smoking status and
+## the diagnoses used for covariates. Also returns the medication review dates, which prescribing is based on.
+def generate_clinical_events(rng, codes, patient_ids, records_end):
+    n = len(patient_ids)
+    snomed_events = []
+
+    # Dementia: the subtype of each patient's codes is chosen once per patient
+    dementia_index, dementia_dates = generate_patient_events(rng, records_end, 0.7, 2)
+    subtype = rng.choice(np.array(["alzheimers", "vascular_dementia", "dementia"]), n, p=[0.5, 0.2, 0.3])
+    for name in ["alzheimers", "vascular_dementia", "dementia"]:
+        is_subtype = subtype[dementia_index] == name
+        snomed_events.append((
+            dementia_index[is_subtype],
+            dementia_dates[is_subtype],
+            random_codes(rng, codes[name], is_subtype.sum()),
+        ))
+
+    # Medication reviews, about once a year
+    years = (records_end - DATA_START).astype(np.int64) / 365.25
+    review_counts = rng.poisson(np.maximum(years, 0) * 0.9)
+    review_index = np.repeat(np.arange(n), review_counts)
+    review_dates = random_dates(rng, np.full(len(review_index), DATA_START), records_end[review_index])
+    snomed_events.append((review_index, review_dates, random_codes(rng, codes["medication_review"], len(review_index))))
+
+    # Ethnicity is usually recorded before the data period
+    ethnicity_index, ethnicity_dates = generate_patient_events(
+        rng, np.full(n, DATA_START), 0.85, 1, earliest=DATA_START - np.timedelta64(20 * 365, "D")
+    )
+    snomed_events.append((ethnicity_index, ethnicity_dates, random_codes(rng, codes["ethnicity"], len(ethnicity_index))))
+
+    for name, prevalence, mean_records in [
+        ("hypertension", 0.6, 2), ("chd", 0.15, 2), ("ami", 0.05, 1), ("stroke", 0.06, 1), ("cancer", 0.12, 1),
+    ]:
+        event_index, event_dates = generate_patient_events(
+            rng, records_end, prevalence, mean_records, earliest=DATA_START - np.timedelta64(10 * 365, "D")
+        )
+        snomed_events.append((event_index, event_dates, random_codes(rng, codes[name], len(event_index))))
+
+    smoking_index, smoking_dates = generate_patient_events(
+        rng, records_end, 0.8, 2, earliest=DATA_START - np.timedelta64(20 * 365, "D")
+    )
+
+    patient_index = np.concatenate([index for index, _, _ in snomed_events] + [smoking_index])
+    dates = np.concatenate([dates for _, dates, _ in snomed_events] + [smoking_dates])
+    snomed = np.concatenate([event_codes for _, _, event_codes in snomed_events] + [np.full(len(smoking_index), "")])
+    ctv3 = np.concatenate([
+        np.full(len(patient_index) - len(smoking_index), ""),
+        random_codes(rng, codes["smoking"], len(smoking_index)),
+    ])
+
+    order = np.lexsort((dates, patient_index))
+    clinical_events = pd.DataFrame({
+        "patient_id": patient_ids[patient_index[order]],
+        "date": format_dates(dates[order]),
+        "snomedct_code": snomed[order],
+        "numeric_value": "",
+        "ctv3_code": ctv3[order],
+    })
+    return clinical_events, review_index, review_dates
+
+
+## This function generates repeat prescriptions of antihypertensives. Each user has courses of one or more medication
+## classes. A course is a series of prescriptions of one product issued at a regular interval (with a few days of
+## variation, and the occasional late issue), between a start date and a stop date. Some courses stop at a
+## medication review.
+def generate_medications(rng, medication_codes, patient_ids, records_end, review_index, review_dates):
+    n = len(patient_ids)
+    class_names = np.array(list(medication_codes))
+
+    # Number of classes per user, and the classes themselves (without repeats)
+    is_user = rng.random(n) < 0.75
+    n_classes = np.where(is_user, rng.choice([1, 2, 3], n, p=[0.5, 0.35, 0.15]), 0)
+    class_keys = rng.random((n, len(class_names))) ** (1 / MEDICATION_CLASS_WEIGHTS)
+    class_order = np.argsort(-class_keys, axis=1)
+    course_patient = np.repeat(np.arange(n), n_classes)
+    course_class = class_order[course_patient, np.concatenate([np.arange(k) for k in n_classes]).astype(np.int64)]
+
+    # Some courses are restarted later, which is generated as a second course of the same class
+    restarted = rng.random(len(course_patient)) < 0.25
+    course_patient = np.concatenate([course_patient, course_patient[restarted]])
+    course_class = np.concatenate([course_class, course_class[restarted]])
+    n_courses = len(course_patient)
+
+    course_start = random_dates(
+        rng, np.full(n_courses, DATA_START - np.timedelta64(2 * 365, "D")), records_end[course_patient]
+    )
+    course_length = (rng.exponential(4 * 365, n_courses) + 30).astype(np.int64).astype("timedelta64[D]")
+    course_stop = np.minimum(course_start + course_length, records_end[course_patient])
+
+    # A third of courses with a medication review during them stop at the first review after a random date
+    # in the course
+    review_order = np.lexsort((review_dates, review_index))
+    review_index = review_index[review_order]
+    review_dates = review_dates[review_order]
+    stop_after = random_dates(rng, course_start, course_stop)
+    # Position of the first review on or after stop_after for the same patient
+    review_keys = review_index.astype(np.int64) * 100_000 + (review_dates - DATA_START).astype(np.int64)
+    course_keys = course_patient.astype(np.int64) * 100_000 + (stop_after - DATA_START).astype(np.int64)
+    next_review = np.searchsorted(review_keys, course_keys)
+    has_review = next_review < len(review_index)
+    next_review = np.minimum(next_review, len(review_index) - 1)
+    stops_at_review = (
+        has_review
+        & (review_index[next_review] == course_patient)
+        & (review_dates[next_review] < course_stop)
+        & (rng.random(n_courses) < 1 / 3)
+    )
+    course_stop = np.where(stops_at_review, review_dates[next_review], course_stop)
+
+    # Prescriptions are issued every interval days from the start of the course until it stops
+    interval = rng.choice([28, 56, 84], n_courses, p=[0.6, 0.3, 0.1])
+    course_days = np.maximum((course_stop - course_start).astype(np.int64), 0)
+    n_issues = course_days // interval + 1
+    issue_course = np.repeat(np.arange(n_courses), n_issues)
+    issue_number = np.arange(len(issue_course)) - np.repeat(np.cumsum(n_issues) - n_issues, n_issues)
+
+    # Each issue is a few days early or late, and 5% of issues are delayed by 1-4 months, which also delays the
+    # issues after it in the course
+    delay = np.where(rng.random(len(issue_course)) < 0.05, rng.integers(30, 120, len(issue_course)), 0)
+    cumulative_delay = np.cumsum(delay) - np.repeat(np.cumsum(np.bincount(issue_course, delay, n_courses)) -
+        np.bincount(issue_course, delay, n_courses), n_issues).astype(np.int64)
+    offset = issue_number * interval[issue_course] + cumulative_delay + rng.integers(-3, 8, len(issue_course))
+    dates = course_start[issue_course] + np.maximum(offset, 0).astype("timedelta64[D]")
+
+    keep = dates <= course_stop[issue_course]
+    issue_course = issue_course[keep]
+    dates = dates[keep]
+
+    # Each course is for one product from the class
+    course_code = np.empty(n_courses, dtype=object)
+    for class_number, class_name in enumerate(class_names):
+        is_class = course_class == class_number
+        course_code[is_class] = random_codes(rng, medication_codes[class_name], is_class.sum())
+
+    patient_index = course_patient[issue_course]
+    order = np.lexsort((dates, patient_index))
+    return pd.DataFrame({
+        "patient_id": patient_ids[patient_index[order]],
+        "date": format_dates(dates[order]),
+        "dmd_code": course_code[issue_course[order]],
+    })
+
+
+## This function generates hospital admissions, A&E attendances, frailty scores, ONS deaths and ethnicity from SUS
+def generate_secondary_care(rng, codes, patient_ids, date_of_death, records_end, first_ident):
+    n = len(patient_ids)
+    # Diagnoses are drawn from the ICD-10 codelists, diluted with an unrelated code
+    diagnoses = np.concatenate(
+        [codes[name] for name in ["ami_icd10", "stroke_icd10", "cancer_icd10", "hypertension_icd10"]]
+        + [np.full(50, "R69")]
+    )
+
+    apcs_index, admission_dates = generate_patient_events(rng, records_end, 0.4, 2)
+    primary_diagnosis = random_codes(rng, diagnoses, len(apcs_index))
+    secondary_diagnosis = random_codes(rng, diagnoses, len(apcs_index))
+    order = np.lexsort((admission_dates, apcs_index))
+    apcs = pd.DataFrame({
+        "patient_id": patient_ids[apcs_index[order]],
+        "apcs_ident": first_ident + np.arange(len(apcs_index)),
+        "admission_date": format_dates(admission_dates[order]),
+        "discharge_date": format_dates(admission_dates[order] + rng.integers(0, 21, len(apcs_index)).astype("timedelta64[D]")),
+        "discharge_destination": rng.choice(np.array(["19", "54", "65"]), len(apcs_index), p=[0.8, 0.1, 0.1]),
+        "discharge_method": 1,
+        "spell_core_hrg_sus": "",
+        "admission_method": rng.choice(np.array(["11", "21", "22"]), len(apcs_index), p=[0.3, 0.6, 0.1]),
+        "primary_diagnosis": primary_diagnosis[order],
+        "secondary_diagnosis": secondary_diagnosis[order],
+        "all_diagnoses": [
+            f"{primary}, {secondary}" for primary, secondary in zip(primary_diagnosis[order], secondary_diagnosis[order])
+        ],
+    })
+
+    ae_index, arrival_dates = generate_patient_events(rng, records_end, 0.3, 2)
+    order = np.lexsort((arrival_dates, ae_index))
+    emergency_care_attendances = pd.DataFrame({
+        "id": first_ident + np.arange(len(ae_index)),
+        "patient_id": patient_ids[ae_index[order]],
+        "arrival_date": format_dates(arrival_dates[order]),
+        "discharge_destination": rng.choice(np.array(["306689006", "19712007", "183665006"]), len(ae_index)),
+        "diagnosis_01": random_codes(rng, diagnoses, len(ae_index)),
+    })
+
+    # Frailty scores are calculated about once a year and tend to increase
+    efi_index, efi_dates = generate_patient_events(rng, records_end, 0.7, 6)
+    order = np.lexsort((efi_dates, efi_index))
+    efi_years = (efi_dates[order] - DATA_START).astype(np.int64) / 365.25
+    decision_support_values = pd.DataFrame({
+        "patient_id": patient_ids[efi_index[order]],
+        "calculation_date": format_dates(efi_dates[order]),
+        "numeric_value": np.round(np.clip(rng.beta(2, 8, len(efi_index)) + efi_years * 0.02, 0, 1), 3),
+        "algorithm_description": EFI_DESCRIPTION,
+        "algorithm_version": "1.0",
+    })
+
+    died = ~np.isnat(date_of_death)
+    ons_deaths = pd.DataFrame({
+        "patient_id": patient_ids[died],
+        "date": format_dates(date_of_death[died]),
+    })
+
+    has_sus = rng.random(n) < 0.3
+    ethnicity_from_sus = pd.DataFrame({
+        "patient_id": patient_ids[has_sus],
+        "code": random_codes(rng, SUS_ETHNICITY_CODES, has_sus.sum()),
+    })
+
+    return {
+        "apcs": apcs,
+        "emergency_care_attendances": emergency_care_attendances,
+        "decision_support_values": decision_support_values,
+        "ons_deaths": ons_deaths,
+        "ethnicity_from_sus": ethnicity_from_sus,
+    }
+
+
+## This function appends a table to its CSV file, writing the header if it is the first chunk
+def append_table(output_dir, name, table, first_chunk):
+    table.to_csv(output_dir / f"{name}.csv", mode="w" if first_chunk else "a", header=first_chunk, index=False)
+
+
+## This function generates every table for n_patients patients, chunk_size patients at a time
+def write_dummy_tables(output_dir, n_patients, chunk_size=50_000, seed=1):
+    output_dir.mkdir(parents=True, exist_ok=True)
+    codes, medication_codes = load_codes()
+    n_rows = {}
+
+    for chunk_number, chunk_start in enumerate(range(0, n_patients, chunk_size)):
+        rng = np.random.default_rng([seed, chunk_number])
+        patient_ids = np.arange(chunk_start + 1, min(chunk_start + chunk_size, n_patients) + 1)
+        print(f"Generating patients {patient_ids[0]} to {patient_ids[-1]}")
+
+        patients, date_of_death, records_end = generate_patients(rng, patient_ids)
+        clinical_events, review_index, review_dates = generate_clinical_events(rng, codes, patient_ids, records_end)
+        tables = {
+            "patients": patients,
+            "practice_registrations": generate_registrations(rng, patient_ids, records_end),
+            "addresses": generate_addresses(rng, patient_ids, records_end, first_address_id=chunk_start * 2 + 1),
+            "clinical_events": clinical_events,
+            "medications": generate_medications(
+                rng, medication_codes, patient_ids, records_end, review_index, review_dates
+            ),
+            **generate_secondary_care(
+                rng, codes, patient_ids, date_of_death, records_end, first_ident=chunk_start * 10 + 1
+            ),
+        }
+        for name, table in tables.items():
+            append_table(output_dir, name, table, first_chunk=chunk_number == 0)
+            n_rows[name] = n_rows.get(name, 0) + len(table)
+
+    return n_rows
+
+
+## This function reads the medication reviews of existing patients from a clinical events table
+## Returns the index of the patient (in patient_ids) and the date of each review. Reviews of other patients, and
+## reviews without a date, are left out
+def read_medication_reviews(clinical_events_file, medication_review_codes, patient_ids):
+    events = pd.read_csv(
+        clinical_events_file, usecols=["patient_id", "date", "snomedct_code"], dtype={"snomedct_code": str},
+        parse_dates=["date"]
+    )
+    events = events[events["snomedct_code"].str.strip().isin(medication_review_codes) & events["date"].notna()]
+    review_index = pd.Index(patient_ids).get_indexer(events["patient_id"])
+    keep = review_index >= 0
+    return review_index[keep], events["date"].to_numpy().astype("datetime64[D]")[keep]
+
+
+## This function generates prescriptions for existing patients, to add a medications table to an existing set of
+## dummy tables. Courses stop at the medication reviews already in the clinical events table, so stopping after a
+## review can be found in the dummy data
+def write_medications_for_patients(output_dir, patients_file, clinical_events_file, seed=1):
+    codes, medication_codes = load_codes()
+    patients = pd.read_csv(patients_file, usecols=["patient_id", "date_of_death"], parse_dates=["date_of_death"])
+    patient_ids = patients["patient_id"].to_numpy()
+    date_of_death = patients["date_of_death"].to_numpy().astype("datetime64[D]")
+    records_end = np.where(np.isnat(date_of_death), DATA_END, np.minimum(date_of_death, DATA_END)).astype("datetime64[D]")
+    review_index, review_dates = read_medication_reviews(clinical_events_file, codes["medication_review"], patient_ids)
+    print(f"Prescribing around {len(review_index)} medication reviews from {clinical_events_file}")
+
+    rng = np.random.default_rng(seed)
+    medications = generate_medications(rng, medication_codes, patient_ids, records_end, review_index, review_dates)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    append_table(output_dir, "medications", medications, first_chunk=True)
+    return {"medications": len(medications)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic dummy tables")
+    parser.add_argument("--output", type=Path, required=True, help="directory to write the tables to")
+    parser.add_argument("--patients", type=int, default=1000, help="number of patients")
+    parser.add_argument("--chunk-size", type=int, default=50_000, help="number of patients to generate at a time")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--medications-for", type=Path,
+        help="patients.csv of existing dummy tables; only write a medications table for these patients")
+    parser.add_argument("--clinical-events", type=Path,
+        help="clinical_events.csv with the medication reviews of the --medications-for patients "
+             "(default: clinical_events.csv next to patients.csv)")
+    args = parser.parse_args()
+
+    if args.medications_for:
+        clinical_events_file = args.clinical_events or args.medications_for.with_name("clinical_events.csv")
+        n_rows = write_medications_for_patients(args.output, args.medications_for, clinical_events_file, args.seed)
+    else:
+        n_rows = write_dummy_tables(args.output, args.patients, args.chunk_size, args.seed)
+    for name, rows in n_rows.items():
+        print(f"{name}: {rows} rows")
+
+
+if __name__ == "__main__":
+    main()
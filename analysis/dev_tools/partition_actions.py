@@ -0,0 +1,127 @@
+## This script writes the actions in project.yaml for the dataset definitions which are partitioned by year.
+## Each definition listed in partition_by_year in config.json (e.g. "desc" for dataset_definition_desc.py) is
+## generated by one action per year of the study period, plus one action for the variables which don't depend
+## on the year, so the years can run at the same time. A merge_dataset_* action then joins the partitions on
+## patient_id (see analysis/dataset_derive/merge_partitions.py), writing to the path the single
+## generate_dataset_* action wrote to, and actions which needed generate_dataset_* need merge_dataset_* instead.
+## Run from the root of the repository after changing partition_by_year or the study dates in config.json:
+##   python analysis/dev_tools/partition_actions.py
+## The actions written are marked with comments in project.yaml, so running the script again replaces them.
+
+import json
+import re
+import shlex
+import sys
+from pathlib import Path
+
+import yaml
+
+sys.path.insert(0, ".")
+from analysis.dataset_definition.study_dates import study_years
+
+PROJECT_YAML = Path("project.yaml")
+BEGIN_MARKER = "  # Partitions of {name} (written by analysis/dev_tools/partition_actions.py)"
+END_MARKER = "  # End of partitions of {name}"
+
+
+## This function returns the definition, output path and needs of a generate action, from the single action if
+## it hasn't been partitioned yet, or from the actions written for it previously
+def get_action_spec(actions, name):
+    if f"generate_dataset_{name}" in actions:
+        action = actions[f"generate_dataset_{name}"]
+        args = shlex.split(action["run"])
+        return {
+            "definition": args[args.index("generate-dataset") + 1],
+            "output": args[args.index("--output") + 1],
+            "needs": action.get("needs", []),
+        }
+    partition = actions[f"generate_dataset_{name}_shared"]
+    merge = actions[f"merge_dataset_{name}"]
+    args = shlex.split(partition["run"])
+    return {
+        "definition": args[args.index("generate-dataset") + 1],
+        "output": merge["outputs"]["highly_sensitive"]["dataset"],
+        "needs": partition.get("needs", []),
+    }
+
+
+## This function returns the YAML for the partition and merge actions of a definition
+def write_partition_actions(name, spec, years):
+    output = Path(spec["output"])
+    partitions_dir = output.parent / "partitions"
+    needs = ", ".join(spec["needs"])
+    partitions = [("shared", "--shared")] + [(str(year), f"--year {year}") for year in years]
+
+    lines = [BEGIN_MARKER.format(name=name)]
+    for partition, args in partitions:
+        path = partitions_dir / f"{output.stem}_{partition}{output.suffix}"
+        lines += [
+            f"  generate_dataset_{name}_{partition}:",
+            f"    run: ehrql:v1 generate-dataset {spec['definition']} --output {path} --dummy-tables dummy_tables -- {args}",
+        ]
+        if needs:
+            lines.append(f"    needs: [{needs}]")
+        lines += [
+            "    outputs:",
+            "      highly_sensitive:",
+            f"        dataset: {path}",
+            "",
+        ]
+
+    partition_paths = " ".join(
+        str(partitions_dir / f"{output.stem}_{partition}{output.suffix}") for partition, _ in partitions
+    )
+    partition_actions = ", ".join(f"generate_dataset_{name}_{partition}" for partition, _ in partitions)
+    lines += [
+        f"  merge_dataset_{name}:",
+        f"    run: python:v2 python analysis/dataset_derive/merge_partitions.py {output} {partition_paths}",
+        f"    needs: [{partition_actions}]",
+        "    outputs:",
+        "      highly_sensitive:",
+        f"        dataset: {output}",
+        END_MARKER.format(name=name),
+    ]
+    return "\n".join(lines)
+
+
+## This function replaces the single generate action of a definition (or the actions written for it previously)
+## with its partition and merge actions
+def replace_actions(text, name, partition_actions):
+    begin = BEGIN_MARKER.format(name=name)
+    end = END_MARKER.format(name=name)
+    if begin in text:
+        start = text.index(begin)
+        stop = text.index(end) + len(end)
+    else:
+        # The single action runs until the next action, comment or the end of the file
+        match = re.search(rf"^  generate_dataset_{name}:\n(?:(?!  \S).*\n|\n)*", text, re.MULTILINE)
+        start = match.start()
+        stop = match.end()
+        # Keep the blank line before the next action
+        while text[start:stop].endswith("\n\n"):
+            stop -= 1
+        stop -= 1
+    text = text[:start] + partition_actions + text[stop:]
+
+    # Actions which needed the single action need the merged dataset
+    return re.sub(rf"\bgenerate_dataset_{name}\b(?!_)", f"merge_dataset_{name}", text)
+
+
+def main():
+    with open("analysis/config.json") as f:
+        study_dates = json.load(f)
+
+    text = PROJECT_YAML.read_text()
+    actions = yaml.safe_load(text)["actions"]
+    for name in study_dates.get("partition_by_year", []):
+        spec = get_action_spec(actions, name)
+        text = replace_actions(text, name, write_partition_actions(name, spec, study_years))
+
+    # Check the result is still valid YAML before overwriting project.yaml
+    yaml.safe_load(text)
+    PROJECT_YAML.write_text(text)
+    print(f"Wrote partitioned actions for: {', '.join(study_dates.get('partition_by_year', [])) or 'none'}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
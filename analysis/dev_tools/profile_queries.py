@@ -0,0 +1,180 @@
+## This script profiles the ehrQL query graph built by a dataset definition, without running any queries.
+## For each column of the dataset it reports:
+## - tree_size: number of nodes if every shared sub-expression were written out in full (roughly the size of the SQL)
+## - depth: nesting depth of the graph
+## - tables: distinct tables read
+## - scans: distinct patient-level aggregations (first_for_patient(), count_for_patient(), ...), each a pass over a table
+## - duplicated: sub-expressions which are also built by another column
+## and the same measures summed for each helper call site, i.e. each line of the definition which calls a function
+## from variable_helper_functions.py or add_variables.py (or adds a column directly).
+## Columns with a tree size or depth above the budget are flagged, and --fail makes the script fail if there are any.
+## Run from the root of the repository with ehrql importable, e.g. in the codespace:
+##   PYTHONPATH=.devcontainer/ehrql-main python analysis/dev_tools/profile_queries.py analysis/dataset_definition/dataset_definition_desc.py
+
+import argparse
+import json
+import sys
+from collections import Counter
+from pathlib import Path
+
+from ehrql.query_language import Dataset
+
+from query_graph import (
+    get_column_nodes,
+    get_depth,
+    get_distinct_nodes,
+    get_table_scans,
+    get_tree_size,
+    load_dataset,
+)
+
+HELPER_FILES = ("variable_helper_functions.py", "add_variables.py")
+MAX_TREE_SIZE = 5_000
+MAX_DEPTH = 200
+# Node types too small to be worth reporting as duplicated sub-expressions
+LEAF_NODE_TYPES = ("Value", "SelectTable", "SelectPatientTable", "SelectColumn", "InlinePatientTable")
+
+
+## This function returns where a column is being added from: the line of the dataset definition and the helper
+## function called on that line, if any
+def get_call_site(definition_name):
+    call_site = None
+    helper = None
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = Path(frame.f_code.co_filename).name
+        if filename in HELPER_FILES:
+            # Keep the outermost helper, i.e. the one called by the definition
+            helper = frame.f_code.co_name
+        elif filename == definition_name and call_site is None:
+            call_site = f"{filename}:{frame.f_lineno}"
+        frame = frame.f_back
+    return f"{call_site} {helper or '(direct)'}"
+
+
+## This function loads a dataset definition, recording the call site which added each column
+## user_args: arguments passed to the definition, which it reads from sys.argv
+def load_dataset_with_call_sites(definition, user_args=()):
+    call_sites = {}
+    patched = {}
+
+    def record(method_name):
+        original = getattr(Dataset, method_name)
+        patched[method_name] = original
+
+        def recording_method(self, name, *args, **kwargs):
+            call_sites.setdefault(name, get_call_site(definition.name))
+            return original(self, name, *args, **kwargs)
+
+        setattr(Dataset, method_name, recording_method)
+
+    for method_name in ["__setattr__", "add_column", "add_event_table"]:
+        if hasattr(Dataset, method_name):
+            record(method_name)
+    try:
+        dataset = load_dataset(definition, user_args)
+    finally:
+        for method_name, original in patched.items():
+            setattr(Dataset, method_name, original)
+    return dataset, call_sites
+
+
+## This function profiles each column of a dataset
+def profile_columns(dataset, call_sites):
+    column_nodes = get_column_nodes(dataset)
+    tree_memo = {}
+    depth_memo = {}
+
+    # Count how many columns build each sub-expression. Nodes are compared by value, so sub-expressions built
+    # separately but identically count as duplicates
+    distinct_by_column = {name: get_distinct_nodes([node]) for name, node in column_nodes.items()}
+    columns_using = Counter(
+        node
+        for nodes in distinct_by_column.values()
+        for node in nodes
+        if type(node).__qualname__ not in LEAF_NODE_TYPES
+    )
+
+    profile = []
+    for name, node in column_nodes.items():
+        distinct_nodes = distinct_by_column[name]
+        tables, scans = get_table_scans(distinct_nodes)
+        profile.append({
+            "column": name,
+            "call_site": call_sites.get(name.split(".")[0], "(unknown)"),
+            "tree_size": get_tree_size(node, tree_memo),
+            "distinct_nodes": len(distinct_nodes),
+            "depth": get_depth(node, depth_memo),
+            "tables": len(tables),
+            "scans": scans,
+            "duplicated": sum(1 for n in distinct_nodes if columns_using.get(n, 0) > 1),
+        })
+    return profile
+
+
+## This function adds up the column profiles for each call site
+def profile_call_sites(column_profile):
+    call_sites = {}
+    for row in column_profile:
+        site = call_sites.setdefault(
+            row["call_site"],
+            {"call_site": row["call_site"], "columns": 0, "tree_size": 0, "depth": 0, "scans": 0, "duplicated": 0},
+        )
+        site["columns"] += 1
+        site["tree_size"] += row["tree_size"]
+        site["depth"] = max(site["depth"], row["depth"])
+        site["scans"] += row["scans"]
+        site["duplicated"] += row["duplicated"]
+    return sorted(call_sites.values(), key=lambda site: site["tree_size"], reverse=True)
+
+
+## This function prints rows as a table
+def print_table(rows, columns):
+    widths = {column: max([len(column)] + [len(str(row[column])) for row in rows]) for column in columns}
+    print("  ".join(column.ljust(widths[column]) for column in columns))
+    for row in rows:
+        print("  ".join(str(row[column]).ljust(widths[column]) for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile the ehrQL query graph of a dataset definition")
+    parser.add_argument("definition", type=Path)
+    parser.add_argument("--max-tree-size", type=int, default=MAX_TREE_SIZE, help="budget for the tree size of a column")
+    parser.add_argument("--max-depth", type=int, default=MAX_DEPTH, help="budget for the depth of a column")
+    parser.add_argument("--top", type=int, default=20, help="number of columns to list")
+    parser.add_argument("--output", type=Path, help="file to write the full profile to as JSON")
+    parser.add_argument("--fail", action="store_true", help="fail if any column is over budget")
+    args = parser.parse_args()
+
+    sys.setrecursionlimit(100_000)
+    dataset, call_sites = load_dataset_with_call_sites(args.definition)
+    column_profile = profile_columns(dataset, call_sites)
+    call_site_profile = profile_call_sites(column_profile)
+    over_budget = [
+        row for row in column_profile
+        if row["tree_size"] > args.max_tree_size or row["depth"] > args.max_depth
+    ]
+
+    print(f"\nCall sites in {args.definition}")
+    print_table(call_site_profile, ["call_site", "columns", "tree_size", "depth", "scans", "duplicated"])
+
+    print(f"\nLargest {args.top} columns")
+    largest = sorted(column_profile, key=lambda row: row["tree_size"], reverse=True)[: args.top]
+    print_table(largest, ["column", "tree_size", "distinct_nodes", "depth", "tables", "scans", "duplicated", "call_site"])
+
+    if over_budget:
+        print(f"\n{len(over_budget)} columns over budget (tree size {args.max_tree_size}, depth {args.max_depth})")
+        print_table(over_budget, ["column", "tree_size", "depth", "call_site"])
+
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(
+            {"columns": column_profile, "call_sites": call_site_profile, "over_budget": over_budget}, indent=2
+        ))
+
+    if args.fail and over_budget:
+        sys.exit(f"{len(over_budget)} columns over budget")
+
+
+if __name__ == "__main__":
+    main()
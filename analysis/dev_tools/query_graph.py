@@ -0,0 +1,118 @@
+## This file contains functions for loading a dataset definition and measuring the size of the ehrQL query
+## graph behind each of its variables, without running any queries.
+## Run from the root of the repository with ehrql importable, e.g.
+##   PYTHONPATH=.devcontainer/ehrql-main python analysis/dev_tools/query_graph.py analysis/dataset_definition/dataset_definition_hist.py
+## to print the totals for one definition as JSON. Arguments after -- are passed to the definition, as with ehrQL
+## (e.g. -- --year 2017 for one partition of a definition partitioned by year).
+
+import dataclasses
+import json
+import runpy
+import sys
+from pathlib import Path
+
+from ehrql.query_model.nodes import Node
+
+
+## This function runs a dataset definition and returns the dataset it defines
+## user_args: arguments passed to the definition, which it reads from sys.argv
+def load_dataset(definition, user_args=()):
+    for path in ["analysis/dataset_definition", "."]:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    argv = sys.argv
+    sys.argv = [str(definition), *user_args]
+    try:
+        return runpy.run_path(str(definition), run_name="__main__")["dataset"]
+    finally:
+        sys.argv = argv
+
+
+## This function returns the query model node of each column of a dataset, including the population and the
+## columns of any event tables (named {table}.{column})
+def get_column_nodes(dataset):
+    nodes = {name: series._qm_node for name, series in dataset.variables.items()}
+    if getattr(dataset, "population", None) is not None:
+        nodes["population"] = dataset.population._qm_node
+    for table_name, event_table in getattr(dataset, "events", {}).items():
+        for column_name, series in getattr(event_table, "series", {}).items():
+            nodes[f"{table_name}.{column_name}"] = series._qm_node
+    return nodes
+
+
+## This function returns the query model nodes directly below a node
+def get_children(node):
+    children = []
+    for field in dataclasses.fields(node):
+        values = [getattr(node, field.name)]
+        while values:
+            value = values.pop()
+            if isinstance(value, Node):
+                children.append(value)
+            elif isinstance(value, (tuple, list, frozenset, set)):
+                values.extend(value)
+            elif isinstance(value, dict):
+                values.extend(value.values())
+    return children
+
+
+## This function returns the distinct nodes in the graphs below the given nodes
+def get_distinct_nodes(nodes):
+    seen = {}
+    to_visit = list(nodes)
+    while to_visit:
+        node = to_visit.pop()
+        if id(node) in seen:
+            continue
+        seen[id(node)] = node
+        to_visit.extend(get_children(node))
+    return set(seen.values())
+
+
+## This function returns the number of nodes in the graph below a node if every shared sub-expression were written
+## out in full, which is roughly how the size of the generated query grows. memo is keyed by id(node).
+def get_tree_size(node, memo):
+    if id(node) not in memo:
+        memo[id(node)] = 1 + sum(get_tree_size(child, memo) for child in get_children(node))
+    return memo[id(node)]
+
+
+## This function returns the length of the longest path from a node to the bottom of its graph
+def get_depth(node, memo):
+    if id(node) not in memo:
+        memo[id(node)] = 1 + max((get_depth(child, memo) for child in get_children(node)), default=0)
+    return memo[id(node)]
+
+
+## This function returns the names of the tables read in the graph below a node, and the number of distinct
+## patient-level aggregations (each of which is a separate pass over a table, e.g. first_for_patient() or
+## count_for_patient())
+def get_table_scans(distinct_nodes):
+    tables = set()
+    aggregations = 0
+    for node in distinct_nodes:
+        node_type = type(node).__qualname__
+        if node_type in ("SelectTable", "SelectPatientTable", "InlinePatientTable"):
+            tables.add(getattr(node, "name", node_type))
+        elif node_type == "PickOneRowPerPatient" or node_type.startswith("AggregateByPatient."):
+            aggregations += 1
+    return tables, aggregations
+
+
+## This function summarises the size of the query graph of a dataset
+def summarise_dataset(dataset):
+    nodes = get_column_nodes(dataset)
+    tree_memo = {}
+    depth_memo = {}
+    return {
+        "columns": len(nodes),
+        "distinct_nodes": len(get_distinct_nodes(nodes.values())),
+        "tree_size": sum(get_tree_size(node, tree_memo) for node in nodes.values()),
+        "max_depth": max((get_depth(node, depth_memo) for node in nodes.values()), default=0),
+    }
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(100_000)
+    user_args = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    print(json.dumps(summarise_dataset(load_dataset(Path(sys.argv[1]), user_args))))
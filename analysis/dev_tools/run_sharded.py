@@ -0,0 +1,187 @@
+## This script runs a generate_dataset_* action locally on large dummy tables by splitting the patients into shards.
+## Every variable in the dataset definitions is calculated per patient, so each shard can be run separately:
+## - the dummy tables (and the eligible population file read by population.py, if there is one) are split into
+##   shards by patient_id range, a chunk of rows at a time
+## - generate-dataset is run on each shard in its own process, with up to --workers processes at once, so all the
+##   cores are used and the memory of each process depends on the size of a shard rather than of the whole cohort
+## - the outputs of the shards are joined in shard order, so the rows stay in order of patient_id and the output is
+##   the same as a single run
+## The wall time and peak memory of each shard are printed, with the logs in output/shards/<action>/shard_<n>.
+## Run from the root of the repository with ehrql importable, e.g.
+##   PYTHONPATH=.devcontainer/ehrql-main python analysis/dev_tools/run_sharded.py generate_dataset_hist_2017 --dummy-tables output/dummy_tables_1m --shards 8
+
+import argparse
+import gzip
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import pyarrow.ipc as ipc
+
+from benchmark_definitions import get_generate_actions, get_output_paths, make_work_dir, run_generate_dataset
+
+SHARD_DIR = Path("output/shards")
+POPULATION_PATH = Path("output/dataset_clean/population_prematch.arrow")
+CHUNK_SIZE = 500_000
+
+
+## This function returns the first patient_id of each shard after the first, so that each shard has about the same
+## number of patients
+def get_shard_boundaries(tables_dir, n_shards):
+    patient_ids = np.sort(pd.read_csv(tables_dir / "patients.csv", usecols=["patient_id"])["patient_id"].to_numpy())
+    return patient_ids[[len(patient_ids) * i // n_shards for i in range(1, n_shards)]]
+
+
+## This function returns the shard of each patient
+def get_shards(patient_ids, boundaries):
+    return np.searchsorted(boundaries, patient_ids, side="right")
+
+
+## This function splits each dummy table into a directory per shard, a chunk of rows at a time. Every shard gets
+## every table, with just the header if none of its patients are in the table
+def split_dummy_tables(tables_dir, shard_dirs, boundaries):
+    for table_path in sorted(tables_dir.glob("*.csv")):
+        files = [open(shard_dir / table_path.name, "w", newline="") for shard_dir in shard_dirs]
+        try:
+            chunks = pd.read_csv(table_path, dtype=str, keep_default_na=False, chunksize=CHUNK_SIZE)
+            for i, chunk in enumerate(chunks):
+                shards = get_shards(chunk["patient_id"].astype(np.int64).to_numpy(), boundaries)
+                for shard, file in enumerate(files):
+                    chunk[shards == shard].to_csv(file, index=False, header=(i == 0))
+        finally:
+            for file in files:
+                file.close()
+
+
+## This function splits the eligible population file between the working directories of the shards
+def split_population(work_dirs, boundaries):
+    population = feather.read_table(POPULATION_PATH)
+    shards = get_shards(population.column("patient_id").to_numpy(), boundaries)
+    for shard, work_dir in enumerate(work_dirs):
+        path = work_dir / POPULATION_PATH
+        path.parent.mkdir(parents=True, exist_ok=True)
+        feather.write_feather(population.filter(pa.array(shards == shard)), path, compression="uncompressed")
+
+
+## This function returns every value in the dictionaries of a column across the shards' Arrow files
+def get_dictionary_values(paths, field):
+    values = []
+    for path in paths:
+        with pa.memory_map(str(path)) as source:
+            reader = ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                values.extend(reader.get_batch(i).column(field.name).dictionary.to_pylist())
+    return pa.array(sorted(set(values) - {None}), type=field.type.value_type)
+
+
+## This function joins the shards' Arrow files, a batch at a time. Each shard has its own dictionaries for the
+## categorical columns, so these are re-encoded with the values of all shards
+def join_arrow(paths, output_path):
+    with pa.memory_map(str(paths[0])) as source:
+        schema = ipc.open_file(source).schema
+    dictionaries = {
+        field.name: get_dictionary_values(paths, field)
+        for field in schema
+        if pa.types.is_dictionary(field.type)
+    }
+    with ipc.new_file(str(output_path), schema, options=ipc.IpcWriteOptions(compression="zstd")) as writer:
+        for path in paths:
+            with pa.memory_map(str(path)) as source:
+                reader = ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    batch = reader.get_batch(i)
+                    columns = []
+                    for field, column in zip(schema, batch.columns):
+                        if field.name in dictionaries:
+                            values = column.dictionary_decode()
+                            indices = pc.index_in(values, value_set=dictionaries[field.name])
+                            column = pa.DictionaryArray.from_arrays(
+                                indices.cast(field.type.index_type), dictionaries[field.name]
+                            )
+                        columns.append(column)
+                    writer.write_batch(pa.record_batch(columns, schema=schema))
+
+
+## This function joins the shards' CSV files (compressed or not), keeping the header of the first
+def join_csv(paths, output_path):
+    open_file = gzip.open if output_path.suffix == ".gz" else open
+    with open_file(output_path, "wb") as output:
+        for i, path in enumerate(paths):
+            with open_file(path, "rb") as f:
+                header = f.readline()
+                if i == 0:
+                    output.write(header)
+                shutil.copyfileobj(f, output)
+
+
+## This function joins each output file of the shards into the same file in the repository
+def join_outputs(work_dirs, output):
+    for path in get_output_paths(work_dirs[0], output):
+        relative_path = path.relative_to(work_dirs[0])
+        paths = [work_dir / relative_path for work_dir in work_dirs]
+        relative_path.parent.mkdir(parents=True, exist_ok=True)
+        if relative_path.suffix in (".arrow", ".feather"):
+            join_arrow(paths, relative_path)
+        else:
+            join_csv(paths, relative_path)
+        print(f"Wrote {relative_path}")
+
+
+## This function runs one action on every shard and joins the outputs
+def run_sharded(name, action, tables_dir, n_shards, workers):
+    action_dir = SHARD_DIR / name
+    if action_dir.exists():
+        shutil.rmtree(action_dir)
+    work_dirs = [make_work_dir(action_dir / f"shard_{shard}") for shard in range(n_shards)]
+    shard_tables = [work_dir / "dummy_tables" for work_dir in work_dirs]
+    for shard_dir in shard_tables:
+        shard_dir.mkdir()
+
+    start = time.perf_counter()
+    boundaries = get_shard_boundaries(tables_dir, n_shards)
+    split_dummy_tables(tables_dir, shard_tables, boundaries)
+    if POPULATION_PATH.exists():
+        split_population(work_dirs, boundaries)
+    print(f"Split into {n_shards} shards in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Each thread waits for a generate-dataset process, so up to `workers` shards run at once
+        results = list(executor.map(
+            lambda shard: run_generate_dataset(
+                work_dirs[shard], action, shard_tables[shard], work_dirs[shard] / "generate.log"
+            ),
+            range(n_shards),
+        ))
+    for shard, (wall_s, peak_rss_mb) in enumerate(results):
+        print(f"Shard {shard}: {wall_s:.1f}s, {peak_rss_mb:.0f} MB")
+    print(f"Ran {n_shards} shards in {time.perf_counter() - start:.1f}s")
+
+    join_outputs(work_dirs, action["output"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run generate_dataset_* actions on shards of the patients")
+    parser.add_argument("actions", nargs="+", help="generate actions to run")
+    parser.add_argument("--dummy-tables", type=Path, default=Path("dummy_tables"), help="dummy tables to run on")
+    parser.add_argument("--shards", type=int, default=4, help="number of shards to split the patients into")
+    parser.add_argument("--workers", type=int, default=4, help="number of shards to run at once")
+    parser.add_argument("--keep", action="store_true", help="keep the shard directories after joining the outputs")
+    args = parser.parse_args()
+
+    actions = get_generate_actions()
+    for name in args.actions:
+        print(f"Running {name}")
+        run_sharded(name, actions[name], args.dummy_tables, args.shards, args.workers)
+        if not args.keep:
+            shutil.rmtree(SHARD_DIR / name)
+
+
+if __name__ == "__main__":
+    main()
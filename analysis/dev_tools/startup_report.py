@@ -0,0 +1,86 @@
+## This script reports how long each dataset definition takes to start up, without running any queries.
+## Each definition is loaded in a fresh Python process and the time is split into:
+## - codelists: importing codelists.py (checking the codelist cache)
+## - helpers: importing variable_helper_functions.py and add_variables.py
+## - construction: running the dataset definition to build the dataset
+## along with the number of codelists the definition actually loaded.
+## Run from the root of the repository with ehrql importable, e.g. in the codespace:
+##   PYTHONPATH=.devcontainer/ehrql-main python analysis/dev_tools/startup_report.py --budget 5
+## If --budget is given, the script fails if any definition takes longer than this many seconds in total.
+
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+DEFINITION_DIR = Path("analysis/dataset_definition")
+
+# Code run in a fresh process for each definition, which prints the timings as JSON
+TIMING_CODE = """
+import json, runpy, sys, time
+sys.path[:0] = [".", "analysis/dataset_definition"]
+t0 = time.perf_counter()
+import codelists
+t1 = time.perf_counter()
+import analysis.dataset_definition.variable_helper_functions
+import analysis.dataset_definition.add_variables
+t2 = time.perf_counter()
+runpy.run_path(sys.argv[1], run_name="__main__")
+t3 = time.perf_counter()
+print(json.dumps({
+    "codelists": t1 - t0,
+    "helpers": t2 - t1,
+    "construction": t3 - t2,
+    "total": t3 - t0,
+    "codelists_loaded": len(codelists.compiled_codelists.loaded_names),
+    "codelists_available": len(codelists.compiled_codelists),
+}))
+"""
+
+
+## This function loads a dataset definition in a fresh process and returns its startup timings
+def time_definition(definition):
+    result = subprocess.run(
+        [sys.executable, "-c", TIMING_CODE, str(definition)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the startup time of each dataset definition")
+    parser.add_argument("definitions", nargs="*", type=Path,
+        help="dataset definitions to report on (default: all dataset_definition_*.py files)")
+    parser.add_argument("--budget", type=float, help="maximum total startup time in seconds")
+    parser.add_argument("--output", type=Path, help="file to write the report to as JSON")
+    args = parser.parse_args()
+
+    definitions = args.definitions or sorted(DEFINITION_DIR.glob("dataset_definition_*.py"))
+
+    report = {}
+    print(f"{'definition':<32}{'codelists':>11}{'helpers':>10}{'construct':>11}{'total':>9}{'lists':>9}")
+    for definition in definitions:
+        timings = time_definition(definition)
+        report[definition.stem] = timings
+        print(
+            f"{definition.stem:<32}"
+            f"{timings['codelists']:>10.2f}s{timings['helpers']:>9.2f}s"
+            f"{timings['construction']:>10.2f}s{timings['total']:>8.2f}s"
+            f"{timings['codelists_loaded']:>5}/{timings['codelists_available']}"
+        )
+
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, indent=2))
+
+    if args.budget is not None:
+        over_budget = [name for name, timings in report.items() if timings["total"] > args.budget]
+        if over_budget:
+            sys.exit(f"Startup time over budget of {args.budget}s: {', '.join(over_budget)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+## This script traces where the time goes when the generate_dataset_* actions in project.yaml are run locally on
+## dummy data. For each action it records:
+## - codelists_s, helpers_s, construction_s: time to import codelists.py, import the helper modules and run the
+##   dataset definition to build the dataset, in a fresh process (as startup_report.py does), and construction_peak_rss_mb,
+##   the peak memory of that process
+## - helpers: the number of calls and the time spent in each function from variable_helper_functions.py and
+##   add_variables.py while the dataset is built. Times include any helpers called by the helper, so they don't add up
+##   to construction_s
+## - generate_s, generate_peak_rss_mb: wall time and peak memory of generate-dataset, which runs the queries and writes
+##   the output. ehrQL writes the rows as the queries return them, so the two can't be timed separately
+## - outputs: the rows, columns and size of each file written
+## The trace is written to output/traces/trace.json. If --baseline is given, the change in each time from a previous
+## trace is printed, to compare runs.
+## Run from the root of the repository with ehrql importable, after the actions the traced actions need have run, e.g.
+##   PYTHONPATH=.devcontainer/ehrql-main python analysis/dev_tools/trace_actions.py generate_dataset_prematch
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+from benchmark_definitions import get_generate_actions, get_output_paths, run_generate_dataset
+
+TRACE_DIR = Path("output/traces")
+
+# Code run in a fresh process for each definition, which prints the timings as JSON. The helper functions are
+# wrapped before add_variables.py and the definition import them, so every call goes through the wrapper
+TRACE_CODE = """
+import json, resource, runpy, sys, time
+sys.path[:0] = [".", "analysis/dataset_definition"]
+helper_times = {}
+
+def wrap(name, function):
+    def traced(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            calls, seconds = helper_times.get(name, (0, 0.0))
+            helper_times[name] = (calls + 1, seconds + time.perf_counter() - start)
+    traced.__wrapped__ = function
+    return traced
+
+def trace(module):
+    file_name = module.__name__.rsplit(".", 1)[-1]
+    for name, value in list(vars(module).items()):
+        if callable(value) and not isinstance(value, type) and getattr(value, "__module__", None) == module.__name__:
+            setattr(module, name, wrap(f"{file_name}.{name}", value))
+
+t0 = time.perf_counter()
+import codelists
+t1 = time.perf_counter()
+import analysis.dataset_definition.variable_helper_functions as variable_helper_functions
+trace(variable_helper_functions)
+import analysis.dataset_definition.add_variables as add_variables
+trace(add_variables)
+t2 = time.perf_counter()
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+t3 = time.perf_counter()
+print(json.dumps({
+    "codelists_s": t1 - t0,
+    "helpers_s": t2 - t1,
+    "construction_s": t3 - t2,
+    "construction_peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "helpers": {
+        name: {"calls": calls, "seconds": seconds}
+        for name, (calls, seconds) in sorted(helper_times.items(), key=lambda item: -item[1][1])
+    },
+}))
+"""
+
+
+## This function builds the dataset of an action in a fresh process and returns the timings of each phase
+def trace_construction(action):
+    result = subprocess.run(
+        [sys.executable, "-c", TRACE_CODE, action["definition"], *action["user_args"]],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+## This function returns the number of rows and columns of an output file (an Arrow file or a CSV)
+def describe_output(path):
+    if path.suffix in (".arrow", ".feather"):
+        with pa.memory_map(str(path)) as source:
+            reader = ipc.open_file(source)
+            rows = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+            columns = len(reader.schema)
+    else:
+        columns = len(pd.read_csv(path, nrows=0).columns)
+        rows = sum(len(chunk) for chunk in pd.read_csv(path, usecols=[0], chunksize=100_000))
+    return {"rows": rows, "columns": columns, "bytes": path.stat().st_size}
+
+
+## This function traces one action: building its dataset, then running generate-dataset
+def trace_action(name, action, tables_dir):
+    print(f"Tracing {name}")
+    trace = trace_construction(action)
+
+    log_path = TRACE_DIR / f"{name}.log"
+    generate_s, generate_peak_rss_mb = run_generate_dataset(Path("."), action, tables_dir, log_path)
+    trace["generate_s"] = generate_s
+    trace["generate_peak_rss_mb"] = generate_peak_rss_mb
+    trace["outputs"] = {
+        str(path): describe_output(path)
+        for path in get_output_paths(Path("."), action["output"])
+        if path.is_file()
+    }
+    return trace
+
+
+## This function prints the change in each phase time of each action from a previous trace
+def compare_with_baseline(actions, baseline):
+    for name, trace in actions.items():
+        previous = baseline["actions"].get(name)
+        if previous is None:
+            continue
+        changes = [
+            f"{measure} {previous[measure]:.2f}s -> {trace[measure]:.2f}s"
+            for measure in ["codelists_s", "helpers_s", "construction_s", "generate_s"]
+        ]
+        print(f"{name}: " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trace the phases of the generate_dataset_* actions")
+    parser.add_argument("actions", nargs="*", help="generate actions to trace (default: all)")
+    parser.add_argument("--dummy-tables", type=Path, default=Path("dummy_tables"), help="dummy tables to run on")
+    parser.add_argument("--output", type=Path, default=TRACE_DIR / "trace.json", help="file to write the trace to")
+    parser.add_argument("--baseline", type=Path, help="previous trace.json to compare with")
+    args = parser.parse_args()
+
+    actions = get_generate_actions()
+    if args.actions:
+        actions = {name: actions[name] for name in args.actions}
+
+    TRACE_DIR.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    traces = {name: trace_action(name, action, args.dummy_tables) for name, action in actions.items()}
+    result = {
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "total_s": time.perf_counter() - start,
+        "actions": traces,
+    }
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(result, indent=2))
+
+    for name, trace in traces.items():
+        slowest = ", ".join(f"{helper} {timing['seconds']:.2f}s" for helper, timing in list(trace["helpers"].items())[:3])
+        print(
+            f"{name}: construction {trace['construction_s']:.2f}s, generate {trace['generate_s']:.2f}s "
+            f"({trace['generate_peak_rss_mb']:.0f} MB), slowest helpers: {slowest or 'none'}"
+        )
+    print(f"Trace written to {args.output}")
+
+    if args.baseline:
+        compare_with_baseline(traces, json.loads(args.baseline.read_text()))
+
+
+if __name__ == "__main__":
+    main()